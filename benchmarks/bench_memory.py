@@ -0,0 +1,127 @@
+"""
+Memory benchmark of the per-server results kept during a sweep.
+
+Compares the memory used by a fleet of results stored as plain
+dictionaries and lists of strings, as every server result used to be kept,
+against the compact ``HostStats`` and ``ProcessTable`` containers.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Usage::
+
+    python benchmarks/bench_memory.py --hosts 5000 --processes 400
+"""
+
+import random
+import tracemalloc
+import click
+from fleet import fake_ps_output
+from vmdiag import stats
+
+
+def fake_batch_output(process_count, rng):
+    """
+    Builds the batched output of a server with random processes.
+
+    Parameters
+    ----------
+    process_count: int
+        Number of processes of the server.
+    rng: Random
+        Random number generator.
+
+    Returns
+    -------
+    list
+        Output lines of the ``ps`` backend batched command.
+    """
+    lines = ['@@vmdiag@@ processes\n'] + fake_ps_output(process_count, rng)
+    lines += ['@@vmdiag@@ cpu\n', 'cpu  3000 10 1000 16000 50 0 20 5 0 0\n',
+              'cpu0  1500 5 500 8000 25 0 10 5 0 0\n', 'cpu1  1500 5 500 8000 25 0 10 0 0 0\n',
+              '@@vmdiag@@ memory\n', 'MemAvailable:     729240 kB\n']
+    return lines
+
+
+def plain_stats(output_lines, top=3):
+    """
+    Parses the batched output into plain dictionaries and lists, with a new
+    string for every process name.
+
+    Parameters
+    ----------
+    output_lines: list
+        Output lines of the ``ps`` backend batched command.
+    top: int
+        Number of top processes to report for every metric.
+
+    Returns
+    -------
+    dictionary
+        The usage data of the server, in the JSON output format.
+    """
+    sections = dict((name, list(lines)) for name, lines in stats.iter_sections(output_lines))
+    processes = [tuple(line.split(None, 3)) for line in sections['processes'][1:]]
+    stats_dict = {'running_processes': [proc[3].rstrip() for proc in processes]}
+    for metric, index in (('cpu', 1), ('memory', 2)):
+        top_dict = {}
+        for pid, cpu, memory, name in sorted(processes, key=lambda proc: float(proc[index]),
+                                             reverse=True)[:top]:
+            top_dict[pid] = {'name': name, 'cpu': float(cpu), 'memory': float(memory)}
+        stats_dict['top_%d_%s_consumption' % (top, metric)] = top_dict
+    capacity = stats.cpu_usage(None, stats.parse_cpu_times(sections['cpu']))
+    capacity['memory_kb'] = stats.parse_meminfo(sections['memory'])['MemAvailable']
+    stats_dict['remaining_capacity'] = capacity
+    return stats_dict
+
+
+def measure(hosts, processes, compact):
+    """
+    Parses the output of a fake fleet and measures the memory used by the
+    results of every server.
+
+    Parameters
+    ----------
+    hosts: int
+        Number of servers.
+    processes: int
+        Number of processes per server.
+    compact: bool
+        Whether to keep ``HostStats`` instances or plain dictionaries.
+
+    Returns
+    -------
+    int
+        Bytes allocated by the fleet results.
+    """
+    rng = random.Random(1)
+    outputs = [fake_batch_output(processes, rng) for _ in range(10)]
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    fleet = {}
+    for host in range(hosts):
+        output_lines = outputs[host % len(outputs)]
+        if compact:
+            host_stats, _ = stats.parse_batch(output_lines)
+        else:
+            host_stats = plain_stats(output_lines)
+        fleet['10.%d.%d.%d' % (host >> 16, (host >> 8) & 255, host & 255)] = host_stats
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current - start
+
+
+@click.command()
+@click.option('--hosts', default=1000, show_default=True, help='Number of simulated servers.')
+@click.option('--processes', default=400, show_default=True, help='Number of processes per server.')
+def main(hosts, processes):
+    plain = measure(hosts, processes, False)
+    compact = measure(hosts, processes, True)
+    click.echo('Hosts: %d, processes per host: %d' % (hosts, processes))
+    click.echo('Dictionaries: %10.1f MB' % (plain / 2 ** 20))
+    click.echo('HostStats:    %10.1f MB' % (compact / 2 ** 20))
+    click.echo('Reduction:    %10.1f x' % (plain / compact))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Benchmark of the parsing of the batched command output.
+
+Compares parsing the output once it has been received whole, as
+``vmdiag`` used to do (joining the chunks, decoding them and splitting
+the lines before parsing), against parsing it line by line as the chunks
+arrive (see ``stats.iter_lines()`` and ``stats.iter_sections()``). Reports
+the best time and the peak memory allocated while parsing.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Usage::
+
+    python benchmarks/bench_parse.py --processes 2000 --processes 100000
+"""
+
+import time
+import tracemalloc
+import click
+import fleet
+from vmdiag import server, stats
+
+
+def chunks(output, size=server.Server.CHUNK_SIZE):
+    """
+    Yields the output of a command in chunks, as received from the channel.
+    """
+    view = memoryview(output)
+    for start in range(0, len(output), size):
+        yield bytes(view[start:start + size])
+
+
+def parse_whole(output):
+    """
+    Parses the output once every chunk has been received.
+    """
+    text = b''.join(list(chunks(output))).decode('utf-8', 'replace')
+    return stats.parse_batch(text.splitlines(True))
+
+
+def parse_streamed(output):
+    """
+    Parses the output as the chunks arrive.
+    """
+    return stats.parse_batch(stats.iter_lines(chunks(output)))
+
+
+def measure(function, output, repeat):
+    """
+    Returns the best time in seconds and the peak memory in bytes of parsing
+    an output.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(output)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    function(output)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+@click.command()
+@click.option('--processes', multiple=True, type=int, default=[2000, 20000, 100000],
+              show_default=True, help='Number of processes of the server, once per run.')
+@click.option('--backend', multiple=True, default=['ps', 'proc'], show_default=True,
+              type=click.Choice(['ps', 'proc']), help='Batched backend whose output is parsed.')
+@click.option('--repeat', default=3, show_default=True, help='Runs of every parse.')
+def main(processes, backend, repeat):
+    click.echo('%9s %7s %11s %11s %11s %11s %11s' % (
+        'processes', 'backend', 'output (kB)', 'whole (ms)', 'whole (MB)', 'stream (ms)',
+        'stream (MB)'))
+    for process_count in processes:
+        host = fleet.FakeHost('127.1.0.1', process_count)
+        for name in backend:
+            sections = [stats.CPU_BASELINE_SECTION] + stats.BACKENDS[name]
+            output = host.run(stats.batch_command(sections)).encode('utf-8')
+            whole_time, whole_peak = measure(parse_whole, output, repeat)
+            stream_time, stream_peak = measure(parse_streamed, output, repeat)
+            click.echo('%9d %7s %11.0f %11.1f %11.1f %11.1f %11.1f' % (
+                process_count, name, len(output) / 1024, whole_time * 1000, whole_peak / 2 ** 20,
+                stream_time * 1000, stream_peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
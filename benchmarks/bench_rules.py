@@ -0,0 +1,139 @@
+"""
+Benchmark of the alert rules engine.
+
+Compares evaluating a set of rules on the columns of the fleet (see
+``vmdiag/rules.py``) against looping over the result of every server for
+every rule, as the scripts that post-process ``server_data.json`` do. The
+rules engine is timed on plain lists and, if NumPy is installed, on NumPy
+arrays.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Usage::
+
+    python benchmarks/bench_rules.py --hosts 10000 --rules 50
+"""
+
+import random
+import time
+import click
+from vmdiag import rules
+
+NAMES = ['java', 'python', 'nginx', 'postgres', 'redis', 'node', 'sshd', 'cron', 'systemd',
+         'dockerd'] + ['worker-%d' % index for index in range(90)]
+"""
+list: Process names of the simulated servers.
+"""
+
+
+def fake_fleet(host_count, rng):
+    """
+    Builds two samples of every server of a fleet, a minute apart.
+
+    Parameters
+    ----------
+    host_count: int
+        Number of servers.
+    rng: Random
+        Random number generator.
+
+    Returns
+    -------
+    dictionary
+        The last samples of every server, as built by ``rules.add_sample()``.
+    """
+    hosts = {}
+    for index in range(host_count):
+        ip_address = '10.%d.%d.%d' % (index >> 16, (index >> 8) & 255, index & 255)
+        memory_kb = rng.randint(100000, 8000000)
+        for timestamp in (0.0, 60.0):
+            top_dict = dict((str(pid), {'name': name, 'cpu': 1.0, 'memory': 1.0})
+                            for pid, name in enumerate(rng.sample(NAMES, 3), 1))
+            rules.add_sample(hosts, ip_address, {
+                'top_3_cpu_consumption': top_dict, 'top_3_memory_consumption': top_dict,
+                'remaining_capacity': {'cpu': rng.uniform(0, 100), 'cpu_steal': rng.uniform(0, 5),
+                                       'memory_kb': memory_kb}}, timestamp)
+            memory_kb += rng.randint(-20000, 20000)
+    return hosts
+
+
+def fake_rules(rule_count, rng):
+    """
+    Builds a mix of threshold, rate and top rules, each firing on a few
+    percent of the servers at most.
+    """
+    specs = []
+    for index in range(rule_count):
+        kind = index % 3
+        spec = {'name': 'rule-%d' % index}
+        if kind == 0:
+            spec.update(metric=rng.choice(['cpu', 'cpu_steal', 'memory_kb']),
+                        below=rng.uniform(0.1, 3))
+        elif kind == 1:
+            spec.update(metric='memory_kb', rate=True, below=-rng.randint(18000, 19900))
+        else:
+            spec.update(process=rng.choice(NAMES), top=rng.randint(1, 3),
+                        metric=rng.choice(['cpu', 'memory']))
+        specs.append(spec)
+    return rules.parse_rules(specs)
+
+
+def loop_evaluate(rule_list, hosts):
+    """
+    Evaluates every rule by looping over the result of every server.
+    """
+    alerts = 0
+    for rule in rule_list:
+        for host in hosts.values():
+            last = host['last']
+            if rule.kind == 'top':
+                top_dict = last['top_3_%s_consumption' % rule.metric]
+                names = [process['name'] for process in top_dict.values()][:rule.value]
+                alerts += rule.process in names
+                continue
+            value = last['remaining_capacity'][rule.metric]
+            if rule.kind == 'rate':
+                previous = host['previous']['remaining_capacity'][rule.metric]
+                value = (value - previous) / host['elapsed'] * rules.RATE_PERIOD
+            alerts += rules.BOUNDS[rule.bound](value, rule.value)
+    return alerts
+
+
+def best_time(function, repeat):
+    """
+    Returns the result and the best time in seconds of several calls.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+@click.command()
+@click.option('--hosts', default=10000, show_default=True, help='Number of simulated servers.')
+@click.option('--rules', 'rule_count', default=50, show_default=True, help='Number of rules.')
+@click.option('--repeat', default=3, show_default=True, help='Runs of every evaluation.')
+def main(hosts, rule_count, repeat):
+    rng = random.Random(42)
+    fleet_hosts = fake_fleet(hosts, rng)
+    rule_list = fake_rules(rule_count, rng)
+    expected, loop_time = best_time(lambda: loop_evaluate(rule_list, fleet_hosts), repeat)
+    click.echo('%-12s %10s %8s %9s' % ('evaluation', 'time (ms)', 'alerts', 'speedup'))
+    click.echo('%-12s %10.1f %8d %9s' % ('loop', loop_time * 1000, expected, '1.0x'))
+    backends = [('lists', None)]
+    if rules.numpy is not None:
+        backends.append(('numpy', rules.numpy))
+    for name, module in backends:
+        rules.numpy = module
+        alerts, elapsed = best_time(lambda: rules.evaluate(rule_list, fleet_hosts), repeat)
+        assert len(alerts) == expected
+        click.echo('%-12s %10.1f %8d %8.1fx' % (name, elapsed * 1000, len(alerts),
+                                                loop_time / elapsed))
+
+
+if __name__ == '__main__':
+    main()
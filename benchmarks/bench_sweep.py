@@ -0,0 +1,140 @@
+"""
+End-to-end benchmark of a sweep against a simulated fleet.
+
+Starts a fleet of in-process SSH servers on localhost (see ``fleet.py``)
+for every fleet size and runs ``vmdiag`` against it in a separate process,
+as a user would, measuring:
+
+    * The wall time of the whole run, startup included, and the servers
+      swept per second.
+    * A ``cold`` run, where every server reads its CPU counters one second
+      apart, and a ``warm`` one measured against the counters saved by the
+      cold run, as a sweep run from cron.
+    * The per-server latency percentiles, from the ``--profile`` output.
+    * The servers that answered, timed out or failed.
+    * The peak resident memory of the main ``vmdiag`` process.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Usage::
+
+    python benchmarks/bench_sweep.py --hosts 10 --hosts 100 --hosts 1000 --latency 0.05
+"""
+
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import click
+import paramiko
+import fleet
+from vmdiag import profiling
+
+
+def run_sweep(fake_fleet, directory, key_path, concurrency, workers, backend, deadline, retries):
+    """
+    Runs ``vmdiag`` against a fleet and measures it.
+
+    Parameters
+    ----------
+    fake_fleet: FakeFleet
+        The started fleet.
+    directory: string
+        Directory for the output, known hosts and error files.
+    key_path: string
+        Private key used to log into the servers.
+    concurrency: int
+        Maximum number of servers queried at the same time.
+    workers: int
+        Number of processes the servers are split across.
+    backend: string
+        How the servers are queried.
+    deadline: float
+        Seconds every server has to answer.
+    retries: int
+        Times a server that timed out or dropped the connection is retried.
+
+    Returns
+    -------
+    dictionary
+        The ``wall`` time in seconds, the ``latencies`` of every server in
+        milliseconds, sorted, the ``statuses`` count and the ``peak_rss`` of
+        the process in MB.
+    """
+    output_path = os.path.join(directory, 'output.ndjson')
+    command = [sys.executable, '-W', 'ignore', '-m', 'vmdiag.vmdiag', 'sweep', fake_fleet.target(),
+               '--user', 'bench', '--key', key_path, '--port', str(fake_fleet.port),
+               '--known-hosts', os.path.join(directory, 'known_hosts'),
+               '--concurrency', str(concurrency), '--workers', str(workers), '--backend', backend,
+               '--deadline', str(deadline), '--retries', str(retries), '--backoff', '0.1',
+               '--profile', '--format', 'ndjson', '--output', output_path]
+    with open(os.path.join(directory, 'stderr.log'), 'w') as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=stderr)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        process.returncode = status
+    latencies = []
+    statuses = {}
+    with open(output_path) as output_file:
+        for line in output_file:
+            record = json.loads(line)
+            status = record.get('status', 'ok')
+            statuses[status] = statuses.get(status, 0) + 1
+            if 'profile' in record:
+                latencies.append(record['profile']['total_ms'])
+    latencies.sort()
+    # ru_maxrss is in kB on Linux:
+    return {'wall': wall, 'latencies': latencies, 'statuses': statuses,
+            'peak_rss': usage.ru_maxrss / 1024}
+
+
+@click.command()
+@click.option('--hosts', multiple=True, type=int, default=[10, 100, 1000], show_default=True,
+              help='Number of simulated servers, once per fleet size.')
+@click.option('--processes', default=200, show_default=True, help='Number of processes per server.')
+@click.option('--latency', default=0.05, show_default=True, help='Seconds every command takes.')
+@click.option('--jitter', default=0.02, show_default=True, help='Maximum random seconds added to the latency.')
+@click.option('--failure-rate', default=0.0, show_default=True, help='Share of servers that fail.')
+@click.option('--failure', default='stall', show_default=True, type=click.Choice(fleet.FAILURES),
+              help='How the failing servers fail.')
+@click.option('--concurrency', default=50, show_default=True, help='Servers queried at the same time.')
+@click.option('--workers', default=1, show_default=True, help='Processes the servers are split across.')
+@click.option('--backend', default='ps', show_default=True, type=click.Choice(['ps', 'proc', 'commands']),
+              help='How the servers are queried.')
+@click.option('--deadline', default=5.0, show_default=True, help='Seconds every server has to answer.')
+@click.option('--retries', default=0, show_default=True, help='Times a failed server is retried.')
+def main(hosts, processes, latency, jitter, failure_rate, failure, concurrency, workers, backend,
+         deadline, retries):
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    host_key = paramiko.RSAKey.generate(2048)
+    click.echo('%8s %5s %9s %9s %9s %9s %9s %9s %9s %9s %9s' % (
+        'hosts', 'run', 'wall (s)', 'hosts/s', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'ok', 'timeout',
+        'error', 'RSS (MB)'))
+    for host_count in hosts:
+        with tempfile.TemporaryDirectory() as directory:
+            key_path = os.path.join(directory, 'key.pem')
+            paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+            for run in ('cold', 'warm'):
+                # A new fleet for every run, so the connections the cold run
+                # left closing do not slow down the warm one:
+                with fleet.FakeFleet(host_count, processes, latency, jitter, failure_rate,
+                                     failure, host_key=host_key) as fake_fleet:
+                    result = run_sweep(fake_fleet, directory, key_path, concurrency, workers,
+                                       backend, deadline, retries)
+                latencies = result['latencies']
+                statuses = result['statuses']
+                click.echo('%8d %5s %9.2f %9.1f %9.1f %9.1f %9.1f %9d %9d %9d %9.1f' % (
+                    host_count, run, result['wall'], host_count / result['wall'],
+                    profiling.percentile(latencies, 50), profiling.percentile(latencies, 90),
+                    profiling.percentile(latencies, 99), statuses.get('ok', 0),
+                    statuses.get('timeout', 0), statuses.get('error', 0),
+                    result['peak_rss']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark of the bytes transferred by every backend, with and without the
+compact transport.
+
+Starts a simulated fleet (see ``fleet.py``) for every process count and
+queries each server twice on the same connection, as ``--watch`` and
+``serve`` do, measuring the second query:
+
+    * The payload: the bytes of the command outputs, as received by
+      ``vmdiag``.
+    * The wire bytes: what the servers sent on the sockets, SSH framing,
+      encryption and compression included.
+
+The key exchange and the authentication happen on the first query, so they
+are not counted.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Usage::
+
+    python benchmarks/bench_transfer.py --processes 200 --processes 2000
+"""
+
+import contextlib
+import io
+import logging
+import os
+import tempfile
+import click
+import paramiko
+import fleet
+from vmdiag import pool, profiling, vmdiag
+
+
+def measure(fake_fleet, key_path, backend, compress):
+    """
+    Queries every server of a fleet twice on the same connection and
+    measures the second query.
+
+    Parameters
+    ----------
+    fake_fleet: FakeFleet
+        The started fleet.
+    key_path: string
+        Private key used to log into the servers.
+    backend: string
+        How the servers are queried.
+    compress: bool
+        Whether to use the compact transport.
+
+    Returns
+    -------
+    tuple
+        The average payload and wire bytes per server.
+    """
+    connection_pool = pool.ConnectionPool(port=fake_fleet.port, compress=compress)
+    payload = 0
+    wire = 0
+    # Keeps the login messages of the servers out of the table:
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            for address, host in fake_fleet.hosts.items():
+                vmdiag.retrieve_info(address, 'bench', key_path, pool=connection_pool,
+                                     backend=backend)
+                sent = host.bytes_sent
+                profile = profiling.HostProfile()
+                vmdiag.retrieve_info(address, 'bench', key_path, pool=connection_pool,
+                                     profile=profile, backend=backend)
+                payload += profile.counters['bytes_received']
+                wire += host.bytes_sent - sent
+        finally:
+            connection_pool.close()
+    return payload / len(fake_fleet.hosts), wire / len(fake_fleet.hosts)
+
+
+@click.command()
+@click.option('--hosts', default=5, show_default=True, help='Number of simulated servers.')
+@click.option('--processes', multiple=True, type=int, default=[200, 2000], show_default=True,
+              help='Number of processes per server, once per fleet.')
+@click.option('--backend', multiple=True, default=['ps', 'proc', 'commands'], show_default=True,
+              type=click.Choice(['ps', 'proc', 'commands']), help='How the servers are queried.')
+def main(hosts, processes, backend):
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    host_key = paramiko.RSAKey.generate(2048)
+    click.echo('%9s %9s %13s %13s %13s %13s %7s' % (
+        'processes', 'backend', 'payload (B)', 'wire (B)', 'compact (B)', 'c. wire (B)',
+        'ratio'))
+    with tempfile.TemporaryDirectory() as directory:
+        key_path = os.path.join(directory, 'key.pem')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+        for process_count in processes:
+            with fleet.FakeFleet(hosts, process_count, host_key=host_key) as fake_fleet:
+                for name in backend:
+                    payload, wire = measure(fake_fleet, key_path, name, False)
+                    compact_payload, compact_wire = measure(fake_fleet, key_path, name, True)
+                    click.echo('%9d %9s %13.0f %13.0f %13.0f %13.0f %6.1fx' % (
+                        process_count, name, payload, wire, compact_payload, compact_wire,
+                        wire / compact_wire))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,608 @@
+"""
+In-process stand-in for a fleet of Linux servers, answering the commands
+run by ``vmdiag`` over SSH with made-up data.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Notes
+-----
+    Every simulated server has its own loopback address (``127.1.0.1``,
+    ``127.1.0.2``, ...) and they all share one listening socket, bound to
+    every interface on a free port. Connections to addresses outside the
+    fleet are closed right away.
+
+    The servers answer the batched commands of the ``ps`` and ``proc``
+    backends and the single commands of the ``commands`` backend, after a
+    configurable latency and jitter. Any public key is accepted. A share of
+    the servers can be made to fail in one of the ``FAILURES`` ways.
+
+    Every server also has an in-memory SFTP server, where the ``sampler``
+    backend uploads its sampler. Running an uploaded sampler waits for its
+    window and answers a made-up summary.
+
+    The servers accept SSH compression, and the process listings of the
+    compact transport are encoded with the local ``awk``, running the same
+    program the real servers run. Every server counts the bytes it sends,
+    as they go on the wire.
+"""
+
+import json
+import random
+import re
+import socket
+import stat
+import struct
+import subprocess
+import threading
+import time
+import paramiko
+from vmdiag import parser, stats
+
+FAILURES = ['refuse', 'stall', 'auth', 'drop']
+"""
+list: Ways a simulated server can fail: ``refuse`` resets the TCP
+connection, ``stall`` accepts it but never answers, ``auth`` rejects every
+key and ``drop`` closes the channel halfway through the output.
+"""
+
+FIRST_ADDRESS = '127.1.0.1'
+"""
+string: Address of the first simulated server.
+"""
+
+CLOSE_WAIT = 1.0
+"""
+float: Seconds a server waits for the client to close a finished channel.
+"""
+
+BASELINE_SLEEP = 1.0
+"""
+float: Seconds the ``cpu_baseline`` section sleeps, as on a real server.
+"""
+
+PROCESS_NAMES = ['systemd', 'sshd', 'bash', 'python3', 'java', 'nginx', 'postgres',
+                 'dockerd', 'containerd', 'rsyslogd', 'cron', 'agetty', 'snapd',
+                 'kthreadd', 'ksoftirqd/0', 'migration/0', 'rcu_sched', 'kswapd0',
+                 'jbd2/xvda1-8', 'node', 'gunicorn', 'celery', 'redis-server']
+"""
+list: Names given to the simulated processes.
+"""
+
+SAMPLER_PATTERN = re.compile(r'exec "\$PYTHON" (\S+) (\S+) (\S+) (\d+)( --aggregate)?')
+"""
+re.Pattern: Command running the sampler, capturing its path, window, rate,
+number of top processes and aggregate flag.
+"""
+
+SECTION_PATTERN = re.compile(r"echo '%s (\w+)'" % stats.SECTION_MARKER)
+"""
+Pattern: Regular expression matching the section delimiters of a batched command.
+"""
+
+CLOCK_TICKS = 100
+"""
+int: Clock ticks per second of the simulated servers.
+"""
+
+PAGE_SIZE = 4096
+"""
+int: Memory page size in bytes of the simulated servers.
+"""
+
+MEM_TOTAL = 4039272
+"""
+int: Total memory in kB of the simulated servers.
+"""
+
+
+def fake_ps_output(process_count, rng):
+    """
+    Builds the ``ps`` output of a server with random processes.
+
+    Parameters
+    ----------
+    process_count: int
+        Number of processes of the server.
+    rng: Random
+        Random number generator.
+
+    Returns
+    -------
+    list
+        Output lines of ``ps axo pid,pcpu,pmem,comm``.
+    """
+    lines = ['  PID %CPU %MEM COMMAND\n']
+    for pid in range(1, process_count + 1):
+        lines.append('%5d %4.1f %4.1f %s\n' % (pid, rng.random() * 20, rng.random() * 5,
+                                               rng.choice(PROCESS_NAMES)))
+    return lines
+
+
+def awk(program, lines):
+    """
+    Runs an ``awk`` program on the given lines.
+
+    Parameters
+    ----------
+    program: string
+        The ``awk`` program.
+    lines: list
+        Input lines.
+
+    Returns
+    -------
+    list
+        Output lines of the program.
+    """
+    process = subprocess.run(['awk', program], input=''.join(lines), stdout=subprocess.PIPE,
+                             universal_newlines=True, check=True)
+    return process.stdout.splitlines(True)
+
+
+class FakeHost:
+    """
+    A simulated server: its processes, counters and behaviour.
+
+    Parameters
+    ----------
+    address: string
+        IPv4 address of the server.
+    processes: int
+        Number of running processes.
+    latency: float
+        Time in seconds every command takes to answer.
+    jitter: float
+        Maximum random time in seconds added to the latency.
+    failure: string
+        One of ``FAILURES``, or None for a healthy server.
+    seed: int
+        Seed of the random data of the server.
+
+    Attributes
+    ----------
+    address: string
+        IPv4 address of the server.
+    latency: float
+        Time in seconds every command takes to answer.
+    jitter: float
+        Maximum random time in seconds added to the latency.
+    failure: string
+        How the server fails, None if it does not.
+    files: dictionary
+        Contents of the files uploaded over SFTP, keyed by path.
+    directories: set
+        Directories created over SFTP.
+    uploads: int
+        Number of files written over SFTP.
+    bytes_sent: int
+        Bytes sent to the clients, key exchange and SSH framing included.
+    """
+
+    def __init__(self, address, processes=200, latency=0.0, jitter=0.0, failure=None, seed=1):
+        rng = random.Random(seed)
+        self.address = address
+        self.latency = latency
+        self.jitter = jitter
+        self.failure = failure
+        self.files = {}
+        self.directories = set()
+        self.uploads = 0
+        self.bytes_sent = 0
+        self._rng = rng
+        self._boot = time.time() - rng.uniform(1000, 100000)
+        self._idle = rng.uniform(0.2, 0.95)
+        self._mem_available = rng.randint(MEM_TOTAL // 10, MEM_TOTAL)
+        self._ps_lines = fake_ps_output(processes, rng)
+        # The /proc/[pid]/stat lines of the same processes, started between
+        # 10 and 100 seconds ago:
+        uptime = time.time() - self._boot
+        self._stat_lines = []
+        for line in self._ps_lines[1:]:
+            pid, cpu, memory, name = line.split(None, 3)
+            elapsed = rng.uniform(10, 100)
+            fields = ['0'] * 49
+            fields[0] = 'S'
+            fields[11] = str(int(float(cpu) / 100 * elapsed * CLOCK_TICKS))
+            fields[19] = str(int((uptime - elapsed) * CLOCK_TICKS))
+            fields[21] = str(int(float(memory) / 100 * MEM_TOTAL * 1024 / PAGE_SIZE))
+            self._stat_lines.append('%s (%s) %s\n' % (pid, name.rstrip(), ' '.join(fields)))
+
+    def delay(self):
+        """
+        Waits the latency of the server, plus a random jitter.
+        """
+        wait = self.latency + self._rng.uniform(0, self.jitter)
+        if wait > 0:
+            time.sleep(wait)
+
+    def _cpu_lines(self, now):
+        """
+        Returns the ``/proc/stat`` CPU lines at the given UNIX time, with
+        counters growing in time.
+        """
+        ticks = int((now - self._boot) * CLOCK_TICKS)
+        idle = int(ticks * self._idle)
+        user = ticks - idle
+        core = '%s %d 0 0 %d 0 0 0 0 0 0\n'
+        return ['cpu  %d 0 0 %d 0 0 0 0 0 0\n' % (2 * user, 2 * idle),
+                core % ('cpu0', user, idle), core % ('cpu1', user, idle)]
+
+    def _section(self, name, now):
+        """
+        Returns the output lines of a section of a batched command.
+        """
+        if name == 'processes':
+            return self._ps_lines
+        if name == 'compact_processes':
+            return awk(stats.COMPACT_PROCESSES_AWK, self._ps_lines)
+        if name in ('cpu', 'cpu_baseline'):
+            return self._cpu_lines(now)
+        if name == 'memory':
+            return ['MemTotal:       %d kB\n' % MEM_TOTAL,
+                    'MemAvailable:   %d kB\n' % self._mem_available]
+        if name == 'pids':
+            return self._stat_lines
+        if name == 'uptime':
+            uptime = now - self._boot
+            return ['%.2f %.2f\n' % (uptime, uptime * self._idle)]
+        if name == 'sysconf':
+            return ['%d\n' % CLOCK_TICKS, '%d\n' % PAGE_SIZE]
+        return []
+
+    def run(self, command):
+        """
+        Returns the output of a command run by ``vmdiag``.
+
+        Parameters
+        ----------
+        command: string
+            The command, batched or not.
+
+        Returns
+        -------
+        string
+            The output of the command.
+        """
+        section_names = SECTION_PATTERN.findall(command)
+        if section_names:
+            now = time.time()
+            lines = []
+            for name in section_names:
+                lines.append('%s %s\n' % (stats.SECTION_MARKER, name))
+                lines += self._section(name, now)
+                if name == 'cpu_baseline':
+                    time.sleep(BASELINE_SLEEP)
+                    now = time.time()
+            return ''.join(lines)
+        if command.startswith('ps axco command'):
+            processes = sorted(self._ps_lines[1:], key=lambda line: -float(line.split()[1]))
+            lines = ['COMMAND\n'] + [line.split(None, 3)[3] for line in processes]
+            if stats.COMPACT_NAMES_AWK in command:
+                return ''.join(awk(stats.COMPACT_NAMES_AWK, lines))
+            return ''.join(lines)
+        if command.startswith('ps axo'):
+            column = 1 if '-pcpu' in command else 2
+            processes = sorted(self._ps_lines[1:], key=lambda line: -float(line.split()[column]))
+            lines = self._ps_lines[:1] + processes
+            match = re.search(r'head -n (\d+)', command)
+            if match:
+                lines = lines[:int(match.group(1))]
+            return ''.join(lines)
+        match = SAMPLER_PATTERN.search(command)
+        if match:
+            return self._sampler(match.group(1), float(match.group(2)), int(match.group(4)),
+                                 bool(match.group(5)))
+        return ''
+
+
+    def _sampler(self, path, window, top, aggregate):
+        """
+        Returns the summary printed by the sampler at ``path``, after its
+        window, or nothing if it was never uploaded.
+        """
+        if path not in self.files:
+            return ''
+        time.sleep(window)
+        rows = []
+        for line in self._ps_lines[1:]:
+            pid, cpu, memory, name = line.split(None, 3)
+            cpu = float(cpu)
+            rows.append([int(pid), name.rstrip(), cpu, round(cpu * 1.5, 1), float(memory)])
+        if aggregate:
+            totals = {}
+            for _, name, cpu, cpu_max, memory in rows:
+                total = totals.setdefault(name, [0, name, 0.0, 0.0, 0.0])
+                total[0] += 1
+                total[2:] = [total[2] + cpu, total[3] + cpu_max, total[4] + memory]
+            rows = list(totals.values())
+        remaining = round(self._idle * 100, 1)
+        summary = {
+            'samples': max(1, int(window * 10)),
+            'seconds': window,
+            'cpu': [round(remaining * 0.8, 1), remaining, min(100.0, round(remaining * 1.1, 1))],
+            'cpu_steal': 0.0,
+            'memory_kb': [self._mem_available - 1024, self._mem_available, self._mem_available],
+            'top_cpu': sorted(rows, key=lambda row: row[2], reverse=True)[:top],
+            'top_memory': sorted(rows, key=lambda row: row[4], reverse=True)[:top],
+            'processes': [row[1] for row in rows],
+        }
+        return json.dumps(summary, separators=(',', ':')) + '\n'
+
+
+class FakeSFTPHandle(paramiko.SFTPHandle):
+    """
+    File being written over SFTP, saved on the server when closed.
+    """
+
+    def __init__(self, host, path):
+        super().__init__()
+        self.host = host
+        self.path = path
+        self.data = bytearray()
+
+    def write(self, offset, data):
+        self.data[offset:offset + len(data)] = data
+        return paramiko.SFTP_OK
+
+    def close(self):
+        self.host.files[self.path] = bytes(self.data)
+        self.host.uploads += 1
+
+
+class FakeSFTPServer(paramiko.SFTPServerInterface):
+    """
+    In-memory SFTP server of a simulated server, supporting what uploading
+    a file needs: ``stat``, ``mkdir``, writing and renaming.
+    """
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.host = server.host
+
+    def stat(self, path):
+        attributes = paramiko.SFTPAttributes()
+        if path in self.host.files:
+            attributes.st_mode = stat.S_IFREG | 0o644
+            attributes.st_size = len(self.host.files[path])
+        elif path in self.host.directories:
+            attributes.st_mode = stat.S_IFDIR | 0o755
+        else:
+            return paramiko.SFTP_NO_SUCH_FILE
+        return attributes
+
+    lstat = stat
+
+    def mkdir(self, path, attr):
+        if path in self.host.directories:
+            return paramiko.SFTP_FAILURE
+        self.host.directories.add(path)
+        return paramiko.SFTP_OK
+
+    def open(self, path, flags, attr):
+        return FakeSFTPHandle(self.host, path)
+
+    def posix_rename(self, oldpath, newpath):
+        if oldpath not in self.host.files:
+            return paramiko.SFTP_NO_SUCH_FILE
+        self.host.files[newpath] = self.host.files.pop(oldpath)
+        return paramiko.SFTP_OK
+
+    rename = posix_rename
+
+
+class CountingSocket:
+    """
+    Socket that adds the bytes it sends to the ``bytes_sent`` of a
+    simulated server.
+    """
+
+    def __init__(self, sock, host):
+        self._sock = sock
+        self._host = host
+
+    def send(self, data):
+        sent = self._sock.send(data)
+        self._host.bytes_sent += sent
+        return sent
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+class FakeSSHServer(paramiko.ServerInterface):
+    """
+    SSH server side of a simulated server: accepts any public key, unless
+    failing with ``auth``, and answers its commands.
+
+    Parameters
+    ----------
+    host: FakeHost
+        The simulated server.
+    """
+
+    def __init__(self, host):
+        self.host = host
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        if self.host.failure == 'auth':
+            return paramiko.AUTH_FAILED
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self._answer, args=(channel, command.decode('utf-8')))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _answer(self, channel, command):
+        """
+        Sends the output of a command once the latency of the server elapsed.
+        """
+        try:
+            self.host.delay()
+            output = self.host.run(command).encode('utf-8')
+            if self.host.failure == 'drop':
+                channel.sendall(output[:len(output) // 2])
+                channel.get_transport().close()
+                return
+            channel.sendall(output)
+            channel.send_exit_status(0)
+            # Closing right away may overtake the reply to the exec request,
+            # failing it on the client: send the end of file instead and wait
+            # for the client to close the channel, as sshd does.
+            channel.shutdown_write()
+            channel.settimeout(CLOSE_WAIT)
+            channel.recv(1)
+        except (EOFError, socket.error, paramiko.SSHException):
+            pass
+        finally:
+            channel.close()
+
+
+class FakeFleet:
+    """
+    A fleet of simulated servers listening on localhost.
+
+    Parameters
+    ----------
+    hosts: int
+        Number of simulated servers.
+    processes: int
+        Number of running processes of every server.
+    latency: float
+        Time in seconds every command takes to answer.
+    jitter: float
+        Maximum random time in seconds added to the latency.
+    failure_rate: float
+        Share of servers, between 0 and 1, that fail.
+    failure: string
+        How the failing servers fail, one of ``FAILURES``.
+    seed: int
+        Seed of the random data of the fleet.
+    host_key: PKey
+        Host key of the servers. A new RSA key is generated if not given.
+
+    Attributes
+    ----------
+    hosts: dictionary
+        The ``FakeHost`` instances keyed by address.
+    port: int
+        TCP port every server listens on, once started.
+    host_key: PKey
+        Host key of the servers.
+    """
+
+    def __init__(self, hosts, processes=200, latency=0.0, jitter=0.0, failure_rate=0.0,
+                 failure='stall', seed=1, host_key=None):
+        if failure not in FAILURES:
+            raise Exception('Invalid failure. Should be one of: %s' % ', '.join(FAILURES))
+        rng = random.Random(seed)
+        failing = set(rng.sample(range(hosts), int(round(hosts * failure_rate))))
+        first = parser.address_to_int(FIRST_ADDRESS)
+        self.hosts = {}
+        for index in range(hosts):
+            address = parser.int_to_address(first + index)
+            self.hosts[address] = FakeHost(address, processes, latency, jitter,
+                                           failure if index in failing else None,
+                                           rng.randrange(2 ** 32))
+        self.host_key = host_key if host_key is not None else paramiko.RSAKey.generate(1024)
+        self.port = None
+        self._listener = None
+        self._connections = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def target(self):
+        """
+        Returns the range of addresses of the fleet, as given to ``vmdiag``.
+
+        Returns
+        -------
+        string
+            The ``first-last`` address range.
+        """
+        addresses = list(self.hosts)
+        return '%s-%s' % (addresses[0], addresses[-1])
+
+    def start(self):
+        """
+        Starts listening for connections.
+        """
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(('0.0.0.0', 0))
+        self._listener.listen(1024)
+        self._listener.settimeout(0.1)
+        self.port = self._listener.getsockname()[1]
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        """
+        Accepts the connections and hands every one to its simulated server.
+        """
+        while not self._stopped.is_set():
+            try:
+                connection, _ = self._listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            connection.settimeout(None)
+            host = self.hosts.get(connection.getsockname()[0])
+            if host is None or host.failure == 'refuse':
+                # Closing with a zero linger time resets the connection:
+                connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                connection.close()
+                continue
+            with self._lock:
+                self._connections.append(connection)
+            if host.failure != 'stall':
+                thread = threading.Thread(target=self._serve, args=(connection, host))
+                thread.daemon = True
+                thread.start()
+
+    def _serve(self, connection, host):
+        """
+        Runs the SSH server side of a connection.
+        """
+        transport = paramiko.Transport(CountingSocket(connection, host))
+        transport.add_server_key(self.host_key)
+        transport.use_compression(True)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, FakeSFTPServer)
+        try:
+            transport.start_server(server=FakeSSHServer(host))
+        except (EOFError, socket.error, paramiko.SSHException):
+            transport.close()
+            return
+        with self._lock:
+            self._connections.append(transport)
+
+    def stop(self):
+        """
+        Stops listening and closes every open connection.
+        """
+        self._stopped.set()
+        if self._listener is not None:
+            self._listener.close()
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -22,6 +22,7 @@ setup(
     author_email='andres.arias12@gmail.com',
     url='https://github.com/andres-arias/VMDiag',
     install_requires=REQUIREMENTS,
+    extras_require={'rules': ['numpy']},
     keywords=['vm', 'cloud', 'aws', 'cpu', 'memory', 'processes'],
     packages=find_packages(),
     classifiers=[
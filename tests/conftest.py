@@ -0,0 +1,61 @@
+"""
+Fixtures shared by the tests.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import pytest
+from vmdiag import stats
+
+
+def fake_host_stats(processes, cpu, memory_kb, top=3, aggregate=False, cores=None):
+    """
+    Builds the usage data of a fake server.
+
+    Parameters
+    ----------
+    processes: list
+        ``(pid, name, cpu, memory)`` tuples, or the names of the processes
+        alone, the first one the busiest: the process at position ``N``,
+        counting from 1, gets PID ``N``, ``50 / N`` CPU and ``10 / N``
+        memory.
+    cpu: float
+        Remaining CPU percentage.
+    memory_kb: int
+        Available memory in kB.
+    top: int
+        Number of top processes reported for every metric.
+    aggregate: bool
+        Whether to rank the process names.
+    cores: int
+        Number of CPU cores to report on ``cpu_cores``, every one with the
+        remaining CPU percentage. Not reported if not given.
+
+    Returns
+    -------
+    HostStats
+        The usage data.
+    """
+    table = stats.ProcessTable()
+    for pid, process in enumerate(processes, 1):
+        if isinstance(process, str):
+            process = (pid, process, 50.0 / pid, 10.0 / pid)
+        table.append(*process)
+    capacity = {'cpu': cpu, 'memory_kb': memory_kb}
+    if cores is not None:
+        capacity['cpu_cores'] = [cpu] * cores
+    return stats.HostStats(table, capacity, top=top, aggregate=aggregate)
+
+
+@pytest.fixture
+def host_stats():
+    """
+    Provides the builder of the usage data of a fake server.
+
+    Returns
+    -------
+    function
+        ``fake_host_stats()``.
+    """
+    return fake_host_stats
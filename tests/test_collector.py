@@ -0,0 +1,177 @@
+"""
+Tests for the concurrent collection engine.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import os
+import threading
+import time
+import pytest
+from vmdiag import collector
+
+
+def fake_retrieve(delays):
+    """
+    Builds a retrieve function that sleeps the given delay for every host
+    and keeps track of how many hosts are being queried at the same time.
+
+    Parameters
+    ----------
+    delays: dictionary
+        Delay in seconds to wait for every IP address.
+
+    Returns
+    -------
+    tuple
+        The retrieve function and a dictionary with the ``max_active`` count.
+    """
+    lock = threading.Lock()
+    counters = {'active': 0, 'max_active': 0}
+
+    def retrieve(ip_address, username, key):
+        with lock:
+            counters['active'] += 1
+            counters['max_active'] = max(counters['max_active'], counters['active'])
+        time.sleep(delays[ip_address])
+        with lock:
+            counters['active'] -= 1
+        return {ip_address: {'user': username, 'key': key}}
+
+    return retrieve, counters
+
+
+def test_collect_all_hosts():
+    """
+    Tests that every target is queried exactly once and its result is
+    yielded along its IP address.
+    """
+    addresses = ['10.0.0.%d' % i for i in range(20)]
+    retrieve, _ = fake_retrieve(dict.fromkeys(addresses, 0.01))
+    targets = [(addr, 'ubuntu', 'key.pem') for addr in addresses]
+    results = dict(collector.collect(targets, retrieve, 5))
+    assert sorted(results) == sorted(addresses)
+    for addr in addresses:
+        assert results[addr] == {addr: {'user': 'ubuntu', 'key': 'key.pem'}}
+
+
+@pytest.mark.parametrize('concurrency', [1, 3, 8])
+def test_concurrency_cap(concurrency):
+    """
+    Tests that no more than ``concurrency`` hosts are queried at once.
+    """
+    addresses = ['10.0.0.%d' % i for i in range(16)]
+    retrieve, counters = fake_retrieve(dict.fromkeys(addresses, 0.02))
+    targets = ((addr, 'ubuntu', 'key.pem') for addr in addresses)
+    list(collector.collect(targets, retrieve, concurrency))
+    assert counters['max_active'] == concurrency
+
+
+def test_slow_host_does_not_stall():
+    """
+    Tests that the sweep time is bound by the slowest host and that fast
+    hosts are yielded before the slow one finishes.
+    """
+    delays = dict.fromkeys(['10.0.0.%d' % i for i in range(1, 10)], 0.05)
+    delays['10.0.0.0'] = 0.5
+    retrieve, _ = fake_retrieve(delays)
+    targets = [(addr, 'ubuntu', 'key.pem') for addr in sorted(delays)]
+    start = time.monotonic()
+    order = [addr for addr, _ in collector.collect(targets, retrieve, 10)]
+    elapsed = time.monotonic() - start
+    assert order[-1] == '10.0.0.0'
+    assert elapsed < 0.5 + 0.05 * 3
+
+
+def test_invalid_concurrency():
+    """
+    Tests that a concurrency lower than 1 is rejected.
+    """
+    with pytest.raises(Exception):
+        list(collector.collect([], lambda *args: None, 0))
+
+
+def sharded_retrieve(ip_address, username, key):
+    """
+    Retrieve function for the sharded tests: waits a bit and returns the
+    process id of the worker, failing for the ``10.0.0.255`` address.
+    """
+    if ip_address == '10.0.0.255':
+        raise Exception('Unreachable: %s' % ip_address)
+    time.sleep(0.02)
+    return {ip_address: {'user': username, 'pid': os.getpid()}}
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_collect_sharded(workers):
+    """
+    Tests that every target is queried exactly once, and that the targets
+    are spread across the worker processes.
+
+    Parameters
+    ----------
+    workers: int
+        Number of worker processes.
+    """
+    addresses = ['10.0.0.%d' % i for i in range(30)]
+    targets = ((addr, 'ubuntu', 'key.pem') for addr in addresses)
+    results = dict(collector.collect_sharded(targets, sharded_retrieve, 6, workers))
+    assert sorted(results) == sorted(addresses)
+    pids = set(result[addr]['pid'] for addr, result in results.items())
+    assert os.getpid() not in pids
+    assert len(pids) == workers
+
+
+def test_collect_sharded_error():
+    """
+    Tests that an exception raised on a worker is raised again on the main
+    process, and that a worker count lower than 1 is rejected.
+    """
+    targets = [('10.0.0.%d' % i, 'ubuntu', 'key.pem') for i in [1, 255, 2]]
+    with pytest.raises(Exception, match='Unreachable: 10.0.0.255'):
+        list(collector.collect_sharded(targets, sharded_retrieve, 2, 2))
+    with pytest.raises(Exception):
+        list(collector.collect_sharded(targets, sharded_retrieve, 2, 0))
+
+
+def test_watch_samples():
+    """
+    Tests that every host is yielded once per sample and that every
+    result of a sample shares the same timestamp.
+    """
+    addresses = ['10.0.0.%d' % i for i in range(4)]
+    retrieve, _ = fake_retrieve(dict.fromkeys(addresses, 0.01))
+    targets = [(addr, 'ubuntu', 'key.pem') for addr in addresses]
+    results = list(collector.watch(targets, retrieve, 0.05, 4, samples=3))
+    assert len(results) == 12
+    timestamps = sorted(set(timestamp for timestamp, _, _ in results))
+    assert len(timestamps) == 3
+    for timestamp in timestamps:
+        sample = [addr for stamp, addr, _ in results if stamp == timestamp]
+        assert sorted(sample) == addresses
+
+
+def test_watch_drift_correction():
+    """
+    Tests that the time spent on every sweep does not delay the next
+    samples: ``n`` samples take about ``n - 1`` intervals.
+    """
+    retrieve, _ = fake_retrieve({'10.0.0.1': 0.04})
+    start = time.monotonic()
+    list(collector.watch([('10.0.0.1', 'ubuntu', 'key.pem')], retrieve, 0.1, samples=5))
+    elapsed = time.monotonic() - start
+    assert 0.44 <= elapsed < 0.44 + 0.08
+
+
+def test_watch_skips_missed_samples():
+    """
+    Tests that a sweep longer than the interval skips the missed sample
+    times instead of running the next sweep right away.
+    """
+    retrieve, _ = fake_retrieve({'10.0.0.1': 0.15})
+    start = time.monotonic()
+    results = list(collector.watch([('10.0.0.1', 'ubuntu', 'key.pem')], retrieve, 0.1, samples=2))
+    second_sweep = results[1][0] - results[0][0]
+    assert second_sweep == pytest.approx(0.2, abs=0.03)
+    assert time.monotonic() - start == pytest.approx(0.35, abs=0.05)
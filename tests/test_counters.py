@@ -0,0 +1,42 @@
+"""
+Tests for the on-disk copy of the CPU counters of the servers.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import os
+import pickle
+from vmdiag import counters
+
+CPU_TIMES = {'cpu': [3000, 10, 1000, 16000, 50, 0, 20, 5],
+             'cpu0': [1500, 5, 500, 8000, 25, 0, 10, 5]}
+"""
+dictionary: Counters of a fake server, as parsed by ``stats.parse_cpu_times()``.
+"""
+
+
+def test_save_load(tmp_path):
+    """
+    Tests that the counters are read back by any copy of the store, as long
+    as they are younger than the maximum age.
+    """
+    cpu_counters = counters.CpuCounters(str(tmp_path / 'cpu_times'))
+    assert cpu_counters.load('10.0.0.1') is None
+    cpu_counters.save('10.0.0.1', CPU_TIMES)
+    assert pickle.loads(pickle.dumps(cpu_counters)).load('10.0.0.1') == CPU_TIMES
+    assert cpu_counters.load('10.0.0.2') is None
+    assert os.listdir(str(tmp_path / 'cpu_times')) == ['10.0.0.1']
+    assert counters.CpuCounters(str(tmp_path / 'cpu_times'), max_age=-1).load('10.0.0.1') is None
+
+
+def test_invalid_file(tmp_path):
+    """
+    Tests that an unreadable file is ignored, and that the counters are not
+    saved where the directory cannot be created.
+    """
+    (tmp_path / '10.0.0.1').write_text('not json')
+    assert counters.CpuCounters(str(tmp_path)).load('10.0.0.1') is None
+    cpu_counters = counters.CpuCounters(str(tmp_path / '10.0.0.1' / 'cpu_times'))
+    cpu_counters.save('10.0.0.1', CPU_TIMES)
+    assert cpu_counters.load('10.0.0.1') is None
@@ -0,0 +1,97 @@
+"""
+Tests for the private key and host key caches.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import pickle
+import paramiko
+import pytest
+from vmdiag import credentials
+
+
+@pytest.fixture(scope='module')
+def key_files(tmp_path_factory):
+    """
+    Writes an RSA and an ECDSA private key.
+
+    Returns
+    -------
+    dictionary
+        The paths of the key files keyed by the expected key class.
+    """
+    directory = tmp_path_factory.mktemp('keys')
+    paths = {}
+    for key_class, key in [(paramiko.RSAKey, paramiko.RSAKey.generate(1024)),
+                           (paramiko.ECDSAKey, paramiko.ECDSAKey.generate())]:
+        path = str(directory / key_class.__name__)
+        key.write_private_key_file(path)
+        paths[key_class] = path
+    return paths
+
+
+def test_key_types(key_files):
+    """
+    Tests that the key type is detected from the file.
+    """
+    for key_class, path in key_files.items():
+        assert isinstance(credentials.load_key(path), key_class)
+
+
+def test_invalid_key(tmp_path):
+    """
+    Tests that a file that is not a private key raises an exception.
+    """
+    path = tmp_path / 'key.pem'
+    path.write_text('not a key\n')
+    with pytest.raises(Exception) as error:
+        credentials.load_key(str(path))
+    assert str(error.value).startswith('Invalid private key')
+
+
+def test_key_cache(key_files):
+    """
+    Tests that every key file is parsed only once and that the agent needs
+    no key.
+    """
+    key_cache = credentials.KeyCache()
+    rsa_key = key_cache.get(key_files[paramiko.RSAKey])
+    for _ in range(10):
+        assert key_cache.get(key_files[paramiko.RSAKey]) is rsa_key
+    key_cache.get(key_files[paramiko.ECDSAKey])
+    assert key_cache.get(credentials.AGENT) is None
+    assert key_cache.loads == 2
+
+
+def test_known_hosts(tmp_path):
+    """
+    Tests that a host key seen for the first time is saved and loaded by
+    the next sweep, and that clients get the known keys of their server.
+    """
+    path = str(tmp_path / 'vmdiag' / 'known_hosts')
+    host_key = paramiko.ECDSAKey.generate()
+    known_hosts = credentials.KnownHosts(path)
+    client = paramiko.SSHClient()
+    known_hosts.attach(client, '10.0.0.1')
+    assert client.get_host_keys().lookup('10.0.0.1') is None
+    credentials.TrustOnFirstUsePolicy(known_hosts).missing_host_key(client, '10.0.0.1', host_key)
+
+    known_hosts = credentials.KnownHosts(path)
+    assert known_hosts.lookup('10.0.0.1') == {host_key.get_name(): host_key}
+    assert known_hosts.lookup('10.0.0.2') == {}
+    client = paramiko.SSHClient()
+    known_hosts.attach(client, '10.0.0.1')
+    assert client.get_host_keys().lookup('10.0.0.1')[host_key.get_name()] == host_key
+
+
+def test_known_hosts_pickle(tmp_path):
+    """
+    Tests that a pickled known hosts copy reads the keys from the file.
+    """
+    path = str(tmp_path / 'known_hosts')
+    host_key = paramiko.ECDSAKey.generate()
+    credentials.KnownHosts(path).add('10.0.0.1', host_key)
+    known_hosts = pickle.loads(pickle.dumps(credentials.KnownHosts(path)))
+    assert known_hosts.path == path
+    assert known_hosts.lookup('10.0.0.1') == {host_key.get_name(): host_key}
@@ -0,0 +1,138 @@
+"""
+Tests for the cache and the HTTP endpoints of the collector daemon.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import json
+import socket
+import threading
+import urllib.error
+import urllib.request
+import pytest
+from vmdiag import daemon, stats
+
+
+def fake_retrieve(ip_address, username, key):
+    """
+    Returns the usage data of a fake server, counting the calls.
+    """
+    fake_retrieve.calls += 1
+    processes = stats.ProcessTable()
+    processes.append(1, 'init', 0.5, 0.1)
+    return stats.HostStats(processes, {'cpu': 90.0, 'memory_kb': 1024})
+
+
+fake_retrieve.calls = 0
+
+
+@pytest.fixture
+def cache():
+    """
+    Returns a cache with one sample of two servers, refreshed from
+    ``fake_retrieve()``.
+    """
+    snapshot_cache = daemon.SnapshotCache(60)
+    targets = [('10.0.0.1', 'ubuntu', 'key.pem'), ('10.0.0.2', 'ubuntu', 'key.pem')]
+    daemon.refresh(snapshot_cache, targets, fake_retrieve, 0.1, samples=1)
+    return snapshot_cache
+
+
+def serve(http_server):
+    """
+    Runs a server on a background thread.
+    """
+    thread = threading.Thread(target=http_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def test_ttl():
+    """
+    Tests that a result is only served while younger than the TTL.
+    """
+    snapshot_cache = daemon.SnapshotCache(10)
+    snapshot_cache.put('10.0.0.1', 1000.0, {'status': 'timeout'})
+    snapshot_cache.put('10.0.0.2', 1005.0, {'status': 'error'})
+    assert json.loads(snapshot_cache.get('10.0.0.1', now=1010.0)) == {
+        'timestamp': 1000.0, 'status': 'timeout'}
+    assert snapshot_cache.get('10.0.0.1', now=1010.5) is None
+    assert snapshot_cache.get('10.0.0.3', now=1000.0) is None
+    assert list(json.loads(snapshot_cache.snapshot(now=1012.0))) == ['10.0.0.2']
+    assert json.loads(snapshot_cache.snapshot(now=2000.0)) == {}
+
+
+def test_http(cache):
+    """
+    Tests that the HTTP endpoint serves every server and single servers
+    from the cache, without querying them again.
+    """
+    calls = fake_retrieve.calls
+    http_server = daemon.SnapshotServer(('127.0.0.1', 0), cache)
+    serve(http_server)
+    url = 'http://127.0.0.1:%d' % http_server.server_address[1]
+    try:
+        for _ in range(3):
+            hosts = json.loads(urllib.request.urlopen(url + '/hosts').read())
+        assert sorted(hosts) == ['10.0.0.1', '10.0.0.2']
+        assert hosts['10.0.0.1']['remaining_capacity']['cpu'] == 90.0
+        host = json.loads(urllib.request.urlopen(url + '/hosts/10.0.0.2').read())
+        assert host == hosts['10.0.0.2']
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + '/hosts/10.0.0.3')
+        assert error.value.code == 404
+        assert fake_retrieve.calls == calls
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
+
+
+def test_unix_socket(cache, tmp_path):
+    """
+    Tests that the cache is served on a Unix socket, and that the socket
+    file is removed on close.
+    """
+    path = str(tmp_path / 'vmdiag.sock')
+    http_server = daemon.UnixSnapshotServer(path, cache)
+    serve(http_server)
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        client.sendall(b'GET /hosts/10.0.0.1 HTTP/1.0\r\n\r\n')
+        response = b''
+        while True:
+            data = client.recv(4096)
+            if not data:
+                break
+            response += data
+        client.close()
+        head, body = response.split(b'\r\n\r\n', 1)
+        assert head.startswith(b'HTTP/1.0 200')
+        assert json.loads(body)['remaining_capacity']['memory_kb'] == 1024
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
+    assert not (tmp_path / 'vmdiag.sock').exists()
+
+
+def test_unix_socket_path(cache, tmp_path):
+    """
+    Tests that a stale socket file is replaced, and that a regular file or a
+    socket in use is left alone.
+    """
+    path = tmp_path / 'vmdiag.sock'
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(path))
+    stale.close()
+    http_server = daemon.UnixSnapshotServer(str(path), cache)
+    try:
+        with pytest.raises(Exception):
+            daemon.UnixSnapshotServer(str(path), cache)
+        assert path.exists()
+    finally:
+        http_server.server_close()
+    path.write_text('data')
+    with pytest.raises(Exception):
+        daemon.UnixSnapshotServer(str(path), cache)
+    assert path.read_text() == 'data'
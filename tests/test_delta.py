@@ -0,0 +1,110 @@
+"""
+Tests for the delta records of the watch mode.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import json
+import pytest
+from vmdiag import delta
+
+
+@pytest.fixture
+def record(host_stats):
+    """
+    Provides the builder of the watch mode record of a fake server.
+
+    Returns
+    -------
+    function
+        Builds the record from the time of the sample, the names of the
+        running processes, the remaining CPU percentage, the available memory
+        in kB and, optionally, the top CPU processes, which default to the
+        first process.
+    """
+    def build(timestamp, processes, cpu, memory_kb, top=None):
+        sample = host_stats(processes, cpu, memory_kb, top=1, cores=2).as_dict()
+        if top is not None:
+            sample['top_1_cpu_consumption'] = top
+        return dict({'timestamp': timestamp, 'ip': '10.0.0.1'}, **sample)
+    return build
+
+
+def test_diff_list():
+    """
+    Tests that the process names are compared as a multiset, and that
+    patching keeps the order of the names that stay.
+    """
+    change = delta.diff_list(['sshd', 'bash', 'bash', 'java'], ['java', 'bash', 'sshd', 'cron'])
+    assert change == {'added': ['cron'], 'removed': ['bash']}
+    assert delta.patch_list(['sshd', 'bash', 'bash', 'java'], change) == [
+        'sshd', 'bash', 'java', 'cron']
+    assert delta.diff_list(['sshd', 'bash'], ['bash', 'sshd']) == {}
+
+
+def test_diff_dict():
+    """
+    Tests that only the changed entries are set, and that the order of the
+    keys is only sent when it changed.
+    """
+    previous = {'1': 'a', '2': 'b', '3': 'c'}
+    assert delta.diff_dict(previous, {'1': 'a', '2': 'x', '4': 'd'}) == {
+        'set': {'2': 'x', '4': 'd'}, 'unset': ['3']}
+    change = delta.diff_dict(previous, {'2': 'b', '1': 'a', '3': 'c'})
+    assert change == {'order': ['2', '1', '3']}
+    assert list(delta.patch_dict(previous, change)) == ['2', '1', '3']
+
+
+def test_threshold(record):
+    """
+    Tests that the remaining capacity is only written when it moves more
+    than the threshold away from the last value written, so it does not
+    drift.
+    """
+    encoder = delta.DeltaEncoder(threshold=2.0)
+    encoder.encode(record(0, ['sshd'], 50.0, 1000))
+    assert encoder.encode(record(1, ['sshd'], 51.5, 1015))['delta'] == {}
+    assert encoder.encode(record(2, ['sshd'], 52.5, 1019))['delta'] == {
+        'remaining_capacity': {'set': {'cpu': 52.5, 'cpu_cores': [52.5, 52.5]}}}
+    assert encoder.encode(record(3, ['sshd'], 52.5, 1021))['delta'] == {
+        'remaining_capacity': {'set': {'memory_kb': 1021}}}
+
+
+def test_keyframes(record):
+    """
+    Tests that a server gets a keyframe on its first sample, every
+    ``keyframe`` samples and when the delta would be larger.
+    """
+    encoder = delta.DeltaEncoder(keyframe=3)
+    kinds = []
+    for timestamp in range(7):
+        kinds.append('keyframe' in encoder.encode(record(timestamp, ['sshd', 'java'], 50.0, 1000)))
+    assert kinds == [True, False, False, True, False, False, True]
+    error = {'timestamp': 7, 'ip': '10.0.0.1', 'status': 'error', 'error': 'Timed out'}
+    assert encoder.encode(error)['keyframe'] is True
+    with pytest.raises(Exception):
+        delta.DeltaEncoder(keyframe=0)
+
+
+def test_decode(record):
+    """
+    Tests that the decoder rebuilds every record from the keyframes and the
+    deltas, and skips the deltas of a server before its first keyframe.
+    """
+    kernel = ['kworker/%d' % core for core in range(20)]
+    records = [
+        record(0, kernel + ['sshd', 'java'], 50.0, 1000),
+        record(1, kernel + ['sshd', 'java', 'cron'], 50.0, 1000),
+        record(2, kernel + ['java', 'cron'], 80.0, 1000,
+               {'7': {'name': 'cron', 'cpu': 20.0, 'memory': 0.1}}),
+        {'timestamp': 3, 'ip': '10.0.0.1', 'status': 'timeout'},
+        record(4, kernel + ['java', 'cron'], 80.0, 1000),
+        record(5, kernel + ['java', 'cron'], 80.0, 1000),
+    ]
+    encoder = delta.DeltaEncoder(keyframe=100, threshold=0)
+    encoded = [json.loads(json.dumps(encoder.encode(dict(item)))) for item in records]
+    assert [('keyframe' in item) for item in encoded] == [True, False, False, True, True, False]
+    decoder = delta.DeltaDecoder()
+    assert [decoder.decode(item) for item in encoded] == records
+    assert delta.DeltaDecoder().decode(encoded[1]) is None
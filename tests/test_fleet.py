@@ -0,0 +1,301 @@
+"""
+End-to-end tests of a sweep against the simulated fleet of the benchmarks.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import json
+import logging
+import os
+import sys
+import paramiko
+import pytest
+from click.testing import CliRunner
+from vmdiag import server, stats, vmdiag
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+import fleet  # noqa: E402
+
+logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+
+
+@pytest.fixture(scope='module')
+def key_path(tmp_path_factory):
+    """
+    Writes a new RSA private key and returns its path.
+    """
+    path = str(tmp_path_factory.mktemp('keys') / 'id_rsa')
+    paramiko.RSAKey.generate(1024).write_private_key_file(path)
+    return path
+
+
+def sweep(fake_fleet, key_path, tmp_path, *arguments):
+    """
+    Sweeps a fleet with ``vmdiag sweep`` and returns the results.
+
+    Parameters
+    ----------
+    fake_fleet: FakeFleet
+        The started fleet.
+    key_path: string
+        Path of the private key.
+    tmp_path: Path
+        Directory for the known hosts and output files.
+    arguments:
+        Extra command line arguments.
+
+    Returns
+    -------
+    dictionary
+        The result of every server keyed by IP address. The fleet summary is
+        left out.
+    """
+    result = CliRunner(mix_stderr=False).invoke(vmdiag.main, [
+        'sweep', fake_fleet.target(), '--user', 'root', '--key', key_path,
+        '--port', str(fake_fleet.port), '--format', 'ndjson',
+        '--known-hosts', str(tmp_path / 'known_hosts'),
+        '--output', str(tmp_path / 'server_data.json')] + list(arguments))
+    assert result.exit_code == 0, result.stderr
+    records = [json.loads(line) for line in result.stdout.splitlines()]
+    return dict((record.pop('ip'), record) for record in records if 'ip' in record)
+
+
+@pytest.mark.parametrize('backend', ['ps', 'proc', 'commands'])
+def test_sweep(key_path, tmp_path, backend):
+    """
+    Tests that every server of the fleet is reported, on every backend.
+
+    Parameters
+    ----------
+    backend: string
+        Collection backend.
+    """
+    with fleet.FakeFleet(5, processes=20) as fake_fleet:
+        results = sweep(fake_fleet, key_path, tmp_path, '--backend', backend)
+    assert sorted(results) == sorted(fake_fleet.hosts)
+    for record in results.values():
+        assert 'status' not in record
+        assert 0 <= record['remaining_capacity']['cpu'] <= 100
+
+
+def test_sweep_process_order(key_path, tmp_path):
+    """
+    Tests that the ``ps`` backend lists the running processes by CPU usage,
+    highest first, as the ``commands`` backend does, with or without the
+    compact transport.
+    """
+    with fleet.FakeFleet(3, processes=30) as fake_fleet:
+        commands = sweep(fake_fleet, key_path, tmp_path, '--backend', 'commands')
+        plain = sweep(fake_fleet, key_path, tmp_path, '--backend', 'ps')
+        compact = sweep(fake_fleet, key_path, tmp_path, '--backend', 'ps', '--compress')
+    for address, record in commands.items():
+        assert plain[address]['running_processes'] == record['running_processes']
+        assert compact[address]['running_processes'] == record['running_processes']
+
+
+@pytest.mark.parametrize('failure, status', [('refuse', 'error'), ('auth', 'error'),
+                                             ('stall', 'timeout')])
+def test_failures(key_path, tmp_path, failure, status):
+    """
+    Tests that a failing server is reported with its status without
+    affecting the others.
+
+    Parameters
+    ----------
+    failure: string
+        How the failing server fails.
+    status: string
+        Status expected for the failing server.
+    """
+    with fleet.FakeFleet(4, processes=20, failure_rate=0.25, failure=failure) as fake_fleet:
+        results = sweep(fake_fleet, key_path, tmp_path, '--deadline', '3')
+    failing = [address for address, host in fake_fleet.hosts.items() if host.failure]
+    assert len(failing) == 1
+    assert results[failing[0]]['status'] == status
+    assert all('status' not in record for address, record in results.items()
+               if address not in failing)
+
+
+def test_sweep_workers(key_path, tmp_path):
+    """
+    Tests that a sweep split across worker processes reports every server,
+    with its profile.
+    """
+    with fleet.FakeFleet(6, processes=20, failure_rate=0.2, failure='auth') as fake_fleet:
+        results = sweep(fake_fleet, key_path, tmp_path, '--workers', '2', '--profile')
+    assert sorted(results) == sorted(fake_fleet.hosts)
+    for address, record in results.items():
+        assert ('status' in record) == bool(fake_fleet.hosts[address].failure)
+        assert record['profile']['round_trips'] == (0 if 'status' in record else 1)
+
+
+@pytest.mark.parametrize('backend', ['ps', 'proc'])
+def test_sweep_large_output(key_path, tmp_path, backend):
+    """
+    Tests that an output spanning many chunks is parsed whole as it
+    arrives.
+
+    Parameters
+    ----------
+    backend: string
+        Collection backend.
+    """
+    with fleet.FakeFleet(1, processes=20000) as fake_fleet:
+        results = sweep(fake_fleet, key_path, tmp_path, '--backend', backend, '--profile')
+    record = list(results.values())[0]
+    assert len(record['running_processes']) == 20000
+    assert record['profile']['bytes_received'] > 10 * server.Server.CHUNK_SIZE
+
+
+def test_sweep_sampler(key_path, tmp_path):
+    """
+    Tests that the sampler is uploaded once per server, is reused by the
+    next sweeps, and reports its window in a single round trip.
+    """
+    with fleet.FakeFleet(3, processes=20) as fake_fleet:
+        for _ in range(2):
+            results = sweep(fake_fleet, key_path, tmp_path, '--backend', 'sampler',
+                            '--window', '0.1', '--profile')
+            assert sorted(results) == sorted(fake_fleet.hosts)
+            for record in results.values():
+                assert record['window']['seconds'] == 0.1
+                assert record['profile']['round_trips'] == 1
+        assert [host.uploads for host in fake_fleet.hosts.values()] == [1, 1, 1]
+
+
+@pytest.mark.parametrize('backend', ['ps', 'proc', 'commands'])
+def test_sweep_compress(key_path, tmp_path, backend):
+    """
+    Tests that the compact transport reports the same processes as the plain
+    one, on every backend. The CPU percentages of the ``proc`` backend move
+    with the uptime, and the running processes are sorted by them, so only
+    the memory and the names of the processes are compared.
+
+    Parameters
+    ----------
+    backend: string
+        Collection backend.
+    """
+    with fleet.FakeFleet(3, processes=50) as fake_fleet:
+        plain = sweep(fake_fleet, key_path, tmp_path, '--backend', backend)
+        compact = sweep(fake_fleet, key_path, tmp_path, '--backend', backend, '--compress')
+    for address, record in plain.items():
+        if backend == 'proc':
+            assert (sorted(compact[address]['running_processes'])
+                    == sorted(record['running_processes']))
+        else:
+            assert compact[address]['running_processes'] == record['running_processes']
+        top_memory = compact[address]['top_3_memory_consumption']
+        assert ([(pid, top_memory[pid]['memory']) for pid in top_memory]
+                == [(pid, process['memory'])
+                    for pid, process in record['top_3_memory_consumption'].items()])
+
+
+def test_sweep_summary(key_path, tmp_path):
+    """
+    Tests that the fleet summary holds the largest processes of the fleet and
+    counts the failed servers.
+    """
+    with fleet.FakeFleet(4, processes=30, failure_rate=0.25, failure='auth') as fake_fleet:
+        results = sweep(fake_fleet, key_path, tmp_path, '--summary', '--summary-top', '5')
+    summary = json.loads((tmp_path / 'server_data.json').read_text().splitlines()[-1])['fleet']
+    assert summary['hosts'] == 4
+    assert summary['statuses'] == {'ok': 3, 'error': 1}
+    cpu = sorted((process['cpu'] for record in results.values() if 'status' not in record
+                  for process in record['top_3_cpu_consumption'].values()), reverse=True)
+    assert [entry['cpu'] for entry in summary['top_5_cpu_consumption']][:3] == cpu[:3]
+    assert summary['remaining_capacity']['memory_kb']['min'] == min(
+        record['remaining_capacity']['memory_kb'] for record in results.values()
+        if 'status' not in record)
+
+
+def test_watch_pipeline(monkeypatch, key_path, tmp_path):
+    """
+    Tests that the standard output of ``sweep --watch --diff`` holds only
+    the delta records, so it can be piped into ``vmdiag expand`` and
+    ``vmdiag check``.
+    """
+    retrieve_info = vmdiag.retrieve_info
+    calls = []
+
+    def retrieve(*args, **kwargs):
+        calls.append(args[0])
+        if len(calls) > 6:
+            raise KeyboardInterrupt
+        return retrieve_info(*args, **kwargs)
+
+    monkeypatch.setattr(vmdiag, 'retrieve_info', retrieve)
+    rules_path = str(tmp_path / 'rules.json')
+    with open(rules_path, 'w') as rules_file:
+        json.dump([{'name': 'down', 'status': 'any'}], rules_file)
+    runner = CliRunner(mix_stderr=False)
+    with fleet.FakeFleet(3, processes=20) as fake_fleet:
+        result = runner.invoke(vmdiag.main, [
+            'sweep', fake_fleet.target(), '--user', 'root', '--key', key_path,
+            '--port', str(fake_fleet.port), '--known-hosts', str(tmp_path / 'known_hosts'),
+            '--watch', '0.01', '--diff'])
+    assert result.exit_code == 0, result.stderr
+    assert 'Succesfully logged into address' in result.stderr
+    expanded = runner.invoke(vmdiag.main, ['expand', '-'], input=result.stdout)
+    assert expanded.exit_code == 0, expanded.stderr
+    records = [json.loads(line) for line in expanded.stdout.splitlines()]
+    assert len(records) == 6
+    assert set(record['ip'] for record in records) == set(fake_fleet.hosts)
+    checked = runner.invoke(vmdiag.main, ['check', rules_path, '-'], input=result.stdout)
+    assert checked.exit_code == 0, checked.stderr
+
+
+@pytest.mark.parametrize('backend', ['proc', 'commands', 'sampler'])
+def test_sweep_store(key_path, tmp_path, backend):
+    """
+    Tests that the results of every backend are appended to the sample
+    store.
+
+    Parameters
+    ----------
+    backend: string
+        Collection backend.
+    """
+    store_path = str(tmp_path / 'store')
+    with fleet.FakeFleet(2, processes=20) as fake_fleet:
+        results = sweep(fake_fleet, key_path, tmp_path, '--backend', backend, '--window', '0.1',
+                        '--store', store_path)
+    for address, record in results.items():
+        result = CliRunner(mix_stderr=False).invoke(vmdiag.main, ['query', address,
+                                                                  '--store', store_path])
+        samples = [json.loads(line) for line in result.stdout.splitlines()]
+        assert len(samples) == 1
+        assert (samples[0]['remaining_capacity']['memory_kb']
+                == record['remaining_capacity']['memory_kb'])
+        assert len(samples[0]['top_cpu_consumption']) == 3
+
+
+@pytest.mark.parametrize('backend', ['ps', 'proc', 'commands'])
+def test_sweep_cpu_counters(monkeypatch, key_path, tmp_path, backend):
+    """
+    Tests that a sweep measures the CPU against the counters saved by the
+    previous one, instead of reading them one second apart.
+
+    Parameters
+    ----------
+    backend: string
+        Collection backend.
+    """
+    baselines = []
+    run = fleet.FakeHost.run
+
+    def record_run(host, command):
+        if stats.CPU_BASELINE_SECTION[0] in command:
+            baselines.append(host.address)
+        return run(host, command)
+
+    monkeypatch.setattr(fleet.FakeHost, 'run', record_run)
+    with fleet.FakeFleet(3, processes=20) as fake_fleet:
+        sweep(fake_fleet, key_path, tmp_path, '--backend', backend)
+        assert sorted(baselines) == sorted(fake_fleet.hosts)
+        assert sorted(os.listdir(str(tmp_path / 'cpu_times'))) == sorted(fake_fleet.hosts)
+        results = sweep(fake_fleet, key_path, tmp_path, '--backend', backend)
+    assert len(baselines) == 3
+    for record in results.values():
+        assert 0 <= record['remaining_capacity']['cpu'] <= 100
@@ -0,0 +1,128 @@
+"""
+Tests for the incremental JSON writer.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import io
+import json
+import pytest
+from vmdiag import output, stats
+
+RESULTS = [
+    ('10.0.0.2', {'running_processes': ['systemd'], 'remaining_capacity': {'cpu': 80.0}}),
+    ('10.0.0.1', {'running_processes': [], 'remaining_capacity': {'cpu': 12.5}}),
+]
+"""
+list: ``(ip_address, usage data)`` tuples of two fake servers.
+"""
+
+
+def write_all(results, output_format='json', compact=False):
+    """
+    Writes the given results to two streams.
+
+    Parameters
+    ----------
+    results: list
+        ``(ip_address, usage data)`` tuples.
+    output_format: string
+        One of ``output.FORMATS``.
+    compact: bool
+        Whether to write without indentation.
+
+    Returns
+    -------
+    string
+        The text written, checked to be the same on both streams.
+    """
+    streams = [io.StringIO(), io.StringIO()]
+    writer = output.JsonWriter(streams, output_format, compact)
+    for ip_address, stats_dict in results:
+        writer.write(ip_address, stats_dict)
+    writer.close()
+    writer.close()
+    assert streams[0].getvalue() == streams[1].getvalue()
+    return streams[0].getvalue()
+
+
+@pytest.mark.parametrize('results', [RESULTS, RESULTS[:1], []])
+def test_indented(results):
+    """
+    Tests that the indented document is the same as dumping all the
+    results at once.
+
+    Parameters
+    ----------
+    results: list
+        ``(ip_address, usage data)`` tuples.
+    """
+    expected = json.dumps(dict(results), indent=output.INDENT) + '\n'
+    assert write_all(results) == expected
+
+
+@pytest.mark.parametrize('results', [RESULTS, []])
+def test_compact(results):
+    """
+    Tests that the compact document is valid JSON without whitespace.
+
+    Parameters
+    ----------
+    results: list
+        ``(ip_address, usage data)`` tuples.
+    """
+    text = write_all(results, compact=True)
+    assert text == json.dumps(dict(results), separators=(',', ':')) + '\n'
+
+
+def test_ndjson():
+    """
+    Tests that every server gets its own line, with its IP address.
+    """
+    lines = write_all(RESULTS, 'ndjson').splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {'ip': '10.0.0.2', 'running_processes': ['systemd'], 'remaining_capacity': {'cpu': 80.0}},
+        {'ip': '10.0.0.1', 'running_processes': [], 'remaining_capacity': {'cpu': 12.5}},
+    ]
+
+
+def test_host_stats():
+    """
+    Tests that the compact ``HostStats`` form is written as its dictionary.
+    """
+    processes = stats.ProcessTable()
+    processes.append(1, 'init', 0.0, 0.5)
+    host_stats = stats.HostStats(processes, {'cpu': 99.0, 'memory_kb': 100})
+    text = write_all([('10.0.0.1', host_stats)])
+    assert json.loads(text) == {'10.0.0.1': host_stats.as_dict()}
+
+
+@pytest.mark.parametrize('output_format', output.FORMATS)
+def test_summary(output_format):
+    """
+    Tests that the fleet summary is written after the servers, under the
+    ``fleet`` key.
+
+    Parameters
+    ----------
+    output_format: string
+        One of ``output.FORMATS``.
+    """
+    stream = io.StringIO()
+    writer = output.JsonWriter([stream], output_format)
+    writer.write(*RESULTS[0])
+    writer.write_summary({'hosts': 1})
+    writer.close()
+    if output_format == 'json':
+        assert json.loads(stream.getvalue())['fleet'] == {'hosts': 1}
+    else:
+        assert json.loads(stream.getvalue().splitlines()[-1]) == {'fleet': {'hosts': 1}}
+
+
+def test_invalid_format():
+    """
+    Tests that an unknown format raises an exception.
+    """
+    with pytest.raises(Exception):
+        output.JsonWriter([], 'xml')
@@ -123,3 +123,146 @@ def test_except_messages(input_ip, expected_msg):
     with pytest.raises(Exception) as error:
         assert parser.parse_ip(input_ip)
     assert str(error.value) == expected_msg
+
+
+@pytest.mark.parametrize('target,expected', [
+    ('10.0.0.1', ('10.0.0.1', '10.0.0.1')),
+    ('10.0.0.0/24', ('10.0.0.1', '10.0.0.254')),
+    ('10.0.0.77/24', ('10.0.0.1', '10.0.0.254')),
+    ('10.0.0.0/31', ('10.0.0.0', '10.0.0.1')),
+    ('10.0.0.5/32', ('10.0.0.5', '10.0.0.5')),
+    ('10.0.0.0/16', ('10.0.0.1', '10.0.255.254')),
+    ('10.0.0.250-10.0.1.3', ('10.0.0.250', '10.0.1.3')),
+    ('10.0.0.1-20', ('10.0.0.1', '10.0.0.20')),
+])
+def test_target(target, expected):
+    """
+    Tests the ranges covered by addresses, CIDR blocks and ranges.
+
+    Parameters
+    ----------
+    target: string
+        The target to parse.
+    expected: tuple
+        The first and last addresses of the range.
+    """
+    first, last = parser.parse_target(target)
+    assert (parser.int_to_address(first), parser.int_to_address(last)) == expected
+
+
+@pytest.mark.parametrize('target,expected_msg', [
+    ('10.0.0.0/33', 'Invalid CIDR prefix. Should be between 0 and 32'),
+    ('10.0.0.0/', 'Invalid CIDR prefix. Should be between 0 and 32'),
+    ('10.0.0.256/24', 'Invalid IP octet. Maximum value should be 255'),
+    ('10.0.0.20-10.0.0.1', 'Invalid IP range. The first address should not be greater than the last'),
+    ('10.0.0.1-256', 'Invalid IP octet. Maximum value should be 255'),
+    ('10.0.0.1-10.0.0', 'Invalid IP format. Should be XXX.XXX.XXX.XXX'),
+])
+def test_target_except(target, expected_msg):
+    """
+    Tests the messages raised for invalid targets.
+
+    Parameters
+    ----------
+    target: string
+        The target to parse.
+    expected_msg: string
+        The message of the exception that should be raised.
+    """
+    with pytest.raises(Exception) as error:
+        parser.parse_target(target)
+    assert str(error.value) == expected_msg
+
+
+def test_parsing_ranges():
+    """
+    Tests that the parser expands the ranges and drops the repeated addresses.
+    """
+    assert parser.parse_ip('10.0.0.2,10.0.0.0/30,10.0.0.1-3') == ['10.0.0.2', '10.0.0.1', '10.0.0.3']
+
+
+def test_expand_lazily():
+    """
+    Tests that the addresses of a large block are generated as they are
+    consumed.
+    """
+    targets = parser.expand_targets(parser.parse_targets('10.0.0.0/8', ['ubuntu'], ['key.pem']))
+    assert next(targets) == ('10.0.0.1', 'ubuntu', 'key.pem')
+    assert next(targets) == ('10.0.0.2', 'ubuntu', 'key.pem')
+
+
+def test_expand_overlapping():
+    """
+    Tests that the addresses of overlapping and touching targets are only
+    generated once, and that the covered ranges are merged.
+    """
+    entries = [(10, 20, 'a', None), (15, 25, 'b', None), (5, 12, 'c', None), (30, 30, 'd', None),
+               (1, 40, 'e', None), (26, 29, 'f', None)]
+    targets = [(parser.address_to_int(address), username)
+               for address, username, _ in parser.expand_targets(entries)]
+    assert targets == ([(value, 'a') for value in range(10, 21)]
+                       + [(value, 'b') for value in range(21, 26)]
+                       + [(value, 'c') for value in range(5, 10)]
+                       + [(30, 'd')]
+                       + [(value, 'e') for value in list(range(1, 5)) + list(range(26, 30))
+                          + list(range(31, 41))])
+    firsts, lasts = [], []
+    for first, last in [(10, 20), (22, 30), (21, 21), (50, 60)]:
+        parser.claim_range(firsts, lasts, first, last)
+    assert (firsts, lasts) == ([10, 50], [30, 60])
+
+
+def test_hosts_file(tmp_path):
+    """
+    Tests that the hosts file columns override the usernames and keys given
+    on the command line.
+    """
+    hosts_file = tmp_path / 'hosts'
+    hosts_file.write_text('# Web servers\n'
+                          '10.0.0.1-2 debian web.pem\n'
+                          '\n'
+                          '10.0.0.2\n'
+                          '10.0.1.0/30 centos  # Uses the default key\n')
+    targets = parser.expand_targets(parser.parse_targets('10.0.2.1', ['ubuntu'], ['key.pem'],
+                                                         str(hosts_file)))
+    assert list(targets) == [
+        ('10.0.2.1', 'ubuntu', 'key.pem'),
+        ('10.0.0.1', 'debian', 'web.pem'),
+        ('10.0.0.2', 'debian', 'web.pem'),
+        ('10.0.1.1', 'centos', 'key.pem'),
+        ('10.0.1.2', 'centos', 'key.pem'),
+    ]
+
+
+@pytest.mark.parametrize('ip_string,users,keys,contents', [
+    ('', ['ubuntu'], ['key.pem'], None),
+    ('10.0.0.1', ['ubuntu', 'debian'], ['key.pem'], None),
+    ('10.0.0.1,10.0.0.2,10.0.0.3', ['ubuntu', 'debian'], ['key.pem', 'key.pem'], None),
+    ('10.0.0.0/30', ['ubuntu', 'debian'], ['key.pem', 'key.pem'], None),
+    ('', [], [], '10.0.0.1 ubuntu\n'),
+    ('', [], [], '10.0.0.1 ubuntu key.pem extra\n'),
+    ('', [], [], '10.0.0.1 ubuntu key.pem\n10.0.0.300\n'),
+])
+def test_targets_except(tmp_path, ip_string, users, keys, contents):
+    """
+    Tests that the targets without a username or key, or with mismatched
+    usernames and keys, raise an exception.
+
+    Parameters
+    ----------
+    ip_string: string
+        Comma separated targets.
+    users: list
+        Usernames given on the command line.
+    keys: list
+        PEM key paths given on the command line.
+    contents: string
+        Contents of the hosts file, None to not use one.
+    """
+    hosts_file = None
+    if contents is not None:
+        hosts_file = str(tmp_path / 'hosts')
+        with open(hosts_file, 'w') as hosts:
+            hosts.write(contents)
+    with pytest.raises(Exception):
+        parser.parse_targets(ip_string, users, keys, hosts_file)
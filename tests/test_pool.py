@@ -0,0 +1,151 @@
+"""
+Tests for the SSH connection pool.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import paramiko
+import pytest
+from vmdiag import pool
+
+
+class FakeServer:
+    """
+    Stand-in for ``server.Server`` that records its connections instead
+    of opening SSH sessions.
+    """
+
+    instances = []
+
+    def __init__(self, ip_address, username, creds, timeout=60, known_hosts=None, port=22,
+                 compress=False):
+        self.ip_address = ip_address
+        self.username = username
+        self.key_path = creds
+        self.active = False
+        self.keepalive = 0
+        self.connections = 0
+        self.deadline = None
+        FakeServer.instances.append(self)
+
+    def connect(self):
+        self.active = True
+        self.connections += 1
+
+    def disconnect(self):
+        self.active = False
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        self.keepalive = interval
+
+    def set_deadline(self, seconds):
+        self.deadline = seconds
+
+
+@pytest.fixture
+def connection_pool(monkeypatch):
+    """
+    Provides a pool whose connections are ``FakeServer`` instances.
+
+    Returns
+    -------
+    ConnectionPool
+        Connection pool with a TTL of 60 seconds.
+    """
+    FakeServer.instances = []
+    monkeypatch.setattr(pool.server, 'Server', FakeServer)
+    return pool.ConnectionPool(ttl=60, keepalive=10)
+
+
+def test_reuse_connection(connection_pool):
+    """
+    Tests that a released connection is reused for the same credentials
+    and that different credentials get their own connection.
+    """
+    client = connection_pool.acquire('10.0.0.1', 'ubuntu', 'key.pem')
+    assert client.keepalive == 10
+    connection_pool.release(client)
+    assert connection_pool.acquire('10.0.0.1', 'ubuntu', 'key.pem') is client
+    other = connection_pool.acquire('10.0.0.1', 'debian', 'key.pem')
+    assert other is not client
+    assert len(FakeServer.instances) == 2
+
+
+def test_reconnect_dead_connection(connection_pool):
+    """
+    Tests that an idle connection that died is reconnected before being
+    handed out again.
+    """
+    client = connection_pool.acquire('10.0.0.1', 'ubuntu', 'key.pem')
+    connection_pool.release(client)
+    client.active = False
+    assert connection_pool.acquire('10.0.0.1', 'ubuntu', 'key.pem') is client
+    assert client.is_active()
+    assert client.connections == 2
+    assert len(FakeServer.instances) == 1
+
+
+def test_run_retries_broken_connection(connection_pool):
+    """
+    Tests that a query failing because of a broken connection is run once
+    more after reconnecting.
+    """
+    calls = []
+
+    def query(client):
+        calls.append(client.connections)
+        if len(calls) == 1:
+            raise paramiko.SSHException('Connection dropped')
+        return 'stats'
+
+    assert connection_pool.run('10.0.0.1', 'ubuntu', 'key.pem', query) == 'stats'
+    assert calls == [1, 2]
+    assert connection_pool.acquire('10.0.0.1', 'ubuntu', 'key.pem') is FakeServer.instances[0]
+
+
+def test_run_discards_on_error(connection_pool):
+    """
+    Tests that a connection is closed and not reused when the query fails
+    for a reason other than a broken connection.
+    """
+    def query(client):
+        raise Exception('Missing section in batched output: cpu')
+
+    with pytest.raises(Exception):
+        connection_pool.run('10.0.0.1', 'ubuntu', 'key.pem', query)
+    client = FakeServer.instances[0]
+    assert not client.is_active()
+    assert connection_pool.acquire('10.0.0.1', 'ubuntu', 'key.pem') is not client
+
+
+def test_evict_idle(connection_pool):
+    """
+    Tests that connections idle for longer than the TTL are closed.
+    """
+    client = connection_pool.acquire('10.0.0.1', 'ubuntu', 'key.pem')
+    connection_pool.release(client)
+    connection_pool.ttl = 0
+    connection_pool.evict_idle()
+    assert not client.is_active()
+    assert connection_pool.acquire('10.0.0.1', 'ubuntu', 'key.pem') is not client
+
+
+def test_run_timeout_not_retried(connection_pool):
+    """
+    Tests that a query that exceeded its deadline is not run again and its
+    connection is closed.
+    """
+    calls = []
+
+    def query(client):
+        calls.append(client.deadline)
+        raise TimeoutError('Deadline exceeded on 10.0.0.1')
+
+    with pytest.raises(TimeoutError):
+        connection_pool.run('10.0.0.1', 'ubuntu', 'key.pem', query, deadline=5)
+    assert calls == [5]
+    assert not FakeServer.instances[0].is_active()
@@ -0,0 +1,90 @@
+"""
+Tests for the per-server timings and counters.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import pickle
+import pytest
+from vmdiag import profiling
+
+
+@pytest.mark.parametrize('percent,expected', [
+    (0, 1),
+    (50, 5),
+    (90, 9),
+    (99, 10),
+    (100, 10),
+])
+def test_percentile(percent, expected):
+    """
+    Tests the nearest rank percentiles of the values from 1 to 10.
+
+    Parameters
+    ----------
+    percent: float
+        The percentile to compute.
+    expected: int
+        The resulting value.
+    """
+    assert profiling.percentile(list(range(1, 11)), percent) == expected
+
+
+def test_host_profile():
+    """
+    Tests that the phases add up their times and the counters their values.
+    """
+    profile = profiling.HostProfile()
+    for _ in range(2):
+        with profile.phase('exec'):
+            pass
+    profile.add('round_trips')
+    profile.add('bytes_received', 1024)
+    profile.finish()
+    profile_dict = profile.as_dict()
+    assert list(profile_dict['phases_ms']) == profiling.PHASES
+    assert profile_dict['phases_ms']['connect'] == 0
+    assert 0 <= profile_dict['phases_ms']['exec'] <= profile_dict['total_ms']
+    assert profile_dict['round_trips'] == 1
+    assert profile_dict['bytes_received'] == 1024
+    assert profile_dict['retries'] == 0
+    assert profile.total() == profile.total()
+
+
+def test_phase_disabled():
+    """
+    Tests that timing a phase without a profile does nothing.
+    """
+    with profiling.phase(None, 'exec'):
+        pass
+
+
+def test_report():
+    """
+    Tests that the summary has one row per phase and counter over the last
+    profile of every server.
+    """
+    profiler = profiling.Profiler()
+    for ip_address, bytes_received in [('10.0.0.1', 100), ('10.0.0.2', 300), ('10.0.0.1', 200)]:
+        profiler.start(ip_address).add('bytes_received', bytes_received)
+    rows = dict((name, values) for name, _, values in profiler.summary())
+    assert rows['bytes_received'] == [200, 300]
+    lines = profiler.report().splitlines()
+    assert lines[0].startswith('2 hosts')
+    assert len(lines) == 1 + len(profiling.PHASES) + 1 + len(profiling.COUNTERS)
+    assert lines[-2].split() == ['bytes_received', '200', '300', '300', '300', '500']
+
+
+def test_profiler_pickle():
+    """
+    Tests that a profile sent back from a pickled profiler can be added to
+    the original one.
+    """
+    profiler = profiling.Profiler()
+    copy = pickle.loads(pickle.dumps(profiler))
+    copy.start('10.0.0.1').add('round_trips')
+    profile = pickle.loads(pickle.dumps(copy.get('10.0.0.1')))
+    assert profiler.get('10.0.0.1') is None
+    profiler.add('10.0.0.1', profile)
+    assert profiler.get('10.0.0.1').counters['round_trips'] == 1
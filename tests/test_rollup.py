@@ -0,0 +1,117 @@
+"""
+Tests for the fleet-wide roll-up of the results of a sweep.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import random
+import pytest
+from vmdiag import profiling, rollup
+
+
+@pytest.mark.parametrize('percent', [1, 5, 50, 95, 99, 100])
+def test_sketch_accuracy(percent):
+    """
+    Tests that the percentiles of the sketch are within its accuracy of the
+    exact ones.
+
+    Parameters
+    ----------
+    percent: float
+        Percentile.
+    """
+    rng = random.Random(1)
+    values = [rng.lognormvariate(12, 2) for _ in range(10000)]
+    sketch = rollup.QuantileSketch(0.01)
+    for value in values:
+        sketch.add(value)
+    exact = profiling.percentile(sorted(values), percent)
+    assert sketch.percentile(percent) == pytest.approx(exact, rel=0.01)
+    assert len(sketch) < 1000
+
+
+def test_sketch_merge():
+    """
+    Tests that merging two sketches gives the sketch of all their values,
+    zeros included.
+    """
+    values = [0.0, 0.0, 3.5, 10.0, 250.0, 99.9, 42.0]
+    whole = rollup.QuantileSketch()
+    first = rollup.QuantileSketch()
+    second = rollup.QuantileSketch()
+    for index, value in enumerate(values):
+        whole.add(value)
+        (first if index % 2 else second).add(value)
+    first.merge(second)
+    assert first.count == whole.count == 7
+    assert (first.min, first.max) == (0.0, 250.0)
+    for percent in (10, 30, 50, 90, 100):
+        assert first.percentile(percent) == whole.percentile(percent)
+    assert first.percentile(20) == 0.0
+    assert rollup.QuantileSketch().percentile(50) is None
+    with pytest.raises(Exception):
+        first.merge(rollup.QuantileSketch(0.05))
+
+
+def test_fleet_top(host_stats):
+    """
+    Tests that the fleet top holds the largest processes of every server, and
+    that the reported top processes of the other backends and the error
+    statuses are counted.
+    """
+    fleet_rollup = rollup.FleetRollup(top=2)
+    fleet_rollup.add('10.0.0.1', host_stats([(1, 'java', 90.0, 1.0), (2, 'sshd', 0.1, 0.1),
+                                             (3, 'java', 80.0, 40.0)], 10.0, 1000))
+    fleet_rollup.add('10.0.0.2', host_stats([(7, 'node', 85.0, 2.0)], 50.0, 3000))
+    fleet_rollup.add('10.0.0.3', {
+        'top_3_cpu_consumption': {'9': {'name': 'redis', 'cpu': 5.0, 'memory': 60.0}},
+        'top_3_memory_consumption': {'9': {'name': 'redis', 'cpu': 5.0, 'memory': 60.0}},
+        'remaining_capacity': {'cpu': 90.0, 'memory_kb': 2000}})
+    fleet_rollup.add('10.0.0.4', {'status': 'timeout', 'error': 'Timed out'})
+    summary = fleet_rollup.summary()
+    assert summary['hosts'] == 4
+    assert summary['statuses'] == {'ok': 3, 'timeout': 1}
+    assert summary['top_2_cpu_consumption'] == [
+        {'ip': '10.0.0.1', 'pid': 1, 'name': 'java', 'cpu': 90.0, 'memory': 1.0},
+        {'ip': '10.0.0.2', 'pid': 7, 'name': 'node', 'cpu': 85.0, 'memory': 2.0}]
+    assert [entry['pid'] for entry in summary['top_2_memory_consumption']] == [9, 3]
+    assert summary['remaining_capacity']['memory_kb']['min'] == 1000
+    assert summary['remaining_capacity']['memory_kb']['p50'] == pytest.approx(2000, rel=0.01)
+    assert summary['remaining_capacity']['cpu']['max'] == 90.0
+
+
+def test_fleet_top_aggregate(host_stats):
+    """
+    Tests that the aggregated results put the process names in the fleet
+    top, with their count.
+    """
+    fleet_rollup = rollup.FleetRollup(top=1)
+    fleet_rollup.add('10.0.0.1', host_stats([(1, 'php', 30.0, 1.0), (2, 'php', 30.0, 1.0),
+                                             (3, 'java', 50.0, 1.0)], 10.0, 1000, aggregate=True))
+    assert fleet_rollup.summary()['top_1_cpu_consumption'] == [
+        {'ip': '10.0.0.1', 'count': 2, 'name': 'php', 'cpu': 60.0, 'memory': 2.0}]
+
+
+def test_merge(host_stats):
+    """
+    Tests that merging the roll-ups of two halves of a fleet gives the
+    roll-up of the whole fleet.
+    """
+    rng = random.Random(2)
+    whole = rollup.FleetRollup(top=3)
+    halves = [rollup.FleetRollup(top=3), rollup.FleetRollup(top=3)]
+    for index in range(50):
+        processes = [(pid, 'proc%d' % pid, round(rng.uniform(0, 100), 1),
+                      round(rng.uniform(0, 10), 1)) for pid in range(1, 30)]
+        result = host_stats(processes, rng.uniform(0, 100), rng.randint(1, 10 ** 7))
+        address = '10.0.0.%d' % index
+        whole.add(address, result)
+        halves[index % 2].add(address, result)
+    halves[0].merge(halves[1])
+    merged = halves[0].summary()
+    expected = whole.summary()
+    assert merged['remaining_capacity'] == expected['remaining_capacity']
+    for key in ('top_3_cpu_consumption', 'top_3_memory_consumption'):
+        assert ([entry['cpu' if 'cpu' in key else 'memory'] for entry in merged[key]]
+                == [entry['cpu' if 'cpu' in key else 'memory'] for entry in expected[key]])
@@ -0,0 +1,149 @@
+"""
+Tests for the alert rules engine.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import io
+import json
+import pytest
+from vmdiag import delta, rules
+
+RULES = [
+    {'name': 'low-memory', 'metric': 'memory_kb', 'below': 600000, 'severity': 'critical'},
+    {'name': 'busy', 'metric': 'cpu', 'below': 20},
+    {'name': 'leak', 'metric': 'memory_kb', 'rate': True, 'below': -1000},
+    {'name': 'java-top', 'process': 'java', 'top': 2, 'metric': 'memory'},
+    {'name': 'down', 'status': 'any', 'severity': 'critical'},
+]
+"""
+list: One rule of every kind.
+"""
+
+
+def record(cpu, memory_kb, top_memory):
+    """
+    Builds the usage data of a fake server.
+
+    Parameters
+    ----------
+    cpu: float
+        Remaining CPU percentage.
+    memory_kb: int
+        Available memory in kB.
+    top_memory: list
+        Names of the top processes by memory, from greater to lower.
+
+    Returns
+    -------
+    dictionary
+        The usage data.
+    """
+    top_dict = dict((str(pid), {'name': name, 'cpu': 1.0, 'memory': 10.0 - pid})
+                    for pid, name in enumerate(top_memory, 1))
+    return {'running_processes': list(top_memory), 'top_3_cpu_consumption': top_dict,
+            'top_3_memory_consumption': top_dict,
+            'remaining_capacity': {'cpu': cpu, 'memory_kb': memory_kb}}
+
+
+@pytest.fixture(params=['lists', 'numpy'])
+def backend(request, monkeypatch):
+    """
+    Evaluates the rules on plain lists, and on NumPy arrays if NumPy is
+    installed.
+    """
+    if request.param == 'numpy':
+        monkeypatch.setattr(rules, 'numpy', pytest.importorskip('numpy'))
+    else:
+        monkeypatch.setattr(rules, 'numpy', None)
+    return request.param
+
+
+def test_evaluate(backend):
+    """
+    Tests that every kind of rule fires on the right servers, and only
+    there.
+    """
+    hosts = {}
+    rules.add_sample(hosts, '10.0.0.1', record(15.0, 900000, ['sshd', 'java']), 100.0)
+    rules.add_sample(hosts, '10.0.0.2', record(90.0, 500000, ['nginx']), 100.0)
+    rules.add_sample(hosts, '10.0.0.1', record(85.0, 800000, ['sshd', 'java']), 160.0)
+    rules.add_sample(hosts, '10.0.0.3', record(5.0, 100, ['java']), 100.0)
+    rules.add_sample(hosts, '10.0.0.3', {'status': 'timeout'}, 160.0)
+    rules.add_sample(hosts, '10.0.0.4', record(50.0, 700000, ['a', 'b', 'java']), 100.0)
+    alerts = rules.evaluate(rules.parse_rules(RULES), hosts)
+    assert alerts == [
+        {'ip': '10.0.0.2', 'rule': 'low-memory', 'severity': 'critical', 'timestamp': 100.0,
+         'metric': 'memory_kb', 'value': 500000.0},
+        {'ip': '10.0.0.1', 'rule': 'leak', 'severity': 'warning', 'timestamp': 160.0,
+         'metric': 'memory_kb', 'rate': -100000.0},
+        {'ip': '10.0.0.1', 'rule': 'java-top', 'severity': 'warning', 'timestamp': 160.0,
+         'metric': 'memory', 'process': 'java', 'rank': 2},
+        {'ip': '10.0.0.3', 'rule': 'down', 'severity': 'critical', 'timestamp': 160.0,
+         'status': 'timeout'},
+    ]
+    assert rules.exit_code(alerts) == 2
+    assert rules.exit_code([alerts[1]]) == 1
+    assert rules.exit_code([]) == rules.EXIT_OK
+
+
+def test_stale_samples(backend):
+    """
+    Tests that the samples older than the last one of a server are ignored,
+    and that the servers without any rule to fire give no alert.
+    """
+    hosts = {}
+    rules.add_sample(hosts, '10.0.0.1', record(90.0, 800000, ['sshd']), 160.0)
+    rules.add_sample(hosts, '10.0.0.1', record(5.0, 100, ['java']), 100.0)
+    assert rules.evaluate(rules.parse_rules(RULES), hosts) == []
+    assert rules.evaluate(rules.parse_rules(RULES), {}) == []
+
+
+@pytest.mark.parametrize('document', [
+    [],
+    {'rules': 'low-memory'},
+    [{'metric': 'cpu', 'below': 10}],
+    [{'name': 'a', 'metric': 'cpu'}],
+    [{'name': 'a', 'metric': 'cpu', 'below': 10, 'above': 90}],
+    [{'name': 'a', 'metric': 'cpu', 'below': '10'}],
+    [{'name': 'a', 'metric': 'cpu', 'below': 10, 'severity': 'fatal'}],
+    [{'name': 'a', 'process': 'java', 'metric': 'disk'}],
+    [{'name': 'a', 'process': 'java', 'metric': 'cpu', 'top': 0}],
+    [{'name': 'a', 'status': 'any'}, {'name': 'a', 'status': 'error'}],
+])
+def test_invalid_rules(document):
+    """
+    Tests that invalid rules are rejected.
+
+    Parameters
+    ----------
+    document: object
+        The parsed rules file.
+    """
+    with pytest.raises(Exception):
+        rules.parse_rules(document)
+
+
+def test_read_results():
+    """
+    Tests that the sweep documents, the ndjson lines and the delta streams
+    are read, and that the fleet summaries are skipped.
+    """
+    document = {'10.0.0.1': record(50.0, 1000, ['sshd']), 'fleet': {'hosts': 1}}
+    assert list(rules.read_results(io.StringIO(json.dumps(document)), 5.0)) == [
+        ('10.0.0.1', 5.0, document['10.0.0.1'])]
+    encoder = delta.DeltaEncoder()
+    lines = []
+    for timestamp, memory_kb in ((100.0, 1000), (160.0, 500)):
+        full = {'timestamp': timestamp, 'ip': '10.0.0.1'}
+        full.update(record(50.0, memory_kb, ['sshd']))
+        lines.append(json.dumps(encoder.encode(full)))
+    lines.append(json.dumps({'fleet': {'hosts': 1}}))
+    lines.append(json.dumps({'ip': '10.0.0.2', 'status': 'timeout'}))
+    results = list(rules.read_results(io.StringIO('\n'.join(lines)), 5.0))
+    assert [(ip, timestamp) for ip, timestamp, _ in results] == [
+        ('10.0.0.1', 100.0), ('10.0.0.1', 160.0), ('10.0.0.2', 5.0)]
+    assert results[1][2] == record(50.0, 500, ['sshd'])
+    with pytest.raises(Exception):
+        list(rules.read_results(io.StringIO('{"ip": "10.0.0.1"}\nnot json\n')))
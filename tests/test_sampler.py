@@ -0,0 +1,57 @@
+"""
+Tests for the sampler run on the servers by the ``sampler`` backend.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import json
+import os
+import subprocess
+import sys
+import pytest
+from vmdiag import sampler, stats
+
+pytestmark = pytest.mark.skipif(not os.path.exists('/proc/stat'), reason='Needs /proc')
+
+
+def test_sample():
+    """
+    Tests that the sampler summarizes a window of this machine.
+    """
+    summary = sampler.sample(0.2, 20, 3)
+    assert summary['samples'] == 4
+    assert 0.1 < summary['seconds'] < 1.0
+    low, average, high = summary['cpu']
+    assert 0 <= low <= average <= high <= 100
+    assert 0 <= summary['cpu_steal'] <= 100 - average
+    assert summary['memory_kb'][0] <= summary['memory_kb'][2]
+    assert len(summary['top_cpu']) <= 3
+    assert os.getpid() not in [row[0] for row in summary['top_cpu'] + summary['top_memory']]
+
+
+def test_script():
+    """
+    Tests that the sampler runs as a script and that its output is parsed
+    by ``stats.parse_sampler()``.
+    """
+    process = subprocess.run([sys.executable, sampler.__file__, '0.1', '10', '2', '--aggregate'],
+                             stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    assert len(json.loads(process.stdout)['top_memory']) <= 2
+    stats_dict = stats.parse_sampler([process.stdout], top=2, aggregate=True)
+    for process_dict in stats_dict['top_2_memory_consumption'].values():
+        assert process_dict['count'] >= 1
+    assert stats_dict['window']['samples'] == 1
+    assert 'cpu_steal' in stats_dict['remaining_capacity']
+
+
+def test_read_cpu(monkeypatch, tmp_path):
+    """
+    Tests that only the first counters of ``/proc/stat`` are read, with the
+    iowait time counted as available CPU.
+    """
+    stat_path = tmp_path / 'stat'
+    stat_path.write_text('cpu  100 10 50 800 40 5 5 20 30 0\ncpu0 1 2 3 4\n')
+    real_open = open
+    monkeypatch.setattr(sampler, 'open', lambda path: real_open(str(stat_path)), raising=False)
+    assert sampler.read_cpu() == (190, 20, 1030)
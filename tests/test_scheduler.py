@@ -0,0 +1,97 @@
+"""
+Tests for the adaptive polling scheduler.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import itertools
+import time
+import pytest
+from vmdiag import scheduler
+
+
+def test_volatility(host_stats):
+    """
+    Tests that the volatility is the largest of the CPU, memory and top
+    processes changes.
+    """
+    previous = scheduler.summarize(host_stats(['java', 'sshd', 'cron'], 80.0, 1000, top=2))
+    assert previous == (80.0, 1000, frozenset(['java', 'sshd']))
+    assert scheduler.volatility(previous, previous) == 0.0
+    current = scheduler.summarize(host_stats(['java', 'sshd', 'cron'], 70.0, 1000, top=2))
+    assert scheduler.volatility(previous, current) == pytest.approx(0.1)
+    current = scheduler.summarize(host_stats(['java', 'sshd', 'cron'], 80.0, 500, top=2))
+    assert scheduler.volatility(previous, current) == pytest.approx(0.5)
+    current = scheduler.summarize(host_stats(['java', 'node', 'cron'], 80.0, 1000, top=2))
+    assert scheduler.volatility(previous, current) == pytest.approx(2 / 3)
+    assert scheduler.summarize({'status': 'error', 'error': 'Authentication failed.'}) is None
+
+
+@pytest.mark.parametrize('score, expected', [(0.0, 64.0), (scheduler.VOLATILE / 2, 8.0),
+                                             (scheduler.VOLATILE, 1.0), (1.0, 1.0)])
+def test_interval_for(score, expected):
+    """
+    Tests that the interval goes geometrically from the maximum to the
+    minimum as the volatility grows.
+
+    Parameters
+    ----------
+    score: float
+        Smoothed volatility.
+    expected: float
+        Expected interval.
+    """
+    assert scheduler.interval_for(score, 1.0, 64.0) == pytest.approx(expected)
+
+
+def test_update(host_stats):
+    """
+    Tests that a server backs off while it does not change, goes back to
+    the minimum interval when it does, and that errors keep its interval.
+    """
+    adaptive = scheduler.AdaptiveScheduler([('10.0.0.1', 'ubuntu', 'key.pem')], 1.0, 60.0)
+    idle = host_stats(['sshd', 'cron'], 90.0, 1000, top=2)
+    assert adaptive.update('10.0.0.1', idle) == 1.0
+    assert adaptive.update('10.0.0.1', idle) == 60.0
+    assert adaptive.update('10.0.0.1', {'status': 'timeout'}) == 60.0
+    assert adaptive.update('10.0.0.1', host_stats(['java', 'node'], 10.0, 100, top=2)) == 1.0
+    with pytest.raises(Exception):
+        scheduler.AdaptiveScheduler([], 10.0, 1.0)
+
+
+def test_busy_hosts_sampled_more(host_stats):
+    """
+    Tests that a server that changes on every sample is sampled at the
+    minimum interval and an idle one backs off to the maximum.
+    """
+    cpu = itertools.cycle([10.0, 90.0])
+
+    def retrieve(ip_address, username, key):
+        if ip_address == '10.0.0.1':
+            return host_stats(['java', 'sshd'], next(cpu), 1000, top=2)
+        return host_stats(['sshd', 'cron'], 95.0, 1000, top=2)
+
+    targets = [('10.0.0.1', 'ubuntu', 'key.pem'), ('10.0.0.2', 'ubuntu', 'key.pem')]
+    adaptive = scheduler.AdaptiveScheduler(targets, 0.02, 0.5)
+    start = time.monotonic()
+    counts = {'10.0.0.1': 0, '10.0.0.2': 0}
+    for _, ip_address, _ in adaptive.run(retrieve):
+        counts[ip_address] += 1
+        if time.monotonic() - start > 0.6:
+            break
+    assert counts['10.0.0.1'] > 15
+    assert counts['10.0.0.2'] <= 4
+    assert adaptive.intervals == {'10.0.0.1': 0.02, '10.0.0.2': pytest.approx(0.5)}
+
+
+def test_rate():
+    """
+    Tests that no more than ``rate`` samples are started per second.
+    """
+    targets = [('10.0.0.%d' % i, 'ubuntu', 'key.pem') for i in range(10)]
+    adaptive = scheduler.AdaptiveScheduler(targets, 0.01, 0.01, rate=50)
+    start = time.monotonic()
+    results = list(adaptive.run(lambda *target: {'status': 'error'}, samples=20))
+    assert len(results) == 20
+    assert time.monotonic() - start >= 19 / 50
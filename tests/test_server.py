@@ -79,14 +79,16 @@ def test_top_cpu(provide_client):
     assert len(cpu_dict) == 3 # Should always return 3 elements
     proc_count = 0
     for proc in cpu_dict:
-        assert isinstance(cpu_dict[proc], float) # CPU values should be floats
+        assert proc.isdigit() # Processes should be keyed by PID
+        assert len(cpu_dict[proc]['name']) > 0 # Every process should have a name
+        assert isinstance(cpu_dict[proc]['cpu'], float) # CPU values should be floats
         # CPU values should be between 0 and 100
-        assert cpu_dict[proc] >= 0.0
-        assert cpu_dict[proc] <= 100.0
+        assert cpu_dict[proc]['cpu'] >= 0.0
+        assert cpu_dict[proc]['cpu'] <= 100.0
         # CPU values should come from greater to lower:
         if proc_count != 0:
-            assert cpu_dict[proc] <= last_proc
-        last_proc = cpu_dict[proc]
+            assert cpu_dict[proc]['cpu'] <= last_proc
+        last_proc = cpu_dict[proc]['cpu']
         proc_count += 1
     client.disconnect()
 
@@ -101,14 +103,16 @@ def test_top_memory(provide_client):
     assert len(mem_dict) == 3 # Should always return 3 elements
     proc_count = 0
     for proc in mem_dict:
-        assert isinstance(mem_dict[proc], float) # Memory values should be floats
+        assert proc.isdigit() # Processes should be keyed by PID
+        assert len(mem_dict[proc]['name']) > 0 # Every process should have a name
+        assert isinstance(mem_dict[proc]['memory'], float) # Memory values should be floats
         # Memory values should be between 0 and 100
-        assert mem_dict[proc] >= 0.0
-        assert mem_dict[proc] <= 100.0
+        assert mem_dict[proc]['memory'] >= 0.0
+        assert mem_dict[proc]['memory'] <= 100.0
         # Memory values should come from greater to lower:
         if proc_count != 0:
-            assert mem_dict[proc] <= last_proc
-        last_proc = mem_dict[proc]
+            assert mem_dict[proc]['memory'] <= last_proc
+        last_proc = mem_dict[proc]['memory']
         proc_count += 1
     client.disconnect()
 
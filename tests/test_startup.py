@@ -0,0 +1,82 @@
+"""
+Tests for the startup time of the command line tool on the paths that do
+not connect to any server.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import subprocess
+import sys
+import pytest
+
+HEAVY_MODULES = ['paramiko', 'cryptography', 'nacl', 'http.server', 'multiprocessing',
+                 'concurrent.futures']
+"""
+list: Modules only needed to query or serve the servers.
+"""
+
+IMPORT_BUDGET_RATIO = 0.75
+"""
+float: Maximum import time of a path that does not connect to any server,
+relative to the same path importing ``paramiko`` too. Comparing both runs
+on the same machine keeps the budget independent of its speed: importing
+``paramiko`` alone roughly doubles the import time.
+"""
+
+
+def import_times(*arguments, preload=''):
+    """
+    Runs the command line tool under ``python -X importtime``.
+
+    Parameters
+    ----------
+    arguments:
+        Command line arguments of ``vmdiag``.
+    preload: string
+        Code run before the tool, such as importing a module.
+
+    Returns
+    -------
+    dictionary
+        The time in microseconds spent importing every module, on its own,
+        keyed by module name.
+    """
+    code = preload + 'import sys; sys.argv = ["vmdiag"] + sys.argv[1:]; from vmdiag import vmdiag; vmdiag.main()'
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code] + list(arguments),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, _, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(self_time)
+    return times
+
+
+@pytest.mark.parametrize('arguments', [
+    ['--help'],
+    ['sweep', '--help'],
+    ['sweep', '300.0.0.1', '--user', 'ubuntu', '--key', 'key.pem'],
+    ['query', '10.0.0.1', '--store', '.', '--start', 'yesterday'],
+    ['check', '--help'],
+])
+def test_no_network_paths(arguments):
+    """
+    Tests that the paths that do not connect to any server do not import
+    the heavy modules, and take clearly less time to import than the same
+    path with ``paramiko``.
+
+    Parameters
+    ----------
+    arguments: list
+        Command line arguments of ``vmdiag``.
+    """
+    times = min((import_times(*arguments) for _ in range(3)), key=lambda times: sum(times.values()))
+    assert 'vmdiag.vmdiag' in times
+    for name in times:
+        assert name.split('.')[0] not in HEAVY_MODULES and name not in HEAVY_MODULES, name
+    heavy_total = min(sum(import_times(*arguments, preload='import paramiko; ').values())
+                      for _ in range(3))
+    assert sum(times.values()) < IMPORT_BUDGET_RATIO * heavy_total
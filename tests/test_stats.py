@@ -0,0 +1,414 @@
+"""
+Tests for the parsing routines of the remote command output.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import json
+import shutil
+import subprocess
+import pytest
+from vmdiag import stats
+
+
+BATCH_OUTPUT = [
+    '@@vmdiag@@ processes\n',
+    '  PID %CPU %MEM COMMAND\n',
+    '    1  0.0  1.1 systemd\n',
+    '  420  2.0  0.5 sshd\n',
+    '  512  1.0  0.2 tmux: server\n',
+    ' 1001 12.5  4.0 python\n',
+    ' 1002 11.0  4.0 python\n',
+    ' 1003  0.8  4.0 python\n',
+    ' 2000  0.5 30.1 java\n',
+    '@@vmdiag@@ cpu\n',
+    'cpu  3000 10 1000 16000 50 0 20 5 0 0\n',
+    'cpu0  1500 5 500 8000 25 0 10 5 0 0\n',
+    'cpu1  1500 5 500 8000 25 0 10 0 0 0\n',
+    '@@vmdiag@@ memory\n',
+    'MemAvailable:     729240 kB\n',
+]
+
+
+def test_batch_command():
+    """
+    Tests that the composite command emits a delimiter before every section.
+    """
+    command = stats.batch_command()
+    for name, section_command in stats.BATCH_SECTIONS:
+        assert "echo '%s %s'; %s" % (stats.SECTION_MARKER, name, section_command) in command
+
+
+def read_sections(output_lines):
+    """
+    Returns the lines of every section of a batched output, keyed by
+    section name.
+    """
+    return dict((name, list(lines)) for name, lines in stats.iter_sections(output_lines))
+
+
+def test_parse_processes():
+    """
+    Tests that process names containing spaces are kept whole.
+    """
+    processes = list(stats.parse_processes(read_sections(BATCH_OUTPUT)['processes']))
+    assert processes[0] == (1, 'systemd', 0.0, 1.1)
+    assert processes[2] == (512, 'tmux: server', 1.0, 0.2)
+
+
+def test_parse_compact_processes():
+    """
+    Tests that the compact process table is decoded into the same processes,
+    PIDs going backwards and processes without CPU or memory included.
+    """
+    lines = ['=systemd\n', '1 0 0.0 1.1\n', '=sshd\n', '419 1 2.0 0.5\n',
+             '=tmux: server\n', '92 2\n', '-100 1 0.3 0.0\n']
+    assert list(stats.parse_compact_processes(lines)) == [
+        (1, 'systemd', 0.0, 1.1), (420, 'sshd', 2.0, 0.5), (512, 'tmux: server', 0.0, 0.0),
+        (412, 'sshd', 0.3, 0.0)]
+    assert stats.parse_compact_names(['=sshd\n', '0\n', '=bash\n', '1\n', '0\n']) == [
+        'sshd', 'bash', 'sshd']
+
+
+@pytest.mark.skipif(shutil.which('awk') is None, reason='Needs awk')
+def test_compact_awk():
+    """
+    Tests that the ``awk`` programs run on the servers encode the listings
+    so they are decoded back into the same processes and names.
+    """
+    ps_lines = read_sections(BATCH_OUTPUT)['processes']
+    ps_lines.append(' 2001  0.0  0.0 =weird  name')
+
+    def awk(program, lines):
+        return subprocess.run(['awk', program], input='\n'.join(lines) + '\n', check=True,
+                              stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+    output = awk(stats.COMPACT_PROCESSES_AWK, ps_lines)
+    assert len(output) < len('\n'.join(ps_lines))
+    assert (list(stats.parse_compact_processes(output.splitlines(True)))
+            == list(stats.parse_processes(ps_lines)))
+    names = ['COMMAND'] + [line.split(None, 3)[3] for line in ps_lines[1:]]
+    assert stats.parse_compact_names(awk(stats.COMPACT_NAMES_AWK, names).splitlines()) == names[1:]
+
+
+@pytest.mark.parametrize('previous,current,expected', [
+    ([0, 0, 0, 0, 0, 0, 0, 0], [3000, 0, 1000, 15000, 1000, 0, 0, 0], (80.0, 0.0)),
+    ([1000, 0, 0, 1000, 0, 0, 0, 0], [1300, 0, 0, 1200, 100, 50, 50, 300], (30.0, 30.0)),
+    ([10, 10, 10, 10, 0, 0, 0, 0], [10, 10, 10, 10, 0, 0, 0, 0], (100.0, 0.0)),
+])
+def test_cpu_remaining(previous, current, expected):
+    """
+    Tests the remaining CPU and steal percentages computed between two
+    reads of the ``/proc/stat`` counters.
+
+    Parameters
+    ----------
+    previous: list
+        Counters of the first read.
+    current: list
+        Counters of the second read.
+    expected: tuple
+        The expected remaining CPU and steal percentages.
+    """
+    assert stats.cpu_remaining(previous, current) == pytest.approx(expected)
+
+
+def test_cpu_usage_delta():
+    """
+    Tests that the CPU usage only reflects the time between both reads,
+    for the whole server and for every core.
+    """
+    previous = stats.parse_cpu_times(['cpu  1000 0 0 1000', 'cpu0 500 0 0 500', 'cpu1 500 0 0 500'])
+    current = stats.parse_cpu_times(['cpu  1100 0 0 1300 0 0 0 100', 'cpu0 600 0 0 600',
+                                     'cpu1 500 0 0 700 0 0 0 100'])
+    usage = stats.cpu_usage(previous, current)
+    assert usage['cpu'] == pytest.approx(60.0)
+    assert usage['cpu_steal'] == pytest.approx(20.0)
+    assert usage['cpu_cores'] == [pytest.approx(50.0), pytest.approx(200 / 3)]
+
+
+@pytest.mark.parametrize('previous', [
+    None,
+    {'cpu': [99999, 0, 0, 99999, 0, 0, 0, 0]},
+])
+def test_cpu_usage_since_boot(previous):
+    """
+    Tests that the usage is computed since boot when there is no previous
+    read or the counters went backwards.
+
+    Parameters
+    ----------
+    previous: dictionary
+        Counters of the previous read.
+    """
+    current = stats.parse_cpu_times(['cpu  3000 10 1000 16000 50 0 20 5 0 0'])
+    assert stats.cpu_usage(previous, current)['cpu'] == pytest.approx(16050 * 100 / 20085)
+
+
+def test_parse_batch():
+    """
+    Tests that every statistic is derived from the batched output with the
+    same format as the individual queries.
+    """
+    previous = stats.parse_cpu_times(['cpu  2000 10 500 15000 50 0 20 5 0 0'])
+    host_stats, cpu_times = stats.parse_batch(BATCH_OUTPUT, previous)
+    stats_dict = host_stats.as_dict()
+    assert stats_dict['running_processes'] == ['python', 'python', 'sshd', 'tmux: server',
+                                               'python', 'java', 'systemd']
+    assert list(stats_dict['top_3_cpu_consumption']) == ['1001', '1002', '420']
+    assert stats_dict['top_3_cpu_consumption']['1001'] == {'name': 'python', 'cpu': 12.5, 'memory': 4.0}
+    assert list(stats_dict['top_3_memory_consumption']) == ['2000', '1001', '1002']
+    assert stats_dict['remaining_capacity']['cpu'] == pytest.approx(40.0)
+    assert stats_dict['remaining_capacity']['memory_kb'] == 729240
+    assert len(stats_dict['remaining_capacity']['cpu_cores']) == 2
+    assert cpu_times['cpu'] == [3000, 10, 1000, 16000, 50, 0, 20, 5]
+
+
+def test_parse_batch_baseline():
+    """
+    Tests that the ``cpu_baseline`` section takes precedence over the
+    counters of the previous query.
+    """
+    output = ['@@vmdiag@@ cpu_baseline\n', 'cpu  2500 10 1000 15500 50 0 20 5 0 0\n'] + BATCH_OUTPUT
+    stats_dict = stats.parse_batch(output, None)[0].as_dict()
+    assert stats_dict['remaining_capacity']['cpu'] == pytest.approx(50.0)
+
+
+
+def test_parse_capacity():
+    """
+    Tests that the remaining capacity alone is computed between two reads
+    of the counters, as on the batched output.
+    """
+    output = ['@@vmdiag@@ cpu_baseline\n', 'cpu  2500 10 1000 15500 50 0 20 5 0 0\n'] + BATCH_OUTPUT[9:]
+    capacity, cpu_times = stats.parse_capacity(output)
+    assert capacity['cpu'] == pytest.approx(50.0)
+    assert capacity['memory_kb'] == 729240
+    assert cpu_times['cpu'] == [3000, 10, 1000, 16000, 50, 0, 20, 5]
+    capacity = stats.parse_capacity(BATCH_OUTPUT[9:], cpu_times)[0]
+    assert capacity['cpu'] == 100.0
+    with pytest.raises(Exception):
+        stats.parse_capacity(BATCH_OUTPUT[9:13])
+
+@pytest.mark.parametrize('count,expected', [
+    (1, ['1001']),
+    (3, ['1001', '1002', '420']),
+    (20, ['1001', '1002', '420', '512', '1003', '2000', '1']),
+])
+def test_top_processes(count, expected):
+    """
+    Tests that processes sharing the same name are reported separately,
+    keyed by PID, and that the requested number of processes is returned.
+
+    Parameters
+    ----------
+    count: int
+        Number of processes to return.
+    expected: list
+        PIDs of the expected processes, from greater to lower CPU.
+    """
+    processes = stats.parse_processes(read_sections(BATCH_OUTPUT)['processes'])
+    assert list(stats.top_processes(processes, 'cpu', count)) == expected
+
+
+def test_top_processes_aggregate():
+    """
+    Tests that the aggregated top adds up the processes with the same name.
+    """
+    processes = stats.parse_processes(read_sections(BATCH_OUTPUT)['processes'])
+    top_dict = stats.top_processes(processes, 'memory', 2, aggregate=True)
+    assert top_dict == {
+        'java': {'count': 1, 'cpu': 0.5, 'memory': 30.1},
+        'python': {'count': 3, 'cpu': 24.3, 'memory': 12.0},
+    }
+    assert list(top_dict) == ['java', 'python']
+
+
+def test_parse_batch_top():
+    """
+    Tests that the top keys are named after the requested number of processes.
+    """
+    stats_dict = stats.parse_batch(BATCH_OUTPUT, top=5, aggregate=True)[0].as_dict()
+    assert list(stats_dict['top_5_cpu_consumption']) == ['python', 'sshd', 'tmux: server', 'java', 'systemd']
+    assert 'top_3_cpu_consumption' not in stats_dict
+
+
+def test_parse_batch_missing_section():
+    """
+    Tests that an incomplete batched output raises an exception.
+    """
+    with pytest.raises(Exception) as error:
+        stats.parse_batch(BATCH_OUTPUT[:-2])
+    assert str(error.value) == 'Missing section in batched output: memory'
+
+
+PROC_OUTPUT = [
+    '@@vmdiag@@ pids\n',
+    '1 (systemd) S 0 1 1 0 -1 4194560 100 0 0 0 50 50 0 0 20 0 1 0 100 170000000 2500 184467 0 0\n',
+    '512 (tmux: server) S 1 512 512 0 -1 4194560 100 0 0 0 400 100 0 0 20 0 1 0 5100 9000000 1000 184467\n',
+    '900 (weird) name)) R 1 900 900 0 -1 4194560 100 0 0 0 9000 1000 0 0 20 0 1 0 90100 9000000 50000 184467\n',
+    '@@vmdiag@@ uptime\n',
+    '1001.00 3500.00\n',
+    '@@vmdiag@@ sysconf\n',
+    '100\n',
+    '4096\n',
+    '@@vmdiag@@ cpu\n',
+    'cpu  3000 10 1000 16000 50 0 20 5 0 0\n',
+    '@@vmdiag@@ memory\n',
+    'MemTotal:        1000000 kB\n',
+    'MemFree:          200000 kB\n',
+    'MemAvailable:     729240 kB\n',
+]
+
+
+def test_parse_meminfo():
+    """
+    Tests that every ``/proc/meminfo`` field is parsed in kB.
+    """
+    meminfo = stats.parse_meminfo(read_sections(PROC_OUTPUT)['memory'])
+    assert meminfo == {'MemTotal': 1000000, 'MemFree': 200000, 'MemAvailable': 729240}
+
+
+def test_parse_proc_processes():
+    """
+    Tests that the process table built from ``/proc/[pid]/stat`` has the
+    same CPU and memory percentages ``ps`` reports, and that process names
+    with spaces or parentheses are kept whole.
+    """
+    processes = stats.parse_proc_processes(read_sections(PROC_OUTPUT)['pids'],
+                                           1001.0, 100, 4096, 1000000)
+    assert list(processes) == [
+        (1, 'systemd', 0.1, 1.0),
+        (512, 'tmux: server', 0.5, 0.4),
+        (900, 'weird) name)', 100.0, 20.0),
+    ]
+
+
+def test_parse_batch_compact():
+    """
+    Tests that the compact ``ps`` backend output yields the same statistics
+    as the plain one.
+    """
+    ps_lines = read_sections(BATCH_OUTPUT)['processes']
+    compact = ['@@vmdiag@@ compact_processes\n', '=systemd\n', '1 0 0.0 1.1\n', '=sshd\n',
+               '419 1 2.0 0.5\n', '=tmux: server\n', '92 2 1.0 0.2\n', '=python\n',
+               '489 3 12.5 4.0\n', '1 3 11.0 4.0\n', '1 3 0.8 4.0\n', '=java\n',
+               '997 4 0.5 30.1\n']
+    output = compact + BATCH_OUTPUT[len(ps_lines) + 1:]
+    host_stats, _ = stats.parse_batch(output)
+    assert host_stats.as_dict() == stats.parse_batch(BATCH_OUTPUT)[0].as_dict()
+    with pytest.raises(Exception) as error:
+        stats.parse_batch(compact)
+    assert str(error.value) == 'Missing section in batched output: cpu'
+
+
+def test_parse_batch_proc():
+    """
+    Tests that the ``proc`` backend output yields every statistic with the
+    same format as the ``ps`` backend.
+    """
+    stats_dict = stats.parse_batch(PROC_OUTPUT)[0].as_dict()
+    assert stats_dict['running_processes'] == ['weird) name)', 'tmux: server', 'systemd']
+    assert list(stats_dict['top_3_memory_consumption']) == ['900', '1', '512']
+    assert stats_dict['remaining_capacity']['memory_kb'] == 729240
+
+
+def test_parse_batch_streamed():
+    """
+    Tests that the output is parsed in a single pass, as it is read, with
+    the ``proc`` process table before or after the sections it needs.
+    """
+    chunks = (chunk.encode('utf-8') for chunk in
+              [''.join(PROC_OUTPUT[4:])[:37], ''.join(PROC_OUTPUT[4:])[37:] + ''.join(PROC_OUTPUT[:4])])
+    streamed = stats.parse_batch(stats.iter_lines(chunks))[0]
+    assert list(streamed.processes) == list(stats.parse_batch(PROC_OUTPUT)[0].processes)
+    lines = iter(BATCH_OUTPUT)
+    assert stats.parse_batch(lines)[0].as_dict() == stats.parse_batch(BATCH_OUTPUT)[0].as_dict()
+    assert next(lines, None) is None
+
+
+def test_iter_lines():
+    """
+    Tests that the lines are rebuilt across chunk boundaries, including the
+    characters split between two chunks, and that only newlines end them.
+    """
+    name = 'caf\u00e9\x0bbar'.encode('utf-8')
+    chunks = [b'  PID\n    1 ', name[:4], name[4:] + b'\n\n', b'last']
+    assert list(stats.iter_lines(chunks)) == ['  PID', '    1 caf\u00e9\x0bbar', '', 'last']
+    assert list(stats.iter_lines([b'a\xff\n'])) == ['a\ufffd']
+    assert list(stats.iter_lines([])) == []
+
+
+def test_iter_sections():
+    """
+    Tests that the sections are split lazily, and that the lines of a
+    section left unread are skipped.
+    """
+    sections = stats.iter_sections(BATCH_OUTPUT)
+    name, lines = next(sections)
+    assert (name, next(lines)) == ('processes', '  PID %CPU %MEM COMMAND')
+    assert [(name, list(lines)) for name, lines in sections] == [
+        ('cpu', [line.rstrip('\n') for line in BATCH_OUTPUT[10:13]]),
+        ('memory', ['MemAvailable:     729240 kB'])]
+
+
+def test_parse_batch_proc_missing_section():
+    """
+    Tests that the ``proc`` backend requires all of its sections.
+    """
+    with pytest.raises(Exception) as error:
+        stats.parse_batch(PROC_OUTPUT[:4] + PROC_OUTPUT[6:])
+    assert str(error.value) == 'Missing section in batched output: uptime'
+
+
+def test_process_table():
+    """
+    Tests that the process table returns the values exactly as they were
+    added and shares the name strings between tables.
+    """
+    first = stats.ProcessTable()
+    second = stats.ProcessTable()
+    first.append(10, ''.join(['py', 'thon']), 12.3, 0.1)
+    second.append(20, ''.join(['pyt', 'hon']), 250.0, 99.9)
+    assert list(first) == [(10, 'python', 12.3, 0.1)]
+    assert list(second) == [(20, 'python', 250.0, 99.9)]
+    assert first.names[0] is second.names[0]
+    assert len(first) == 1
+
+
+def test_as_dict():
+    """
+    Tests the JSON output of the server results and that it can be used as
+    the ``default`` function of ``json.dumps()``.
+    """
+    host_stats, _ = stats.parse_batch(BATCH_OUTPUT)
+    output = json.loads(json.dumps({'10.0.0.1': host_stats}, default=stats.as_dict))
+    assert output['10.0.0.1'] == json.loads(json.dumps(host_stats.as_dict()))
+    assert stats.as_dict({'error': 'timed out'}) == {'error': 'timed out'}
+    with pytest.raises(TypeError):
+        stats.as_dict(object())
+
+
+def test_parse_sampler():
+    """
+    Tests the parsing of the sampler summary, where the remaining capacity
+    is the average CPU and the lowest memory of the window.
+    """
+    summary = {'samples': 50, 'seconds': 5.0, 'cpu': [12.5, 80.0, 99.0], 'cpu_steal': 2.5,
+               'memory_kb': [1000, 1500, 2000],
+               'top_cpu': [[42, 'java', 60.0, 95.5, 20.0]],
+               'top_memory': [[42, 'java', 60.0, 95.5, 20.0]],
+               'processes': ['systemd', 'java']}
+    stats_dict = stats.parse_sampler([json.dumps(summary) + '\n'], top=1)
+    assert stats_dict['remaining_capacity'] == {'cpu': 80.0, 'cpu_steal': 2.5, 'memory_kb': 1000}
+    assert stats_dict['window']['cpu'] == {'min': 12.5, 'avg': 80.0, 'max': 99.0}
+    assert stats_dict['top_1_cpu_consumption'] == {
+        '42': {'name': 'java', 'cpu': 60.0, 'cpu_max': 95.5, 'memory': 20.0}}
+    assert stats_dict['running_processes'] == ['systemd', 'java']
+    with pytest.raises(Exception) as error:
+        stats.parse_sampler(['{"error":"Python not found"}\n'])
+    assert str(error.value) == 'Sampler failed on the server: Python not found'
+    with pytest.raises(Exception) as error:
+        stats.parse_sampler([])
+    assert str(error.value) == 'Invalid sampler output: no output'
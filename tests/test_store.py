@@ -0,0 +1,179 @@
+"""
+Tests for the on-disk sample store.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import os
+import pytest
+from vmdiag import stats, store
+
+
+def make_stats(cpu=80.0, memory_kb=729240):
+    """
+    Builds the usage statistics of a fake server.
+
+    Parameters
+    ----------
+    cpu: float
+        Remaining CPU percentage.
+    memory_kb: int
+        Available memory in kB.
+
+    Returns
+    -------
+    HostStats
+        Statistics with four processes, two of them sharing the same name.
+    """
+    processes = stats.ProcessTable()
+    processes.append(1, 'systemd', 0.0, 1.1)
+    processes.append(1001, 'python', 12.5, 4.0)
+    processes.append(1002, 'python', 11.0, 4.0)
+    processes.append(2000, 'a-very-long-process-name', 0.5, 30.1)
+    capacity = {'cpu': cpu, 'cpu_steal': 0.5, 'cpu_cores': [cpu], 'memory_kb': memory_kb}
+    return stats.HostStats(processes, capacity)
+
+
+def test_encode_decode():
+    """
+    Tests that a sample keeps its capacity and top processes when packed
+    into a fixed-width record.
+    """
+    record = store.encode_sample(1000.5, make_stats())
+    assert len(record) == store.RECORD_SIZE
+    sample = store.decode_sample(record)
+    assert sample['timestamp'] == 1000.5
+    assert sample['remaining_capacity'] == {'cpu': 80.0, 'cpu_steal': 0.5, 'memory_kb': 729240}
+    assert list(sample['top_cpu_consumption']) == ['1001', '1002', '2000']
+    assert sample['top_cpu_consumption']['1001'] == {'name': 'python', 'cpu': 12.5, 'memory': 4.0}
+    assert sample['top_memory_consumption']['2000']['name'] == 'a-very-long-proc'
+
+
+def test_encode_few_processes():
+    """
+    Tests that the unused top slots are not returned.
+    """
+    processes = stats.ProcessTable()
+    processes.append(1, 'init', 0.0, 0.5)
+    host_stats = stats.HostStats(processes, {'cpu': 99.0, 'memory_kb': 100})
+    sample = store.decode_sample(store.encode_sample(1.0, host_stats))
+    assert sample['top_cpu_consumption'] == {'1': {'name': 'init', 'cpu': 0.0, 'memory': 0.5}}
+
+
+
+def test_encode_dictionary():
+    """
+    Tests that the results of the ``commands`` and ``sampler`` backends are
+    stored too, with the top processes added up by name under PID 0.
+    """
+    top_dict = {'java': {'count': 2, 'cpu': 40.0, 'cpu_max': 90.0, 'memory': 12.5},
+                'sshd': {'count': 1, 'cpu': 0.1, 'cpu_max': 0.2, 'memory': 0.3}}
+    stats_dict = {'running_processes': ['java', 'java', 'sshd'],
+                  'top_5_cpu_consumption': top_dict, 'top_5_memory_consumption': top_dict,
+                  'remaining_capacity': {'cpu': 55.0, 'cpu_steal': 1.5, 'memory_kb': 2048}}
+    sample = store.decode_sample(store.encode_sample(2.0, stats_dict))
+    assert sample['remaining_capacity'] == {'cpu': 55.0, 'cpu_steal': 1.5, 'memory_kb': 2048}
+    assert sample['top_cpu_consumption'] == {'java': {'cpu': 40.0, 'memory': 12.5},
+                                             'sshd': {'cpu': 0.1, 'memory': 0.3}}
+
+
+
+def test_encode_aggregate():
+    """
+    Tests that the top processes of a ``HostStats`` added up by name are
+    stored as they are written to the output.
+    """
+    host_stats = make_stats()
+    host_stats.aggregate = True
+    sample = store.decode_sample(store.encode_sample(1.0, host_stats))
+    top_dict = host_stats.as_dict()['top_3_cpu_consumption']
+    assert list(top_dict) == ['python', 'a-very-long-process-name', 'systemd']
+    assert sample['top_cpu_consumption'] == {
+        'python': {'cpu': 23.5, 'memory': 8.0},
+        'a-very-long-proc': {'cpu': 0.5, 'memory': 30.1},
+        'systemd': {'cpu': 0.0, 'memory': 1.1}}
+
+@pytest.fixture
+def sample_store(tmp_path):
+    """
+    Provides a store with segments of 100 seconds holding one sample every
+    10 seconds, from 0 to 290, for two servers.
+
+    Returns
+    -------
+    SampleStore
+        The filled store.
+    """
+    sample_store = store.SampleStore(str(tmp_path), segment_seconds=100, retention=0)
+    for timestamp in range(0, 300, 10):
+        sample_store.append('10.0.0.1', timestamp, make_stats(cpu=timestamp / 10))
+        sample_store.append('10.0.0.2', timestamp, make_stats(memory_kb=timestamp))
+    return sample_store
+
+
+def test_segments(sample_store):
+    """
+    Tests that every server gets its own directory with one segment per period.
+    """
+    assert sample_store.hosts() == ['10.0.0.1', '10.0.0.2']
+    assert sorted(os.listdir(os.path.join(sample_store.path, '10.0.0.1'))) == [
+        '0.seg', '100.seg', '200.seg']
+
+
+@pytest.mark.parametrize('start,end,expected', [
+    (None, None, list(range(0, 300, 10))),
+    (95, 125, [100, 110, 120]),
+    (105, None, list(range(110, 300, 10))),
+    (None, 30, [0, 10, 20, 30]),
+    (300, None, []),
+])
+def test_query(sample_store, start, end, expected):
+    """
+    Tests that only the samples of the requested server and time range are
+    returned, in chronological order.
+
+    Parameters
+    ----------
+    start: float
+        UNIX time of the first sample.
+    end: float
+        UNIX time of the last sample.
+    expected: list
+        Timestamps of the samples that should be returned.
+    """
+    samples = list(sample_store.query('10.0.0.1', start, end))
+    assert [sample['timestamp'] for sample in samples] == expected
+    for sample in samples:
+        assert sample['remaining_capacity']['cpu'] == pytest.approx(sample['timestamp'] / 10)
+
+
+def test_query_unknown_host(sample_store):
+    """
+    Tests that a server without samples returns nothing.
+    """
+    assert list(sample_store.query('10.0.0.3')) == []
+
+
+def test_partial_record(sample_store):
+    """
+    Tests that a record left incomplete is ignored and overwritten by the
+    next sample.
+    """
+    segment_path = os.path.join(sample_store.path, '10.0.0.1', '200.seg')
+    with open(segment_path, 'ab') as segment:
+        segment.write(b'\1' * 10)
+    assert len(list(sample_store.query('10.0.0.1', 200))) == 10
+    sample_store.append('10.0.0.1', 295, make_stats())
+    assert [sample['timestamp'] for sample in sample_store.query('10.0.0.1', 285)] == [290, 295]
+
+
+def test_retention(sample_store):
+    """
+    Tests that the segments whose samples are all older than the retention
+    time are deleted.
+    """
+    sample_store.retention = 150
+    sample_store.enforce_retention(now=300)
+    timestamps = [sample['timestamp'] for sample in sample_store.query('10.0.0.2')]
+    assert timestamps == list(range(100, 300, 10))
@@ -0,0 +1,312 @@
+"""
+Tests for the retries and profiling of the command line tool.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+"""
+
+import json
+import paramiko
+import pytest
+from click.testing import CliRunner
+from vmdiag import profiling, stats, vmdiag
+
+
+def fake_retrieve(errors):
+    """
+    Builds a stand-in for ``retrieve_info()`` that raises the given errors
+    on the first attempts and then succeeds.
+
+    Parameters
+    ----------
+    errors: list
+        Exceptions raised by the successive attempts.
+
+    Returns
+    -------
+    function
+        The fake ``retrieve_info()``, with an ``attempts`` list recording the
+        keyword arguments of every call.
+    """
+    def retrieve(ip_address, username, key, **options):
+        retrieve.attempts.append(options)
+        if len(retrieve.attempts) <= len(errors):
+            raise errors[len(retrieve.attempts) - 1]
+        return {ip_address: {'remaining_capacity': {'cpu': 80.0}}}
+    retrieve.attempts = []
+    return retrieve
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """
+    Records the waits between retries instead of sleeping.
+
+    Returns
+    -------
+    list
+        The times in seconds waited.
+    """
+    waits = []
+    monkeypatch.setattr(vmdiag.time, 'sleep', waits.append)
+    return waits
+
+
+def test_retry_with_backoff(monkeypatch, sleeps):
+    """
+    Tests that timeouts and broken connections are retried, doubling the
+    wait every time.
+    """
+    retrieve = fake_retrieve([TimeoutError('Deadline exceeded'), paramiko.SSHException('Dropped')])
+    monkeypatch.setattr(vmdiag, 'retrieve_info', retrieve)
+    result = vmdiag.retrieve_with_retries('10.0.0.1', 'ubuntu', 'key.pem', retries=2,
+                                          backoff=0.5, deadline=10)
+    assert result == {'10.0.0.1': {'remaining_capacity': {'cpu': 80.0}}}
+    assert sleeps == [0.5, 1.0]
+    assert retrieve.attempts == [{'deadline': 10, 'profile': None}] * 3
+
+
+def test_timeout_status(monkeypatch, sleeps):
+    """
+    Tests that a server timing out on every attempt is reported with a
+    timeout status.
+    """
+    monkeypatch.setattr(vmdiag, 'retrieve_info', fake_retrieve([TimeoutError('Deadline exceeded')] * 2))
+    result = vmdiag.retrieve_with_retries('10.0.0.1', 'ubuntu', 'key.pem', retries=1)
+    assert result['10.0.0.1']['status'] == 'timeout'
+    assert result['10.0.0.1']['error'] == 'Deadline exceeded'
+    assert result['10.0.0.1']['attempts'] == 2
+    assert sleeps == [1.0]
+
+
+@pytest.mark.parametrize('error', [
+    paramiko.SSHException('Dropped'),
+    paramiko.AuthenticationException('Authentication failed.'),
+    paramiko.BadHostKeyException('10.0.0.1', paramiko.RSAKey.generate(1024),
+                                 paramiko.RSAKey.generate(1024)),
+    Exception('Missing section in batched output: cpu'),
+])
+def test_errors_raised(monkeypatch, sleeps, error):
+    """
+    Tests that errors other than timeouts are raised once the retries are
+    exhausted, and that the authentication and host key errors and the
+    errors unrelated to the connection are not retried.
+
+    Parameters
+    ----------
+    error: Exception
+        The error raised by every attempt.
+    """
+    retrieve = fake_retrieve([error] * 2)
+    monkeypatch.setattr(vmdiag, 'retrieve_info', retrieve)
+    with pytest.raises(type(error)):
+        vmdiag.retrieve_with_retries('10.0.0.1', 'ubuntu', 'key.pem', retries=1)
+    assert len(retrieve.attempts) == (2 if type(error) is paramiko.SSHException else 1)
+
+
+def test_profiled_retries(monkeypatch, sleeps):
+    """
+    Tests that the retries are counted on the profile of the server, which
+    is added to its output.
+    """
+    retrieve = fake_retrieve([TimeoutError('Deadline exceeded')])
+    monkeypatch.setattr(vmdiag, 'retrieve_info', retrieve)
+    profiler = profiling.Profiler()
+    result = vmdiag.retrieve_with_retries('10.0.0.1', 'ubuntu', 'key.pem', retries=1,
+                                          profiler=profiler)
+    assert retrieve.attempts[0]['profile'] is profiler.get('10.0.0.1')
+    record = vmdiag.with_profile('10.0.0.1', result['10.0.0.1'], profiler)
+    assert record['remaining_capacity'] == {'cpu': 80.0}
+    assert record['profile']['retries'] == 1
+    assert 'profile' not in result['10.0.0.1']
+
+
+def test_without_profile():
+    """
+    Tests that the usage data is left untouched when profiling is disabled.
+    """
+    host_stats = stats.HostStats(stats.ProcessTable(), {'cpu': 99.0, 'memory_kb': 100})
+    assert vmdiag.with_profile('10.0.0.1', host_stats, None) is host_stats
+    assert vmdiag.with_profile('10.0.0.1', host_stats, profiling.Profiler()) is host_stats
+
+
+@pytest.mark.parametrize('max_interval', [None, 0.05])
+def test_watch_host_stats(monkeypatch, tmp_path, max_interval):
+    """
+    Tests that watch mode writes the compact ``HostStats`` results, on the
+    fixed and on the adaptive schedule.
+
+    Parameters
+    ----------
+    max_interval: float
+        Longest interval of the adaptive schedule, None for a fixed one.
+    """
+    calls = []
+
+    def retrieve(ip_address, username, key, **options):
+        calls.append(ip_address)
+        if len(calls) > 2:
+            raise KeyboardInterrupt
+        host_stats = stats.HostStats(stats.ProcessTable(), {'cpu': 99.0, 'memory_kb': 100})
+        return {ip_address: host_stats}
+
+    monkeypatch.setattr(vmdiag, 'retrieve_info', retrieve)
+    output_path = str(tmp_path / 'watch.ndjson')
+    vmdiag.watch_servers([('10.0.0.1', 'ubuntu', 'key.pem')], 0.01, 1, output_path,
+                         max_interval=max_interval)
+    with open(output_path) as output_file:
+        records = [json.loads(line) for line in output_file]
+    assert len(records) == 2
+    assert records[0]['ip'] == '10.0.0.1'
+    assert records[0]['remaining_capacity'] == {'cpu': 99.0, 'memory_kb': 100}
+
+
+@pytest.mark.parametrize('max_interval, ttl', [(None, 300), (100.0, 300), (400.0, 800)])
+def test_watch_pool_ttl(monkeypatch, max_interval, ttl):
+    """
+    Tests that the connections of watch mode are kept open for twice the
+    longest interval of the schedule.
+
+    Parameters
+    ----------
+    max_interval: float
+        Longest interval of the adaptive schedule, None for a fixed one.
+    ttl: float
+        Expected time the idle connections are kept open.
+    """
+    from vmdiag import pool
+    ttls = []
+
+    class FakePool:
+        def __init__(self, ttl, **kwargs):
+            ttls.append(ttl)
+
+        def close(self):
+            pass
+
+    def watch(*args):
+        raise KeyboardInterrupt
+        yield
+
+    monkeypatch.setattr(pool, 'ConnectionPool', FakePool)
+    monkeypatch.setattr('vmdiag.collector.watch', watch)
+    monkeypatch.setattr('vmdiag.scheduler.AdaptiveScheduler.run', watch)
+    vmdiag.watch_servers([('10.0.0.1', 'ubuntu', 'key.pem')], 10.0, 1, None,
+                         max_interval=max_interval)
+    assert ttls == [ttl]
+
+
+def test_watch_diff(monkeypatch, tmp_path):
+    """
+    Tests that watch mode writes the delta records with ``--diff`` and that
+    ``vmdiag expand`` rebuilds the full records.
+    """
+    calls = []
+
+    def retrieve(ip_address, username, key, **options):
+        calls.append(ip_address)
+        if len(calls) > 3:
+            raise KeyboardInterrupt
+        processes = stats.ProcessTable()
+        processes.append(1, 'systemd', 0.0, 0.1)
+        processes.append(len(calls) + 1, 'python', 10.0, 1.0)
+        return {ip_address: stats.HostStats(processes, {'cpu': 99.0, 'memory_kb': 100})}
+
+    monkeypatch.setattr(vmdiag, 'retrieve_info', retrieve)
+    output_path = str(tmp_path / 'watch.ndjson')
+    result = CliRunner().invoke(vmdiag.main, [
+        'sweep', '10.0.0.1', '--user', 'ubuntu', '--key', 'key.pem', '--watch', '0.01', '--diff',
+        '--known-hosts', str(tmp_path / 'known_hosts'), '--output', output_path])
+    assert result.exit_code == 0, result.output
+    with open(output_path) as output_file:
+        records = [json.loads(line) for line in output_file]
+    assert [('keyframe' in record) for record in records] == [True, False, False]
+    top_change = {'set': {'3': {'name': 'python', 'cpu': 10.0, 'memory': 1.0}}, 'unset': ['2'],
+                  'order': ['3', '1']}
+    assert records[1]['delta'] == {'top_3_cpu_consumption': top_change,
+                                   'top_3_memory_consumption': top_change}
+    result = CliRunner().invoke(vmdiag.main, ['expand', output_path])
+    expanded = [json.loads(line) for line in result.output.splitlines()]
+    assert [record['top_3_memory_consumption'] for record in expanded] == [
+        {str(pid): {'name': 'python', 'cpu': 10.0, 'memory': 1.0},
+         '1': {'name': 'systemd', 'cpu': 0.0, 'memory': 0.1}} for pid in (2, 3, 4)]
+    result = CliRunner().invoke(vmdiag.main, ['sweep', '10.0.0.1', '--user', 'ubuntu',
+                                              '--key', 'key.pem', '--diff'])
+    assert result.output == 'Error: --diff requires --watch\n'
+
+
+def test_check(tmp_path):
+    """
+    Tests that ``vmdiag check`` prints the alerts of a sweep and exits with
+    the code of the most severe one, or 3 if the rules cannot be read.
+    """
+    rules_path = str(tmp_path / 'rules.json')
+    with open(rules_path, 'w') as rules_file:
+        json.dump([{'name': 'low-memory', 'metric': 'memory_kb', 'below': 1000},
+                   {'name': 'down', 'status': 'any', 'severity': 'critical'}], rules_file)
+    results_path = str(tmp_path / 'server_data.json')
+    document = {'10.0.0.1': {'remaining_capacity': {'cpu': 90.0, 'memory_kb': 500}},
+                '10.0.0.2': {'remaining_capacity': {'cpu': 90.0, 'memory_kb': 5000}}}
+    with open(results_path, 'w') as results_file:
+        json.dump(document, results_file)
+    result = CliRunner().invoke(vmdiag.main, ['check', rules_path, results_path])
+    assert result.exit_code == 1, result.output
+    alerts = [json.loads(line) for line in result.output.splitlines() if line.startswith('{')]
+    assert [(alert['ip'], alert['rule']) for alert in alerts] == [('10.0.0.1', 'low-memory')]
+    document['10.0.0.2'] = {'status': 'error', 'error': 'Authentication failed.'}
+    with open(results_path, 'w') as results_file:
+        json.dump(document, results_file)
+    result = CliRunner().invoke(vmdiag.main, ['check', rules_path, results_path])
+    assert result.exit_code == 2
+    result = CliRunner().invoke(vmdiag.main, ['check', rules_path, '-'], input='{}')
+    assert result.exit_code == 0
+    result = CliRunner().invoke(vmdiag.main, ['check', results_path, results_path])
+    assert result.exit_code == 3
+    assert result.output.startswith('Error: Invalid rules')
+
+
+def test_arguments_checked_first(tmp_path):
+    """
+    Tests that invalid arguments are reported before the socket of ``serve``
+    or the sample store of ``sweep`` is created.
+    """
+    socket_path = tmp_path / 'vmdiag.sock'
+    result = CliRunner().invoke(vmdiag.main, [
+        'serve', '10.0.0.1', '--user', 'ubuntu', '--key', 'key.pem', '--socket', str(socket_path),
+        '--backend', 'sampler', '--window', '90', '--known-hosts', str(tmp_path / 'known_hosts')])
+    assert result.output == 'Error: Invalid window. Should be shorter than the deadline\n'
+    assert not socket_path.exists()
+    store_path = tmp_path / 'store'
+    result = CliRunner().invoke(vmdiag.main, [
+        'sweep', '10.0.0.1', '--user', 'ubuntu', '--key', 'key.pem', '--diff',
+        '--store', str(store_path)])
+    assert result.output == 'Error: --diff requires --watch\n'
+    assert not store_path.exists()
+
+
+def test_query_single_address(tmp_path):
+    """
+    Tests that ``query`` rejects a network or a range instead of expanding
+    it.
+    """
+    for target in ['10.0.0.0/8', '10.0.0.1-10.255.255.255']:
+        result = CliRunner().invoke(vmdiag.main, ['query', target, '--store', str(tmp_path)])
+        assert result.output == 'Error: Invalid IP format. Should be XXX.XXX.XXX.XXX\n'
+
+
+def test_sweep_error_after_output(monkeypatch, tmp_path):
+    """
+    Tests that an error raised once the results are being written goes to
+    the standard error, leaving a valid JSON document on the standard
+    output.
+    """
+    def collect(targets, retrieve, concurrency):
+        yield '10.0.0.1', ({'remaining_capacity': {'cpu': 80.0}}, None)
+        raise Exception('Worker died')
+
+    monkeypatch.setattr('vmdiag.collector.collect', collect)
+    result = CliRunner(mix_stderr=False).invoke(vmdiag.main, [
+        'sweep', '10.0.0.1', '--user', 'ubuntu', '--key', 'key.pem',
+        '--known-hosts', str(tmp_path / 'known_hosts'), '--output', str(tmp_path / 'out.json')])
+    assert json.loads(result.stdout) == {'10.0.0.1': {'remaining_capacity': {'cpu': 80.0}}}
+    assert result.stderr == 'Error: Worker died\n'
@@ -0,0 +1,243 @@
+"""
+Concurrent collection engine used to query several servers at the same time.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Notes
+-----
+    The engine is agnostic of how a single host is queried: it receives the
+    function that retrieves the data of one server and runs it on a bounded
+    thread pool, so at most ``concurrency`` SSH sessions are open at once.
+
+    ``watch()`` repeats the sweep on a fixed cadence. The sample times are
+    aligned to the time the first sweep started, so the time spent querying
+    the servers does not accumulate as drift.
+
+    ``collect_sharded()`` spreads the hosts across several worker processes,
+    each running its own thread pool, for fleets large enough to keep one
+    core busy with the SSH cryptography and the parsing.
+"""
+
+import itertools
+import multiprocessing
+import threading
+import time
+from concurrent import futures
+from multiprocessing import connection
+
+
+def collect(targets, retrieve, concurrency=10):
+    """
+    Runs ``retrieve`` for every target on a bounded thread pool and yields
+    each result as soon as its host finishes.
+
+    Notes
+    -----
+        * The targets are consumed lazily: a new target is only taken from the
+          iterable when one of the in-flight hosts finishes.
+        * The results are yielded in completion order, not in input order.
+        * If ``retrieve`` raises an exception, it is raised again when the
+          result of that host is yielded.
+
+    Parameters
+    ----------
+    targets: iterable
+        Iterable of ``(ip_address, username, key)`` tuples.
+    retrieve: function
+        Function called as ``retrieve(ip_address, username, key)`` that
+        returns the usage data of a single server.
+    concurrency: int
+        Maximum number of servers queried at the same time.
+
+    Yields
+    ------
+    tuple
+        A ``(ip_address, result)`` tuple for every target.
+
+    Raises
+    ------
+    Exception
+        Invalid concurrency. Should be at least 1
+    """
+    if concurrency < 1:
+        raise Exception('Invalid concurrency. Should be at least 1')
+    targets = iter(targets)
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = {}
+        for target in itertools.islice(targets, concurrency):
+            pending[executor.submit(retrieve, *target)] = target
+        while pending:
+            done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                target = pending.pop(future)
+                for next_target in itertools.islice(targets, 1):
+                    pending[executor.submit(retrieve, *next_target)] = next_target
+                yield target[0], future.result()
+
+
+def _shard_worker(tasks, results, retrieve, concurrency):
+    """
+    Runs ``collect()`` on the targets taken from the shared task queue until
+    it gets None, sending every ``(ip_address, result)`` tuple through the
+    results pipe. An exception is sent as an ``(None, message)`` tuple.
+    """
+    try:
+        for ip_address, result in collect(iter(tasks.get, None), retrieve, concurrency):
+            results.send((ip_address, result))
+    except Exception as error:
+        results.send((None, str(error)))
+    finally:
+        results.close()
+
+
+def _feed(tasks, targets, workers):
+    """
+    Puts every target on the task queue, and then one None per worker.
+    """
+    for target in targets:
+        tasks.put(target)
+    for _ in range(workers):
+        tasks.put(None)
+
+
+def collect_sharded(targets, retrieve, concurrency=10, workers=2):
+    """
+    Runs ``retrieve`` for every target on a pool of worker processes, each
+    one with its own bounded thread pool, and yields each result as soon as
+    its host finishes.
+
+    Notes
+    -----
+        * The targets are handed out through a shared queue, so a worker
+          takes a new target when one of its hosts finishes and a shard of
+          slow hosts does not hold the others back.
+        * ``concurrency`` is the total for all the workers, split evenly
+          across them. There are never more workers than ``concurrency``.
+        * ``retrieve`` and the results are sent between processes, so they
+          must be picklable: use a module level function, or a
+          ``functools.partial()`` of one. State kept by ``retrieve`` stays on
+          the worker that ran it.
+        * If ``retrieve`` raises an exception, an ``Exception`` with the same
+          message is raised when the result of that host would have been
+          yielded, and the workers are stopped.
+
+    Parameters
+    ----------
+    targets: iterable
+        Iterable of ``(ip_address, username, key)`` tuples.
+    retrieve: function
+        Function called as ``retrieve(ip_address, username, key)`` that
+        returns the usage data of a single server.
+    concurrency: int
+        Maximum number of servers queried at the same time.
+    workers: int
+        Number of worker processes.
+
+    Yields
+    ------
+    tuple
+        A ``(ip_address, result)`` tuple for every target.
+
+    Raises
+    ------
+    Exception
+        Invalid number of workers. Should be at least 1
+    """
+    if workers < 1:
+        raise Exception('Invalid number of workers. Should be at least 1')
+    if concurrency < 1:
+        raise Exception('Invalid concurrency. Should be at least 1')
+    workers = min(workers, concurrency)
+    context = multiprocessing.get_context()
+    tasks = context.SimpleQueue()
+    processes = {}
+    try:
+        for index in range(workers):
+            reader, writer = context.Pipe(duplex=False)
+            shard_concurrency = concurrency // workers + (index < concurrency % workers)
+            process = context.Process(target=_shard_worker,
+                                      args=(tasks, writer, retrieve, shard_concurrency))
+            process.daemon = True
+            process.start()
+            # Only the worker keeps the writing end, so the reader gets EOF
+            # when the worker exits:
+            writer.close()
+            processes[reader] = process
+        feeder = threading.Thread(target=_feed, args=(tasks, targets, workers))
+        feeder.daemon = True
+        feeder.start()
+        readers = list(processes)
+        while readers:
+            for reader in connection.wait(readers):
+                try:
+                    ip_address, result = reader.recv()
+                except EOFError:
+                    readers.remove(reader)
+                    process = processes[reader]
+                    process.join()
+                    if process.exitcode:
+                        raise Exception('Worker process exited with code %d' % process.exitcode)
+                    continue
+                if ip_address is None:
+                    raise Exception(result)
+                yield ip_address, result
+    finally:
+        for reader, process in processes.items():
+            if process.is_alive():
+                process.terminate()
+            process.join()
+            reader.close()
+
+
+def watch(targets, retrieve, interval, concurrency=10, samples=None):
+    """
+    Sweeps the targets every ``interval`` seconds and yields every result
+    as soon as its host finishes.
+
+    Notes
+    -----
+        * Every sweep starts at ``start + k * interval``. If a sweep takes
+          longer than the interval, the missed sample times are skipped
+          instead of running the sweeps back to back.
+
+    Parameters
+    ----------
+    targets: iterable
+        Iterable of ``(ip_address, username, key)`` tuples.
+    retrieve: function
+        Function called as ``retrieve(ip_address, username, key)`` that
+        returns the usage data of a single server.
+    interval: float
+        Time in seconds between the start of two consecutive sweeps.
+    concurrency: int
+        Maximum number of servers queried at the same time.
+    samples: int
+        Number of sweeps to run. If not given, sweeps run forever.
+
+    Yields
+    ------
+    tuple
+        A ``(timestamp, ip_address, result)`` tuple for every target on every
+        sweep, where ``timestamp`` is the UNIX time the sweep started.
+
+    Raises
+    ------
+    Exception
+        Invalid interval. Should be greater than 0
+    """
+    if interval <= 0:
+        raise Exception('Invalid interval. Should be greater than 0')
+    targets = list(targets)
+    start = time.monotonic()
+    sample_count = 0
+    while True:
+        timestamp = time.time()
+        for ip_address, result in collect(targets, retrieve, concurrency):
+            yield timestamp, ip_address, result
+        sample_count += 1
+        if samples is not None and sample_count >= samples:
+            return
+        elapsed = time.monotonic() - start
+        next_sample = start + (int(elapsed // interval) + 1) * interval
+        time.sleep(max(0, next_sample - time.monotonic()))
@@ -0,0 +1,118 @@
+"""
+On-disk copy of the last ``/proc/stat`` counters read from every server, so
+a one-shot sweep measures the CPU usage against the previous sweep.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Notes
+-----
+    Without previous counters, the first query to a server reads them twice,
+    one second apart (see ``stats.CPU_BASELINE_SECTION``). Watch mode and the
+    daemon keep the counters on the pooled connections; a sweep run from cron
+    starts a new connection to every server, so it would pay that second on
+    every server and every run. The counters of every server are kept on
+    their own small file, so the worker processes of a sharded sweep write
+    them without sharing any file.
+"""
+
+import json
+import os
+import time
+
+DEFAULT_DIRECTORY = '~/.vmdiag/cpu_times'
+"""
+string: Default directory of the counters, next to the default known hosts
+file.
+"""
+
+MAX_AGE = 3600
+"""
+int: Seconds the counters of a server are used for. The CPU usage is
+averaged over the time since they were read, so older counters are ignored
+and the server is measured over one second instead.
+"""
+
+
+class CpuCounters:
+    """
+    Last ``/proc/stat`` counters of every server, one file per server.
+
+    Notes
+    -----
+        * Pickling keeps the directory and the maximum age only, so a copy
+          sent to a worker process reads and writes the same files.
+
+    Parameters
+    ----------
+    directory: string
+        Directory of the files. Created when the first counters are saved.
+    max_age: float
+        Seconds the saved counters are used for.
+
+    Attributes
+    ----------
+    directory: string
+        Directory of the files.
+    max_age: float
+        Seconds the saved counters are used for.
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_age=MAX_AGE):
+        self.directory = os.path.expanduser(directory)
+        self.max_age = max_age
+
+    def __reduce__(self):
+        return (CpuCounters, (self.directory, self.max_age))
+
+    def load(self, ip_address):
+        """
+        Returns the counters last saved for a server.
+
+        Parameters
+        ----------
+        ip_address: string
+            IPv4 address of the server.
+
+        Returns
+        -------
+        dictionary
+            The counters, as returned by ``stats.parse_cpu_times()``, or None
+            if there are none younger than ``max_age``, or the file cannot be
+            read.
+        """
+        try:
+            with open(os.path.join(self.directory, ip_address)) as counters_file:
+                saved = json.load(counters_file)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(saved, dict):
+            return None
+        if not 0 <= time.time() - saved.get('timestamp', 0) <= self.max_age:
+            return None
+        return saved.get('cpu_times')
+
+    def save(self, ip_address, cpu_times):
+        """
+        Saves the counters read from a server, replacing the previous ones.
+        Errors writing them are ignored: the next sweep measures the server
+        over one second instead.
+
+        Parameters
+        ----------
+        ip_address: string
+            IPv4 address of the server.
+        cpu_times: dictionary
+            The counters, as returned by ``stats.parse_cpu_times()``.
+        """
+        path = os.path.join(self.directory, ip_address)
+        partial_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(partial_path, 'w') as counters_file:
+                json.dump({'timestamp': time.time(), 'cpu_times': cpu_times}, counters_file,
+                          separators=(',', ':'))
+            # A reader sees the previous file or the new one, never half of it:
+            os.replace(partial_path, path)
+        except OSError:
+            pass
@@ -0,0 +1,233 @@
+"""
+Caches of the private keys and the server host keys shared by every
+``Server`` instance.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Notes
+-----
+    Every private key file is read and parsed once, no matter how many
+    servers use it, and the parsed key is shared by every thread. The key
+    type (RSA, ECDSA or Ed25519) is detected from the file. The ``agent`` key
+    path uses the keys of the running ``ssh-agent`` instead of a file.
+
+    The host keys of the servers are kept on a known hosts file, with the
+    OpenSSH format. The first time a server is seen its key is added to the
+    file; from then on, a server presenting a different key is rejected.
+
+    ``paramiko`` is only imported when a key or a known hosts file is read,
+    so the command line can use the constants of this module without paying
+    for its import.
+"""
+
+import os
+import threading
+
+AGENT = 'agent'
+"""
+string: Key path that means authenticating with the ``ssh-agent`` keys.
+"""
+
+KEY_CLASSES = ['RSAKey', 'ECDSAKey', 'Ed25519Key']
+"""
+list: Names of the ``paramiko`` private key types tried, in order, when
+loading a key file.
+"""
+
+DEFAULT_KNOWN_HOSTS = os.path.join('~', '.vmdiag', 'known_hosts')
+"""
+string: Default path of the known hosts file.
+"""
+
+
+def load_key(path):
+    """
+    Reads a private key file of any of the ``KEY_CLASSES`` types.
+
+    Parameters
+    ----------
+    path: string
+        Path of the private key file.
+
+    Returns
+    -------
+    PKey
+        The parsed private key.
+
+    Raises
+    ------
+    Exception
+        Invalid private key. Should be an RSA, ECDSA or Ed25519 key
+    """
+    import paramiko
+    for class_name in KEY_CLASSES:
+        try:
+            return getattr(paramiko, class_name).from_private_key_file(path)
+        except paramiko.SSHException:
+            continue
+    raise Exception('Invalid private key. Should be an RSA, ECDSA or Ed25519 key: %s' % path)
+
+
+class KeyCache:
+    """
+    Loads every private key file once and shares the parsed keys.
+
+    Attributes
+    ----------
+    loads: int
+        Number of key files read and parsed so far.
+    """
+
+    def __init__(self):
+        self.loads = 0
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Returns the parsed private key of a file, reading it on the first
+        call only.
+
+        Parameters
+        ----------
+        path: string
+            Path of the private key file, or ``AGENT``.
+
+        Returns
+        -------
+        PKey
+            The parsed private key, or None for ``AGENT``.
+        """
+        if path == AGENT:
+            return None
+        path = os.path.abspath(os.path.expanduser(path))
+        with self._lock:
+            if path not in self._keys:
+                self._keys[path] = load_key(path)
+                self.loads += 1
+            return self._keys[path]
+
+
+KEYS = KeyCache()
+"""
+KeyCache: Key cache shared by every ``Server`` instance.
+"""
+
+
+class KnownHosts:
+    """
+    Host keys of the servers, persisted on a known hosts file.
+
+    Notes
+    -----
+        * Hashed host names on the file are ignored: vmdiag writes the plain
+          addresses, so a file shared with OpenSSH should not hash them.
+        * Pickling keeps the path only: a copy sent to a worker process reads
+          the file again, and the keys it adds are appended to the same file.
+
+    Parameters
+    ----------
+    path: string
+        Path of the known hosts file. Created, with its directory, when the
+        first host key is added.
+
+    Attributes
+    ----------
+    path: string
+        Path of the known hosts file.
+    """
+
+    def __init__(self, path=DEFAULT_KNOWN_HOSTS):
+        self.path = os.path.expanduser(path)
+        self._keys = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            import paramiko
+            with open(self.path) as known_hosts_file:
+                for line in known_hosts_file:
+                    if not line.strip() or line.startswith('#'):
+                        continue
+                    try:
+                        entry = paramiko.hostkeys.HostKeyEntry.from_line(line)
+                    except paramiko.SSHException:
+                        entry = None
+                    if entry is None:
+                        continue
+                    for hostname in entry.hostnames:
+                        self._keys.setdefault(hostname, {})[entry.key.get_name()] = entry.key
+
+    def __reduce__(self):
+        return (KnownHosts, (self.path,))
+
+    def lookup(self, hostname):
+        """
+        Returns the known keys of a server.
+
+        Parameters
+        ----------
+        hostname: string
+            Host name as given by paramiko: the address, or ``[address]:port``
+            for ports other than 22.
+
+        Returns
+        -------
+        dictionary
+            The keys of the server keyed by key type, empty if unknown.
+        """
+        with self._lock:
+            return dict(self._keys.get(hostname, {}))
+
+    def add(self, hostname, key):
+        """
+        Adds the key of a server and appends it to the known hosts file.
+
+        Parameters
+        ----------
+        hostname: string
+            Host name as given by paramiko.
+        key: PKey
+            Host key presented by the server.
+        """
+        with self._lock:
+            self._keys.setdefault(hostname, {})[key.get_name()] = key
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a') as known_hosts_file:
+                known_hosts_file.write('%s %s %s\n' % (hostname, key.get_name(), key.get_base64()))
+
+    def attach(self, client, hostname):
+        """
+        Makes an SSH client verify a server against the known keys, trusting
+        and saving its key if the server was never seen before.
+
+        Parameters
+        ----------
+        client: SSHClient
+            Client about to connect to the server.
+        hostname: string
+            Host name as given by paramiko.
+        """
+        host_keys = client.get_host_keys()
+        for key_type, key in self.lookup(hostname).items():
+            host_keys.add(hostname, key_type, key)
+        client.set_missing_host_key_policy(TrustOnFirstUsePolicy(self))
+
+
+class TrustOnFirstUsePolicy:
+    """
+    Missing host key policy of ``paramiko`` that accepts the key of a server
+    never seen before and saves it on the known hosts.
+
+    Parameters
+    ----------
+    known_hosts: KnownHosts
+        Where the new host keys are saved.
+    """
+
+    def __init__(self, known_hosts):
+        self.known_hosts = known_hosts
+
+    def missing_host_key(self, client, hostname, key):
+        self.known_hosts.add(hostname, key)
@@ -0,0 +1,268 @@
+"""
+Collector daemon: keeps the latest result of every server in a cache and
+serves it to any number of clients.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Notes
+-----
+    The daemon samples every server on a fixed cadence, reusing its SSH
+    connection, so the servers are queried once per interval however many
+    clients ask for their data. A result is served until it is older than the
+    TTL of the cache: a server that stops answering drops out of the answers
+    instead of being reported with old data.
+
+    The cache is served over HTTP, on a TCP address or on a Unix socket:
+
+        * ``GET /hosts``: the fresh result of every server, keyed by IP
+          address.
+        * ``GET /hosts/<ip>``: the fresh result of one server, or ``404`` if
+          there is none.
+
+    Every result is a JSON object with the ``timestamp`` of its sample and
+    the usage data, or the error status, of the server. The results are
+    encoded once, when they are cached, not on every request.
+"""
+
+import http.server
+import json
+import os
+import socket
+import socketserver
+import stat
+import threading
+import time
+from vmdiag import collector, stats
+
+
+class SnapshotCache:
+    """
+    Latest result of every server, dropped once older than a TTL.
+
+    Parameters
+    ----------
+    ttl: float
+        Time in seconds a result is served after its sample was taken.
+
+    Attributes
+    ----------
+    ttl: float
+        Time in seconds a result is served after its sample was taken.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def put(self, ip_address, timestamp, result):
+        """
+        Replaces the result of a server.
+
+        Parameters
+        ----------
+        ip_address: string
+            IPv4 address of the server.
+        timestamp: float
+            UNIX time the sample was taken.
+        result: HostStats or dictionary
+            The usage data, or the error status, of the server.
+        """
+        record = {'timestamp': timestamp}
+        record.update(stats.as_dict(result))
+        text = json.dumps(record, separators=(',', ':'))
+        with self._lock:
+            self._entries[ip_address] = (timestamp, text)
+
+    def get(self, ip_address, now=None):
+        """
+        Returns the result of a server, if it is fresh.
+
+        Parameters
+        ----------
+        ip_address: string
+            IPv4 address of the server.
+        now: float
+            Current UNIX time. Defaults to ``time.time()``.
+
+        Returns
+        -------
+        string
+            The result encoded as JSON, or None if the server has no result
+            younger than the TTL.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(ip_address)
+        if entry is None or now - entry[0] > self.ttl:
+            return None
+        return entry[1]
+
+    def snapshot(self, now=None):
+        """
+        Returns the fresh results of every server.
+
+        Parameters
+        ----------
+        now: float
+            Current UNIX time. Defaults to ``time.time()``.
+
+        Returns
+        -------
+        string
+            A JSON object with the results keyed by IP address.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            entries = list(self._entries.items())
+        return '{%s}' % ','.join('%s:%s' % (json.dumps(ip_address), text)
+                                 for ip_address, (timestamp, text) in entries
+                                 if now - timestamp <= self.ttl)
+
+
+def refresh(cache, targets, retrieve, interval, concurrency=10, samples=None):
+    """
+    Samples the servers every ``interval`` seconds and puts every result in
+    the cache. See ``collector.watch()``.
+
+    Parameters
+    ----------
+    cache: SnapshotCache
+        Where the results are kept.
+    targets: iterable
+        Iterable of ``(ip_address, username, key)`` tuples.
+    retrieve: function
+        Function called as ``retrieve(ip_address, username, key)`` that
+        returns the usage data, or the error status, of a single server.
+    interval: float
+        Time in seconds between the start of two consecutive samples.
+    concurrency: int
+        Maximum number of servers queried at the same time.
+    samples: int
+        Number of samples to take. If not given, runs forever.
+    """
+    for timestamp, ip_address, result in collector.watch(targets, retrieve, interval,
+                                                         concurrency, samples):
+        cache.put(ip_address, timestamp, result)
+
+
+class SnapshotHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers the ``GET`` requests from the cache of the server.
+    """
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0].rstrip('/')
+        if path == '/hosts':
+            self._reply(200, self.server.cache.snapshot())
+        elif path.startswith('/hosts/'):
+            text = self.server.cache.get(path[len('/hosts/'):])
+            if text is None:
+                self._reply(404, json.dumps({'error': 'No fresh sample of the server'}))
+            else:
+                self._reply(200, text)
+        else:
+            self._reply(404, json.dumps({'error': 'Not found'}))
+
+    def _reply(self, status, text):
+        """
+        Sends a JSON response.
+        """
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Clients of a Unix socket have no address:
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SnapshotServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    HTTP server of a cache on a TCP address.
+
+    Parameters
+    ----------
+    address: tuple
+        ``(host, port)`` to listen on. Port 0 picks a free port.
+    cache: SnapshotCache
+        The cache served.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, cache):
+        self.cache = cache
+        super().__init__(address, SnapshotHandler)
+
+
+class UnixSnapshotServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    HTTP server of a cache on a Unix socket. A socket file left behind by a
+    previous daemon is replaced, and the file is removed on close. Any other
+    file at the path, or a socket some process still listens on, is left
+    alone and raises an exception.
+
+    Parameters
+    ----------
+    path: string
+        Path of the Unix socket.
+    cache: SnapshotCache
+        The cache served.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, cache):
+        self.cache = cache
+        self.bound = False
+        remove_stale_socket(path)
+        super().__init__(path, SnapshotHandler)
+
+    def server_bind(self):
+        super().server_bind()
+        self.bound = True
+
+    def server_close(self):
+        super().server_close()
+        if self.bound and os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def remove_stale_socket(path):
+    """
+    Removes the socket file left behind by a daemon that is no longer
+    running.
+
+    Parameters
+    ----------
+    path: string
+        Path of the Unix socket.
+
+    Raises
+    ------
+    Exception
+        If the path is not a socket, or a process still listens on it.
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise Exception('%s exists and is not a socket' % path)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except ConnectionRefusedError:
+        os.remove(path)
+        return
+    finally:
+        client.close()
+    raise Exception('%s is in use by another process' % path)
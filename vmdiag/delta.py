@@ -0,0 +1,343 @@
+"""
+Incremental output of the watch mode: writes only what changed on every
+server since its previous sample.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Notes
+-----
+    Every sample of a server is written either as a keyframe, the full
+    record with a ``keyframe`` key set to true, or as a delta record with
+    its ``timestamp``, its ``ip`` and a ``delta`` key holding the change of
+    every key that changed since the previous record of the server:
+
+        * ``{"added": [...], "removed": [...]}`` for the process names of
+          ``running_processes``.
+        * ``{"set": {...}, "unset": [...], "order": [...]}`` for the
+          dictionaries, such as the top processes: the entries that changed
+          or are new, the entries that are gone and, only if it changed, the
+          order of the keys.
+        * ``{"value": ...}`` for any other value, or a new key.
+        * ``null`` for a key that is gone.
+
+    The remaining capacity only changes when a value moves more than a
+    threshold away from the last value written, so a server whose CPU
+    wanders around the same value produces empty deltas. The threshold is
+    in percentage points for the CPU values, and in percent of the last
+    value written for the others.
+
+    A server gets a keyframe on its first sample, every ``keyframe``
+    samples, and whenever its delta would be larger than the full record,
+    so a consumer joining the stream only waits for the next keyframe of
+    every server and the deltas never cost more than the full output.
+    ``DeltaDecoder`` rebuilds the full records.
+
+    The order of ``running_processes`` is only kept on the keyframes: the
+    deltas rebuild the same process names, with the new ones at the end.
+"""
+
+import collections
+import json
+
+RECORD_KEYS = ('timestamp', 'ip')
+"""
+tuple: Keys written on every record, not compared between samples.
+"""
+
+THRESHOLD_KEYS = ('remaining_capacity',)
+"""
+tuple: Keys whose numbers only change when they move more than the
+threshold.
+"""
+
+
+def _exceeds(key, previous, current, threshold):
+    """
+    Tells whether a value of the remaining capacity moved more than the
+    threshold. Lists are compared element by element.
+    """
+    if isinstance(previous, list) and isinstance(current, list) and len(previous) == len(current):
+        return any(_exceeds(key, prev, curr, threshold) for prev, curr in zip(previous, current))
+    numbers = (int, float)
+    if (not isinstance(previous, numbers) or not isinstance(current, numbers)
+            or isinstance(previous, bool) or isinstance(current, bool)):
+        return previous != current
+    if key.startswith('cpu'):
+        return abs(current - previous) > threshold
+    return abs(current - previous) > threshold / 100 * abs(previous)
+
+
+def diff_dict(previous, current, threshold=None):
+    """
+    Computes the change between two dictionaries.
+
+    Parameters
+    ----------
+    previous: dictionary
+        Last value written.
+    current: dictionary
+        New value.
+    threshold: float
+        Change below which the numbers are left as they were written, see
+        the notes of the module. If not given, every change counts.
+
+    Returns
+    -------
+    dictionary
+        The ``set``, ``unset`` and ``order`` keys that are not empty.
+    """
+    change = {}
+    updated = {}
+    for key, value in current.items():
+        if key not in previous:
+            updated[key] = value
+        elif threshold is None:
+            if previous[key] != value:
+                updated[key] = value
+        elif _exceeds(key, previous[key], value, threshold):
+            updated[key] = value
+    if updated:
+        change['set'] = updated
+    removed = [key for key in previous if key not in current]
+    if removed:
+        change['unset'] = removed
+    kept = [key for key in previous if key in current]
+    if kept + [key for key in current if key not in previous] != list(current):
+        change['order'] = list(current)
+    return change
+
+
+def patch_dict(previous, change):
+    """
+    Applies a change computed by ``diff_dict()``.
+
+    Parameters
+    ----------
+    previous: dictionary
+        Value the change was computed against.
+    change: dictionary
+        The change.
+
+    Returns
+    -------
+    dictionary
+        The new value.
+    """
+    result = dict(previous)
+    for key in change.get('unset', []):
+        result.pop(key, None)
+    result.update(change.get('set', {}))
+    if 'order' in change:
+        result = dict((key, result[key]) for key in change['order'])
+    return result
+
+
+def diff_list(previous, current):
+    """
+    Computes the change between two lists of names, as a multiset.
+
+    Returns
+    -------
+    dictionary
+        The ``added`` and ``removed`` names, or an empty dictionary if the
+        same names are in both lists.
+    """
+    counts = collections.Counter(current)
+    counts.subtract(previous)
+    added = [name for name, count in counts.items() for _ in range(count) if count > 0]
+    removed = [name for name, count in counts.items() for _ in range(-count) if count < 0]
+    if not added and not removed:
+        return {}
+    return {'added': added, 'removed': removed}
+
+
+def patch_list(previous, change):
+    """
+    Applies a change computed by ``diff_list()``. The removed names are taken
+    out where they were and the added ones appended.
+    """
+    pending = collections.Counter(change['removed'])
+    result = []
+    for name in previous:
+        if pending[name]:
+            pending[name] -= 1
+        else:
+            result.append(name)
+    return result + change['added']
+
+
+def diff_record(previous, current, threshold=1.0):
+    """
+    Computes the change of every key between two records of a server.
+
+    Parameters
+    ----------
+    previous: dictionary
+        Last record written, as rebuilt by a consumer.
+    current: dictionary
+        New record.
+    threshold: float
+        Change of the remaining capacity below which it is not written.
+
+    Returns
+    -------
+    dictionary
+        The change of every key that changed, see the notes of the module.
+    """
+    delta = {}
+    for key, value in current.items():
+        if key in RECORD_KEYS:
+            continue
+        if key not in previous:
+            delta[key] = {'value': value}
+            continue
+        old = previous[key]
+        if isinstance(old, list) and isinstance(value, list):
+            change = diff_list(old, value)
+        elif isinstance(old, dict) and isinstance(value, dict):
+            change = diff_dict(old, value, threshold if key in THRESHOLD_KEYS else None)
+        elif old != value:
+            change = {'value': value}
+        else:
+            change = None
+        if change:
+            delta[key] = change
+    for key in previous:
+        if key not in current and key not in RECORD_KEYS:
+            delta[key] = None
+    return delta
+
+
+def patch_record(previous, delta):
+    """
+    Applies a change computed by ``diff_record()``.
+
+    Parameters
+    ----------
+    previous: dictionary
+        Record the change was computed against.
+    delta: dictionary
+        The change.
+
+    Returns
+    -------
+    dictionary
+        The new record, without the ``timestamp`` and ``ip`` keys.
+    """
+    record = dict((key, value) for key, value in previous.items() if key not in RECORD_KEYS)
+    for key, change in delta.items():
+        if change is None:
+            record.pop(key, None)
+        elif 'value' in change:
+            record[key] = change['value']
+        elif 'added' in change:
+            record[key] = patch_list(record[key], change)
+        else:
+            record[key] = patch_dict(record[key], change)
+    return record
+
+
+class DeltaEncoder:
+    """
+    Turns the records of the watch mode into keyframes and delta records.
+
+    Parameters
+    ----------
+    keyframe: int
+        Number of samples of a server between two keyframes, at most.
+    threshold: float
+        Change of the remaining capacity below which it is not written.
+
+    Attributes
+    ----------
+    keyframe: int
+        Number of samples of a server between two keyframes, at most.
+    threshold: float
+        Change of the remaining capacity below which it is not written.
+
+    Raises
+    ------
+    Exception
+        Invalid keyframe interval. Should be at least 1
+    """
+
+    def __init__(self, keyframe=20, threshold=1.0):
+        if keyframe < 1:
+            raise Exception('Invalid keyframe interval. Should be at least 1')
+        self.keyframe = keyframe
+        self.threshold = threshold
+        # Last record of every server as rebuilt by the consumers, and the
+        # number of deltas written since its last keyframe:
+        self._states = {}
+        self._deltas = {}
+
+    def encode(self, record):
+        """
+        Encodes the next record of a server.
+
+        Parameters
+        ----------
+        record: dictionary
+            Full record, with the ``timestamp`` and the ``ip`` of the server.
+
+        Returns
+        -------
+        dictionary
+            The record to write: a keyframe or a delta record.
+        """
+        ip_address = record['ip']
+        previous = self._states.get(ip_address)
+        if previous is not None and self._deltas[ip_address] + 1 < self.keyframe:
+            delta = diff_record(previous, record, self.threshold)
+            delta_record = {'timestamp': record['timestamp'], 'ip': ip_address, 'delta': delta}
+            if len(json.dumps(delta_record, separators=(',', ':'))) < len(
+                    json.dumps(record, separators=(',', ':'))):
+                self._states[ip_address] = patch_record(previous, delta)
+                self._deltas[ip_address] += 1
+                return delta_record
+        self._states[ip_address] = patch_record(record, {})
+        self._deltas[ip_address] = 0
+        keyframe = {'timestamp': record['timestamp'], 'ip': ip_address, 'keyframe': True}
+        keyframe.update((key, value) for key, value in record.items() if key not in RECORD_KEYS)
+        return keyframe
+
+
+class DeltaDecoder:
+    """
+    Rebuilds the full records from the keyframes and delta records written
+    by ``DeltaEncoder``.
+    """
+
+    def __init__(self):
+        self._states = {}
+
+    def decode(self, record):
+        """
+        Decodes the next record of a server.
+
+        Parameters
+        ----------
+        record: dictionary
+            Keyframe or delta record. Records without a ``delta`` key are
+            taken as keyframes, so full records are decoded as they are.
+
+        Returns
+        -------
+        dictionary
+            The full record, or None for a delta record of a server whose
+            first keyframe was not decoded yet.
+        """
+        ip_address = record['ip']
+        if 'delta' in record:
+            previous = self._states.get(ip_address)
+            if previous is None:
+                return None
+            state = patch_record(previous, record['delta'])
+        else:
+            state = dict((key, value) for key, value in record.items()
+                         if key not in RECORD_KEYS and key != 'keyframe')
+        self._states[ip_address] = state
+        full = {'timestamp': record['timestamp'], 'ip': ip_address}
+        full.update(state)
+        return full
@@ -0,0 +1,134 @@
+"""
+Incremental JSON writer for the results of a sweep.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Notes
+-----
+    Every server is written as soon as its result is available instead of
+    building the whole document in memory first, so the first results show up
+    right away and the memory used does not grow with the number of servers.
+    The servers are written in completion order.
+
+    A fleet summary (see ``rollup``) can be written after the servers: under
+    the ``fleet`` key of the ``json`` document, or as a last ``ndjson`` line
+    with a ``fleet`` key instead of an ``ip``.
+"""
+
+import json
+from vmdiag import stats
+
+FORMATS = ['json', 'ndjson']
+"""
+list: Available output formats. ``json`` writes one JSON object keyed by IP
+address, ``ndjson`` writes one JSON line per server.
+"""
+
+INDENT = 4
+"""
+int: Number of spaces used to indent the ``json`` format when not compact.
+"""
+
+
+class JsonWriter:
+    """
+    Writes the results of a sweep to one or more streams as they arrive.
+
+    Parameters
+    ----------
+    streams: list
+        File-like objects where the output is written.
+    output_format: string
+        One of ``FORMATS``.
+    compact: bool
+        Whether to write the ``json`` format without indentation. The
+        ``ndjson`` format is always compact.
+
+    Attributes
+    ----------
+    streams: list
+        File-like objects where the output is written.
+    output_format: string
+        One of ``FORMATS``.
+    compact: bool
+        Whether the ``json`` format is written without indentation.
+    count: int
+        Number of servers written so far.
+    """
+
+    def __init__(self, streams, output_format='json', compact=False):
+        if output_format not in FORMATS:
+            raise Exception('Invalid output format. Should be one of: %s' % ', '.join(FORMATS))
+        self.streams = streams
+        self.output_format = output_format
+        self.compact = compact
+        self.count = 0
+        self._closed = False
+
+    def _emit(self, chunk):
+        """
+        Writes a chunk of text to every stream and flushes it.
+        """
+        for stream in self.streams:
+            stream.write(chunk)
+            stream.flush()
+
+    def write(self, ip_address, host_stats):
+        """
+        Writes the result of a server.
+
+        Parameters
+        ----------
+        ip_address: string
+            IPv4 address of the server.
+        host_stats: HostStats or dictionary
+            The usage data of the server.
+        """
+        if self.output_format == 'ndjson':
+            record = {'ip': ip_address}
+            record.update(stats.as_dict(host_stats))
+            self._emit(json.dumps(record, separators=(',', ':')) + '\n')
+        elif self.compact:
+            prefix = ',' if self.count else '{'
+            self._emit('%s%s:%s' % (prefix, json.dumps(ip_address),
+                                    json.dumps(host_stats, separators=(',', ':'),
+                                               default=stats.as_dict)))
+        else:
+            # Same layout as json.dumps(indent=INDENT) on the whole document:
+            prefix = ',\n' if self.count else '{\n'
+            padding = ' ' * INDENT
+            value = json.dumps(host_stats, indent=INDENT, default=stats.as_dict)
+            self._emit('%s%s%s: %s' % (prefix, padding, json.dumps(ip_address),
+                                       value.replace('\n', '\n' + padding)))
+        self.count += 1
+
+    def write_summary(self, summary):
+        """
+        Writes the fleet summary. Should be written after every server.
+
+        Parameters
+        ----------
+        summary: dictionary
+            The fleet summary.
+        """
+        if self.output_format == 'ndjson':
+            self._emit(json.dumps({'fleet': summary}, separators=(',', ':')) + '\n')
+            return
+        self.write('fleet', summary)
+
+    def close(self):
+        """
+        Finishes the ``json`` document. The streams are not closed.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self.output_format == 'ndjson':
+            return
+        if not self.count:
+            self._emit('{}\n')
+        elif self.compact:
+            self._emit('}\n')
+        else:
+            self._emit('\n}\n')
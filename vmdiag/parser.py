@@ -6,13 +6,322 @@ Functions for parsing and validating the provided IP addresses.
 
 Notes
 -----
-    ``validate_ip()`` and ``validate_ip_octets()`` are auxiliary functions, they
-    are called when ``parse_ip()`` is called. If any of those auxiliary functions
-    fail, ``parse_ip()`` will raise and exception.
+    The targets can be single addresses (``10.0.0.1``), CIDR blocks
+    (``10.0.0.0/24``), ranges (``10.0.0.1-10.0.0.20`` or ``10.0.0.1-20``) or
+    lines of a hosts file. Every target is validated once, with a single
+    regular expression match, and kept as a range of integers; the addresses
+    are only generated as the targets are consumed by ``expand_targets()``,
+    which deduplicates them on the ranges, so memory does not grow with the
+    number of addresses.
+
+    ``validate_ip()`` and ``validate_ip_octets()`` are kept for validating
+    lists of addresses, ``parse_ip()`` does not need them anymore.
 """
 
+import bisect
 import re
 
+IP_PATTERN = re.compile(r'^(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})$')
+"""
+Pattern: Regular expression matching an IPv4 address, capturing its octets.
+"""
+
+
+def address_to_int(address):
+    """
+    Validates an IPv4 address and converts it to an integer.
+
+    Parameters
+    ----------
+    address: string
+        IPv4 address with the format ``XXX.XXX.XXX.XXX``.
+
+    Returns
+    -------
+    int
+        The address as a 32-bit integer.
+
+    Raises
+    ------
+    Exception
+        Invalid IP format. Should be XXX.XXX.XXX.XXX
+    Exception
+        Invalid IP octet. Maximum value should be 255
+    """
+    match_result = IP_PATTERN.match(address)
+    if match_result is None:
+        raise Exception('Invalid IP format. Should be XXX.XXX.XXX.XXX')
+    value = 0
+    for octet in match_result.groups():
+        octet = int(octet)
+        if octet > 255:
+            raise Exception('Invalid IP octet. Maximum value should be 255')
+        value = value << 8 | octet
+    return value
+
+
+def int_to_address(value):
+    """
+    Converts a 32-bit integer to an IPv4 address.
+
+    Parameters
+    ----------
+    value: int
+        The address as a 32-bit integer.
+
+    Returns
+    -------
+    string
+        IPv4 address with the format ``XXX.XXX.XXX.XXX``.
+    """
+    return '%d.%d.%d.%d' % (value >> 24, value >> 16 & 255, value >> 8 & 255, value & 255)
+
+
+def parse_target(target):
+    """
+    Validates a target and returns the range of addresses it covers.
+
+    Notes
+    -----
+        * A CIDR block covers its usable host addresses: the network and
+          broadcast addresses are left out, except on ``/31`` and ``/32``
+          blocks.
+
+    Parameters
+    ----------
+    target: string
+        An address (``XXX.XXX.XXX.XXX``), a CIDR block (``XXX.XXX.XXX.XXX/N``)
+        or a range (``XXX.XXX.XXX.XXX-YYY.YYY.YYY.YYY`` or
+        ``XXX.XXX.XXX.XXX-YYY``, the last octet of the last address).
+
+    Returns
+    -------
+    tuple
+        The ``(first, last)`` addresses of the range as integers, both
+        included.
+
+    Raises
+    ------
+    Exception
+        Invalid IP format. Should be XXX.XXX.XXX.XXX
+    Exception
+        Invalid IP octet. Maximum value should be 255
+    Exception
+        Invalid CIDR prefix. Should be between 0 and 32
+    Exception
+        Invalid IP range. The first address should not be greater than the last
+    """
+    target = target.strip()
+    if '/' in target:
+        address, prefix = target.split('/', 1)
+        if not prefix.isdigit() or int(prefix) > 32:
+            raise Exception('Invalid CIDR prefix. Should be between 0 and 32')
+        host_bits = 32 - int(prefix)
+        first = address_to_int(address) >> host_bits << host_bits
+        last = first + (1 << host_bits) - 1
+        if host_bits > 1:
+            first, last = first + 1, last - 1
+        return first, last
+    if '-' in target:
+        first, last = target.split('-', 1)
+        first = address_to_int(first)
+        if last.isdigit() and len(last) <= 3:
+            if int(last) > 255:
+                raise Exception('Invalid IP octet. Maximum value should be 255')
+            last = first >> 8 << 8 | int(last)
+        else:
+            last = address_to_int(last)
+        if first > last:
+            raise Exception('Invalid IP range. The first address should not be greater than the last')
+        return first, last
+    first = address_to_int(target)
+    return first, first
+
+
+def parse_hosts_file(path):
+    """
+    Reads the targets listed on a hosts file.
+
+    Notes
+    -----
+        * Every line has a target (see ``parse_target()``), optionally
+          followed by the username and the PEM key path used for it,
+          separated by whitespace. Empty lines and everything after a ``#``
+          are ignored.
+
+    Parameters
+    ----------
+    path: string
+        Path of the hosts file.
+
+    Returns
+    -------
+    list
+        A ``(first, last, username, key)`` tuple for every target, where the
+        username and key are None if not given.
+
+    Raises
+    ------
+    Exception
+        Invalid hosts file line N: followed by the reason
+    """
+    entries = []
+    with open(path) as hosts_file:
+        for line_number, line in enumerate(hosts_file, 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            if len(fields) > 3:
+                raise Exception('Invalid hosts file line %d: too many columns' % line_number)
+            try:
+                first, last = parse_target(fields[0])
+            except Exception as error:
+                raise Exception('Invalid hosts file line %d: %s' % (line_number, error))
+            fields += [None] * (3 - len(fields))
+            entries.append((first, last, fields[1], fields[2]))
+    return entries
+
+
+def claim_range(firsts, lasts, first, last):
+    """
+    Adds a range of addresses to the covered ones and returns the parts of
+    it that were not covered yet.
+
+    Parameters
+    ----------
+    firsts: list
+        First address of every covered range, sorted. Updated in place.
+    lasts: list
+        Last address of every covered range, sorted. The covered ranges never
+        overlap nor touch: they are merged as they are added.
+    first: int
+        First address of the range.
+    last: int
+        Last address of the range.
+
+    Returns
+    -------
+    list
+        The ``(first, last)`` ranges of new addresses, in increasing order.
+    """
+    # Covered ranges overlapping the new one or right next to it:
+    low = bisect.bisect_left(lasts, first - 1)
+    high = bisect.bisect_right(firsts, last + 1)
+    gaps = []
+    start = first
+    for index in range(low, high):
+        if firsts[index] > start:
+            gaps.append((start, min(firsts[index] - 1, last)))
+        start = max(start, lasts[index] + 1)
+    if start <= last:
+        gaps.append((start, last))
+    if low < high:
+        first, last = min(first, firsts[low]), max(last, lasts[high - 1])
+    firsts[low:high] = [first]
+    lasts[low:high] = [last]
+    return gaps
+
+
+def expand_targets(entries):
+    """
+    Generates the addresses covered by the given targets, skipping the
+    repeated ones.
+
+    Notes
+    -----
+        * Only the ranges already covered are kept to skip the repeated
+          addresses (see ``claim_range()``), not the addresses themselves.
+
+    Parameters
+    ----------
+    entries: iterable
+        ``(first, last, username, key)`` tuples, as returned by
+        ``parse_targets()``.
+
+    Yields
+    ------
+    tuple
+        A ``(ip_address, username, key)`` tuple for every address, in the
+        order of the targets. An address listed more than once is only
+        yielded the first time, with the username and key of that target.
+    """
+    firsts = []
+    lasts = []
+    for first, last, username, key in entries:
+        for gap_first, gap_last in claim_range(firsts, lasts, first, last):
+            for value in range(gap_first, gap_last + 1):
+                yield int_to_address(value), username, key
+
+
+def parse_targets(ip_string, users, keys, hosts_file=None):
+    """
+    Validates the targets given on the command line and matches them with
+    their usernames and PEM keys.
+
+    Notes
+    -----
+        * Several usernames and keys can only be given for a list of
+          addresses, one per address. Otherwise, a single username and key
+          are used for every target without its own on the hosts file.
+        * The addresses are not generated here, only the ranges are validated.
+          Use ``expand_targets()`` to get them.
+
+    Parameters
+    ----------
+    ip_string: string
+        Comma separated targets (see ``parse_target()``). May be empty if a
+        hosts file is given.
+    users: list
+        Usernames given on the command line.
+    keys: list
+        PEM key paths given on the command line.
+    hosts_file: string
+        Path of a hosts file with more targets (see ``parse_hosts_file()``).
+
+    Returns
+    -------
+    list
+        A ``(first, last, username, key)`` tuple for every target.
+
+    Raises
+    ------
+    Exception
+        No IP addresses given. Provide them as arguments or on a hosts file
+    Exception
+        Must provide usernames and PEM keys for every IP or one PEM key common to all servers.
+    Exception
+        Must provide PEM keys and usernames for every IP or one PEM key common to all servers.
+    """
+    entries = []
+    if ip_string:
+        for target in ip_string.split(','):
+            first, last = parse_target(target)
+            entries.append((first, last, None, None))
+    if hosts_file is not None:
+        entries += parse_hosts_file(hosts_file)
+    if not entries:
+        raise Exception('No IP addresses given. Provide them as arguments or on a hosts file')
+    if len(users) != len(keys):
+        raise Exception('Must provide usernames and PEM keys for every IP or one PEM key common to all servers.')
+    if len(users) > 1:
+        # One username and key per address, only for lists of addresses:
+        if hosts_file is not None or any(first != last for first, last, _, _ in entries) \
+                or len(users) != len(entries):
+            raise Exception('Must provide PEM keys and usernames for every IP or one PEM key common to all servers.')
+        return [(first, last, username, key)
+                for (first, last, _, _), username, key in zip(entries, users, keys)]
+    default_user = users[0] if users else None
+    default_key = keys[0] if keys else None
+    targets = []
+    for first, last, username, key in entries:
+        username = default_user if username is None else username
+        key = default_key if key is None else key
+        if username is None or key is None:
+            raise Exception('Must provide PEM keys and usernames for every IP or one PEM key common to all servers.')
+        targets.append((first, last, username, key))
+    return targets
+
+
 def parse_ip(ip_string):
     """
     Returns a list with properly formatted IP addresses from a single
@@ -23,6 +332,8 @@ def parse_ip(ip_string):
         * The function will raise an exception if the given string is ill-formed, has
           addresses with an erroneous format (*not XXX.XXX.XXX.XXX*) or if the IP address
           has an octet with a value greater than 255.
+        * CIDR blocks and ranges are expanded and repeated addresses are
+          only returned once. See ``parse_target()``.
 
     Parameters
     ----------
@@ -42,13 +353,11 @@ def parse_ip(ip_string):
     Exception
         Invalid IP octet. Maximum value should be 255
     """
-    ip_list = ip_string.split(',')
-    if not validate_ip(ip_list):
-        raise Exception('Invalid IP format. Should be XXX.XXX.XXX.XXX')
-    elif not validate_ip_octets(ip_list):
-        raise Exception('Invalid IP octet. Maximum value should be 255')
-    else:
-        return ip_list
+    entries = []
+    for target in ip_string.split(','):
+        first, last = parse_target(target)
+        entries.append((first, last, None, None))
+    return [ip_address for ip_address, _, _ in expand_targets(entries)]
 
 
 def validate_ip(ip_list):
@@ -0,0 +1,223 @@
+"""
+Pool of authenticated SSH connections reused across sweeps.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Notes
+-----
+    Connections are keyed by ``(ip_address, username, key)``. An idle
+    connection is health-checked before being handed out again, reconnected
+    if it died, and closed once it has been idle for longer than the pool's TTL.
+"""
+
+import socket
+import threading
+import time
+import paramiko
+from vmdiag import server
+
+
+class ConnectionPool:
+    """
+    Keeps authenticated ``Server`` instances alive so repeated queries to the
+    same servers skip the TCP connection, key exchange and authentication.
+
+    Parameters
+    ----------
+    ttl: int
+        Time in seconds an idle connection is kept before being closed.
+    keepalive: int
+        Interval in seconds between SSH keepalive packets, 0 to disable them.
+    timeout: int
+        Time in seconds to wait before giving up trying to connect.
+    known_hosts: KnownHosts
+        Known host keys the servers are verified against. If not given, any
+        host key is accepted.
+    port: int
+        TCP port of the SSH servers.
+    compress: bool
+        Whether the servers use the compact transport. See ``Server``.
+
+    Attributes
+    ----------
+    ttl: int
+        Time in seconds an idle connection is kept before being closed.
+    keepalive: int
+        Interval in seconds between SSH keepalive packets.
+    timeout: int
+        Time in seconds to wait before giving up trying to connect.
+    known_hosts: KnownHosts
+        Known host keys the servers are verified against.
+    port: int
+        TCP port of the SSH servers.
+    compress: bool
+        Whether the servers use the compact transport.
+    """
+
+    CONNECTION_ERRORS = (paramiko.SSHException, EOFError, socket.error)
+    """
+    tuple: Exceptions that mean a pooled connection is no longer usable.
+    """
+
+    def __init__(self, ttl=300, keepalive=15, timeout=20, known_hosts=None, port=22,
+                 compress=False):
+        self.ttl = ttl
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.known_hosts = known_hosts
+        self.port = port
+        self.compress = compress
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, ip_address, username, key, deadline=None, profile=None):
+        """
+        Returns a connected ``Server`` for the given credentials, reusing an
+        idle connection if a healthy one is available.
+
+        Parameters
+        ----------
+        ip_address: string
+            IPv4 address of the remote server.
+        username: string
+            Username to log into via SSH.
+        key: string
+            PEM key path to use for SSH authentication.
+        deadline: float
+            Time in seconds the returned server has for connecting and running
+            its commands. See ``Server.set_deadline()``.
+        profile: HostProfile
+            Where the returned server records its timings and counters, if
+            given.
+
+        Returns
+        -------
+        Server
+            A connected server instance. Must be given back with ``release()``
+            or ``discard()``.
+        """
+        self.evict_idle()
+        pool_key = (ip_address, username, key)
+        client = None
+        with self._lock:
+            if self._idle.get(pool_key):
+                client, _ = self._idle[pool_key].pop()
+        if client is None:
+            client = server.Server(ip_address, username, key, self.timeout, self.known_hosts,
+                                   self.port, self.compress)
+        client.set_deadline(deadline)
+        client.profile = profile
+        if not client.is_active():
+            self._connect(client)
+        return client
+
+    def _connect(self, client):
+        """
+        (Re)connects a server instance. Reconnecting the same instance keeps
+        the state it stores between queries, such as its CPU counters.
+        """
+        client.disconnect()
+        client.connect()
+        if self.keepalive:
+            client.set_keepalive(self.keepalive)
+
+    def release(self, client):
+        """
+        Gives a connection back to the pool so it can be reused.
+
+        Parameters
+        ----------
+        client: Server
+            Server instance returned by ``acquire()``.
+        """
+        pool_key = (client.ip_address, client.username, client.key_path)
+        with self._lock:
+            self._idle.setdefault(pool_key, []).append((client, time.monotonic()))
+
+    def discard(self, client):
+        """
+        Closes a connection that should not be reused.
+
+        Parameters
+        ----------
+        client: Server
+            Server instance returned by ``acquire()``.
+        """
+        client.disconnect()
+
+    def run(self, ip_address, username, key, query, deadline=None, profile=None):
+        """
+        Runs ``query`` with a pooled connection. If the connection turns out
+        to be broken, it is transparently reconnected and the query is run
+        once more. A connection that exceeded its deadline is closed instead.
+
+        Parameters
+        ----------
+        ip_address: string
+            IPv4 address of the remote server.
+        username: string
+            Username to log into via SSH.
+        key: string
+            PEM key path to use for SSH authentication.
+        query: function
+            Function called with the connected ``Server`` instance.
+        deadline: float
+            Time in seconds for connecting and running the query, including
+            the reconnection.
+        profile: HostProfile
+            Where the timings and counters of the query are recorded, if given.
+
+        Returns
+        -------
+        object
+            The value returned by ``query``.
+        """
+        client = self.acquire(ip_address, username, key, deadline, profile)
+        try:
+            try:
+                result = query(client)
+            except TimeoutError:
+                raise
+            except self.CONNECTION_ERRORS:
+                if profile is not None:
+                    profile.add('retries')
+                self._connect(client)
+                result = query(client)
+        except Exception:
+            self.discard(client)
+            raise
+        self.release(client)
+        return result
+
+    def evict_idle(self):
+        """
+        Closes every idle connection that has not been used for longer
+        than the pool's TTL.
+        """
+        deadline = time.monotonic() - self.ttl
+        expired = []
+        with self._lock:
+            for pool_key in list(self._idle):
+                kept = []
+                for client, last_used in self._idle[pool_key]:
+                    if last_used < deadline:
+                        expired.append(client)
+                    else:
+                        kept.append((client, last_used))
+                if kept:
+                    self._idle[pool_key] = kept
+                else:
+                    del self._idle[pool_key]
+        for client in expired:
+            client.disconnect()
+
+    def close(self):
+        """
+        Closes every idle connection held by the pool.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for idle_list in idle.values():
+            for client, _ in idle_list:
+                client.disconnect()
@@ -0,0 +1,270 @@
+"""
+Per-server timings and counters of the queries, for finding out where the
+time of a slow sweep goes.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Notes
+-----
+    The time of every query is split into the ``PHASES``: the TCP connection,
+    the SSH key exchange, the authentication, the remote commands and the
+    local parsing of their output. Every server also counts its round trips,
+    the bytes received and the retries.
+
+    Profiling is disabled by passing None instead of a ``HostProfile``, which
+    costs one ``is None`` check per phase.
+"""
+
+import contextlib
+import threading
+import time
+
+PHASES = ['connect', 'kex', 'auth', 'exec', 'parse']
+"""
+list: Phases the time of a query is split into, in the order they happen.
+"""
+
+COUNTERS = ['round_trips', 'bytes_received', 'retries']
+"""
+list: Counters kept for every server.
+"""
+
+PERCENTILES = [50, 90, 99]
+"""
+list: Percentiles shown on the summary table.
+"""
+
+
+class HostProfile:
+    """
+    Timings and counters of the query of a single server.
+
+    Attributes
+    ----------
+    phases: dictionary
+        Seconds spent on every phase, keyed by phase name.
+    counters: dictionary
+        Value of every counter, keyed by counter name.
+    """
+
+    def __init__(self):
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self._start = time.perf_counter()
+        self._end = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Adds the time spent inside the ``with`` block to a phase.
+
+        Parameters
+        ----------
+        name: string
+            One of ``PHASES``.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def add(self, counter, value=1):
+        """
+        Increases a counter.
+
+        Parameters
+        ----------
+        counter: string
+            One of ``COUNTERS``.
+        value: int
+            Amount to add.
+        """
+        self.counters[counter] += value
+
+    def finish(self):
+        """
+        Marks the end of the query, fixing its total time.
+        """
+        self._end = time.perf_counter()
+
+    def total(self):
+        """
+        Returns the time in seconds from the creation of the profile until
+        ``finish()`` was called, or until now if it was not.
+        """
+        end = time.perf_counter() if self._end is None else self._end
+        return end - self._start
+
+    def as_dict(self):
+        """
+        Returns the profile as written on the output.
+
+        Returns
+        -------
+        dictionary
+            The time of every phase and the total time, in milliseconds,
+            under ``phases_ms`` and ``total_ms``, plus every counter.
+        """
+        profile_dict = {
+            'phases_ms': dict((name, round(seconds * 1000, 3))
+                              for name, seconds in self.phases.items()),
+            'total_ms': round(self.total() * 1000, 3)
+        }
+        profile_dict.update(self.counters)
+        return profile_dict
+
+
+def phase(profile, name):
+    """
+    Times a phase on a profile that may be disabled.
+
+    Parameters
+    ----------
+    profile: HostProfile
+        Profile of the server, or None if profiling is disabled.
+    name: string
+        One of ``PHASES``.
+
+    Returns
+    -------
+    context manager
+        ``profile.phase(name)``, or a context manager doing nothing.
+    """
+    if profile is None:
+        return contextlib.nullcontext()
+    return profile.phase(name)
+
+
+def percentile(values, percent):
+    """
+    Returns a percentile of a list of values, using the nearest rank.
+
+    Parameters
+    ----------
+    values: list
+        Values sorted in increasing order.
+    percent: float
+        Percentile between 0 and 100.
+
+    Returns
+    -------
+    float
+        The smallest value that is greater than or equal to ``percent``
+        percent of the values.
+    """
+    if not values:
+        return 0.0
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[int(rank) - 1]
+
+
+class Profiler:
+    """
+    Keeps the profile of the last query of every server and summarizes them.
+
+    Notes
+    -----
+        * A profiler can be pickled to be sent to a worker process. The
+          profiles started on the worker stay there: send them back and
+          ``add()`` them to the profiler of the main process.
+    """
+
+    def __init__(self):
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        with self._lock:
+            return dict(self._profiles)
+
+    def __setstate__(self, state):
+        self._profiles = state
+        self._lock = threading.Lock()
+
+    def start(self, ip_address):
+        """
+        Starts the profile of a new query, replacing the previous one of the
+        same server.
+
+        Parameters
+        ----------
+        ip_address: string
+            IPv4 address of the server.
+
+        Returns
+        -------
+        HostProfile
+            The new profile.
+        """
+        profile = HostProfile()
+        with self._lock:
+            self._profiles[ip_address] = profile
+        return profile
+
+    def add(self, ip_address, profile):
+        """
+        Keeps a profile started elsewhere, replacing the previous one of the
+        same server.
+
+        Parameters
+        ----------
+        ip_address: string
+            IPv4 address of the server.
+        profile: HostProfile
+            The profile of the query.
+        """
+        with self._lock:
+            self._profiles[ip_address] = profile
+
+    def get(self, ip_address):
+        """
+        Returns the last profile of a server, or None if it was never queried.
+        """
+        with self._lock:
+            return self._profiles.get(ip_address)
+
+    def summary(self):
+        """
+        Summarizes the profiles of every server.
+
+        Returns
+        -------
+        list
+            A ``(name, unit, values)`` tuple for every phase, the total time and
+            every counter, where ``values`` is the sorted list of the values of
+            every server. Times are in milliseconds.
+        """
+        with self._lock:
+            profiles = list(self._profiles.values())
+        rows = []
+        for name in PHASES:
+            rows.append((name, 'ms', sorted(profile.phases[name] * 1000 for profile in profiles)))
+        rows.append(('total', 'ms', sorted(profile.total() * 1000 for profile in profiles)))
+        for name in COUNTERS:
+            rows.append((name, '', sorted(profile.counters[name] for profile in profiles)))
+        return rows
+
+    def report(self):
+        """
+        Formats the summary as a table with the percentiles, maximum and sum
+        of every phase and counter across the servers.
+
+        Returns
+        -------
+        string
+            The table, one line per phase or counter.
+        """
+        header = ['%-16s' % ('%d hosts' % len(self._profiles))]
+        header += ['%12s' % ('p%d' % percent) for percent in PERCENTILES]
+        header += ['%12s' % 'max', '%14s' % 'sum']
+        lines = [''.join(header)]
+        for name, unit, values in self.summary():
+            label = '%s (%s)' % (name, unit) if unit else name
+            number = '%12.1f' if unit else '%12d'
+            line = ['%-16s' % label]
+            line += [number % percentile(values, percent) for percent in PERCENTILES]
+            line += [number % (values[-1] if values else 0), '  ' + number % sum(values)]
+            lines.append(''.join(line))
+        return '\n'.join(lines)
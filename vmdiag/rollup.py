@@ -0,0 +1,356 @@
+"""
+Fleet-wide roll-up of the results of a sweep: the top processes of the
+whole fleet and the percentiles of the remaining capacity.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Notes
+-----
+    The results are added one by one as they arrive and then dropped, so the
+    roll-up takes the same memory for ten servers as for a million:
+
+        * The top processes are kept on a min-heap of ``top`` entries per
+          metric. A process only enters the heap when it beats the smallest
+          entry, which is compared first, so most processes cost a single
+          comparison.
+        * The remaining CPU and available memory go into a quantile sketch
+          (see ``QuantileSketch``), whose size only depends on the range of
+          the values and not on their count.
+
+    Both can be merged with the roll-up of another part of the fleet.
+"""
+
+import heapq
+import itertools
+import math
+from vmdiag import stats
+
+PERCENTILES = (1, 5, 50, 95, 99)
+"""
+tuple: Percentiles of the remaining capacity in the summary.
+"""
+
+ACCURACY = 0.01
+"""
+float: Relative accuracy of the percentiles of the remaining capacity.
+"""
+
+CAPACITY_KEYS = ('cpu', 'memory_kb')
+"""
+tuple: Values of the remaining capacity summarized with percentiles.
+"""
+
+
+class QuantileSketch:
+    """
+    Mergeable sketch of the distribution of positive values, answering
+    percentiles with a bounded relative error.
+
+    Notes
+    -----
+        * Every value falls in a bucket ``i`` covering the values between
+          ``gamma ** (i - 1)`` and ``gamma ** i``, where ``gamma`` is
+          ``(1 + accuracy) / (1 - accuracy)``, and only the count of every
+          bucket is kept. A percentile is answered with the middle of its
+          bucket, within ``accuracy`` times the exact value.
+        * The number of buckets grows with the logarithm of the ratio between
+          the largest and the smallest value: at 1% accuracy, about 1400
+          buckets cover from 1 kB to 1 TB.
+        * Values of zero or less are counted apart, as zeros.
+
+    Parameters
+    ----------
+    accuracy: float
+        Relative accuracy of the percentiles, between 0 and 1.
+
+    Attributes
+    ----------
+    accuracy: float
+        Relative accuracy of the percentiles.
+    count: int
+        Number of values added.
+    min: float
+        Smallest value added, None if empty.
+    max: float
+        Largest value added, None if empty.
+
+    Raises
+    ------
+    Exception
+        Invalid accuracy. Should be between 0 and 1
+    """
+
+    def __init__(self, accuracy=ACCURACY):
+        if not 0 < accuracy < 1:
+            raise Exception('Invalid accuracy. Should be between 0 and 1')
+        self.accuracy = accuracy
+        self.count = 0
+        self.min = None
+        self.max = None
+        self._gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._buckets = {}
+        self._zeros = 0
+
+    def add(self, value):
+        """
+        Adds a value to the sketch.
+
+        Parameters
+        ----------
+        value: float
+            The value.
+        """
+        if value > 0:
+            index = math.ceil(math.log(value) / self._log_gamma)
+            self._buckets[index] = self._buckets.get(index, 0) + 1
+        else:
+            self._zeros += 1
+        self.count += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        """
+        Adds every value of another sketch with the same accuracy.
+
+        Parameters
+        ----------
+        other: QuantileSketch
+            The other sketch. It is not modified.
+
+        Raises
+        ------
+        Exception
+            Cannot merge sketches with different accuracies
+        """
+        if other.accuracy != self.accuracy:
+            raise Exception('Cannot merge sketches with different accuracies')
+        for index, count in other._buckets.items():
+            self._buckets[index] = self._buckets.get(index, 0) + count
+        self._zeros += other._zeros
+        self.count += other.count
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percent):
+        """
+        Returns a percentile of the values, using the nearest rank.
+
+        Parameters
+        ----------
+        percent: float
+            Percentile between 0 and 100.
+
+        Returns
+        -------
+        float
+            The percentile, within ``accuracy`` times the exact value and
+            never out of the range of the values. None if the sketch is
+            empty.
+        """
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(self.count * percent / 100))
+        seen = self._zeros
+        if rank <= seen:
+            return max(self.min, 0)
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                value = 2 * self._gamma ** index / (self._gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def __len__(self):
+        return len(self._buckets) + (1 if self._zeros else 0)
+
+
+class FleetRollup:
+    """
+    Rolls up the results of the servers of a fleet as they arrive.
+
+    Notes
+    -----
+        * The top processes are taken from the whole process table of the
+          batched backends. The other backends only report their own top
+          processes, which gives the same fleet top as long as they report at
+          least ``top`` of them: a process among the ``top`` of the fleet is
+          always among the ``top`` of its server.
+        * The results with ``aggregate`` rank the process names of every
+          server, so the fleet top holds the names with the ``count`` of
+          processes on their server instead of the PIDs.
+
+    Parameters
+    ----------
+    top: int
+        Number of top processes of the fleet to report for every metric.
+    accuracy: float
+        Relative accuracy of the percentiles. See ``QuantileSketch``.
+
+    Attributes
+    ----------
+    top: int
+        Number of top processes of the fleet to report for every metric.
+    hosts: int
+        Number of results added.
+    statuses: dictionary
+        Number of results with every status, ``ok`` for the usage data.
+    capacity: dictionary
+        ``QuantileSketch`` of every value of ``CAPACITY_KEYS``.
+    """
+
+    def __init__(self, top=10, accuracy=ACCURACY):
+        if top < 1:
+            raise Exception('Invalid top. Should be at least 1')
+        self.top = top
+        self.hosts = 0
+        self.statuses = {}
+        self.capacity = dict((key, QuantileSketch(accuracy)) for key in CAPACITY_KEYS)
+        # Min-heaps of (value, order, ip_address, row) per metric, the order
+        # breaking the ties so the rows are never compared:
+        self._heaps = dict((metric, []) for metric in stats.METRICS)
+        self._order = itertools.count()
+
+    def _push(self, metric, value, ip_address, row):
+        """
+        Offers a ``(pid, count, name, cpu, memory)`` row to the top of a
+        metric.
+        """
+        heap = self._heaps[metric]
+        if len(heap) < self.top:
+            heapq.heappush(heap, (value, next(self._order), ip_address, row))
+        elif value > heap[0][0]:
+            heapq.heapreplace(heap, (value, next(self._order), ip_address, row))
+
+    def add(self, ip_address, result):
+        """
+        Adds the result of a server.
+
+        Parameters
+        ----------
+        ip_address: string
+            IPv4 address of the server.
+        result: HostStats or dictionary
+            The usage data, or the error status, of the server.
+        """
+        self.hosts += 1
+        if isinstance(result, stats.HostStats):
+            self._add_processes(ip_address, result)
+            capacity = result.capacity
+        else:
+            status = result.get('status')
+            if status is not None:
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+                return
+            self._add_top_dicts(ip_address, result)
+            capacity = result.get('remaining_capacity', {})
+        self.statuses['ok'] = self.statuses.get('ok', 0) + 1
+        for key, sketch in self.capacity.items():
+            if capacity.get(key) is not None:
+                sketch.add(capacity[key])
+
+    def _add_processes(self, ip_address, host_stats):
+        """
+        Offers the top processes of a process table to the top of every
+        metric. Only the ``top`` of the server can make it to the top of the
+        fleet, and they are selected on the columns of the table, without
+        building a row for every process.
+        """
+        processes = host_stats.processes
+        if host_stats.aggregate:
+            rows = [(None, count, name, cpu, memory)
+                    for count, name, cpu, memory in stats.aggregate_processes(processes)]
+            for metric, index in stats.METRICS.items():
+                for row in heapq.nlargest(self.top, rows, key=lambda row: row[index + 1]):
+                    self._push(metric, row[index + 1], ip_address, row)
+            return
+        for metric in stats.METRICS:
+            column = processes.cpu if metric == 'cpu' else processes.memory
+            for position in heapq.nlargest(self.top, range(len(column)), key=column.__getitem__):
+                row = (processes.pids[position], None, processes.names[position],
+                       processes.cpu[position] / 10, processes.memory[position] / 10)
+                self._push(metric, column[position] / 10, ip_address, row)
+
+    def _add_top_dicts(self, ip_address, stats_dict):
+        """
+        Offers the top processes reported by a server to the top of every
+        metric.
+        """
+        for metric in stats.METRICS:
+            suffix = '_%s_consumption' % metric
+            for key, top_dict in stats_dict.items():
+                if not (key.startswith('top_') and key.endswith(suffix)):
+                    continue
+                for first, process in top_dict.items():
+                    if 'name' in process:
+                        row = (int(first), None, process['name'])
+                    else:
+                        row = (None, process.get('count'), first)
+                    row += (process['cpu'], process['memory'])
+                    self._push(metric, process[metric], ip_address, row)
+
+    def merge(self, other):
+        """
+        Adds every result added to another roll-up with the same ``top`` and
+        accuracy, such as the roll-up of another part of the fleet.
+
+        Parameters
+        ----------
+        other: FleetRollup
+            The other roll-up. It is not modified.
+        """
+        self.hosts += other.hosts
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        for key, sketch in self.capacity.items():
+            sketch.merge(other.capacity[key])
+        for metric, heap in other._heaps.items():
+            for value, _, ip_address, row in heap:
+                self._push(metric, value, ip_address, row)
+
+    def summary(self):
+        """
+        Builds the fleet summary.
+
+        Returns
+        -------
+        dictionary
+            A dictionary with the number of ``hosts``, the count of every
+            status under ``statuses``, the ``top_N_cpu_consumption`` and
+            ``top_N_memory_consumption`` lists of processes, from greater to
+            lower, with the ``ip`` of their server, and the ``min``, the
+            ``PERCENTILES`` and the ``max`` of every value of the remaining
+            capacity under ``remaining_capacity``.
+        """
+        summary = {'hosts': self.hosts, 'statuses': dict(self.statuses)}
+        for metric, heap in self._heaps.items():
+            summary['top_%d_%s_consumption' % (self.top, metric)] = [
+                _entry(ip_address, *row)
+                for _, _, ip_address, row in sorted(heap, key=lambda item: (-item[0], item[1]))]
+        capacity = {}
+        for key, sketch in self.capacity.items():
+            values = {'min': sketch.min}
+            for percent in PERCENTILES:
+                values['p%d' % percent] = sketch.percentile(percent)
+            values['max'] = sketch.max
+            capacity[key] = values
+        summary['remaining_capacity'] = capacity
+        return summary
+
+
+def _entry(ip_address, pid, count, name, cpu, memory):
+    """
+    Builds the summary entry of a process, or of a process name with the
+    number of processes sharing it.
+    """
+    entry = {'ip': ip_address}
+    if pid is None:
+        entry['count'] = count
+    else:
+        entry['pid'] = pid
+    entry.update(name=name, cpu=cpu, memory=memory)
+    return entry
@@ -0,0 +1,486 @@
+"""
+Rules engine that evaluates alert rules against the usage data collected
+from a fleet, for running ``vmdiag`` from cron or CI.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Notes
+-----
+    The rules are a JSON list of objects, or an object with a ``rules`` list,
+    every rule with a ``name``, a ``severity`` (``warning`` by default) and
+    one of these conditions:
+
+        * Threshold: ``{"metric": "memory_kb", "below": 524288}`` alerts on
+          the servers whose last value of a remaining capacity key, such as
+          ``cpu``, ``cpu_steal`` or ``memory_kb``, is below (or ``above``) a
+          bound. The ``processes`` metric is the number of running processes.
+        * Rate of change: ``{"metric": "memory_kb", "rate": true, "below":
+          -1024}`` alerts on the change per minute between the last two
+          samples of every server.
+        * Top processes: ``{"process": "java", "top": 3, "metric": "memory"}``
+          alerts on the servers where a process name is among the ``top``
+          processes by ``cpu`` or ``memory``. Only the top processes reported
+          by the servers can be ranked, so ``top`` should not be larger than
+          the ``--top`` of the sweep.
+        * Status: ``{"status": "timeout"}`` alerts on the servers whose last
+          result is an error with that status, or any error with ``any``.
+
+    The samples are turned into columns, one array per metric with a value
+    per server, and every rule is evaluated on a whole column at once, so a
+    rule costs a single pass over the fleet whatever the number of servers.
+    The columns are NumPy arrays when NumPy is installed, and plain lists
+    otherwise, with the same results.
+"""
+
+import json
+import math
+import operator
+
+try:
+    import numpy
+except ImportError:  # Optional, the rules are evaluated on lists without it
+    numpy = None
+
+SEVERITIES = {'warning': 1, 'critical': 2}
+"""
+dictionary: Exit code of every severity. The exit code of an evaluation is
+the one of its most severe alert.
+"""
+
+EXIT_OK = 0
+"""
+int: Exit code when no rule fired.
+"""
+
+EXIT_UNKNOWN = 3
+"""
+int: Exit code when the rules could not be evaluated, such as invalid rules
+or an unreadable input.
+"""
+
+BOUNDS = {'below': operator.lt, 'above': operator.gt}
+"""
+dictionary: Comparison of every bound of the threshold and rate rules.
+"""
+
+RATE_PERIOD = 60.0
+"""
+float: Period in seconds the rates of change are given for.
+"""
+
+
+class Rule:
+    """
+    Alert rule, see the notes of the module.
+
+    Parameters
+    ----------
+    spec: dictionary
+        The rule as read from the rules file.
+
+    Attributes
+    ----------
+    name: string
+        Name of the rule, reported on its alerts.
+    severity: string
+        One of ``SEVERITIES``.
+    kind: string
+        Kind of condition: ``threshold``, ``rate``, ``top`` or ``status``.
+    metric: string
+        Metric the condition is evaluated on, None for the status rules.
+    bound: string
+        ``below`` or ``above`` for the threshold and rate rules.
+    value: object
+        Bound of the threshold and rate rules, number of top processes of
+        the top rules and status of the status rules.
+    process: string
+        Process name of the top rules.
+
+    Raises
+    ------
+    Exception
+        Invalid rule, with the reason.
+    """
+
+    def __init__(self, spec):
+        if not isinstance(spec, dict) or not isinstance(spec.get('name'), str):
+            raise Exception('Invalid rule. Should be an object with a name: %r' % (spec,))
+        self.name = spec['name']
+        self.severity = spec.get('severity', 'warning')
+        if self.severity not in SEVERITIES:
+            raise Exception('Invalid severity on rule %s. Should be one of: %s' % (
+                self.name, ', '.join(SEVERITIES)))
+        self.metric = spec.get('metric')
+        self.bound = None
+        self.process = None
+        if 'status' in spec:
+            self.kind = 'status'
+            self.metric = None
+            self.value = spec['status']
+        elif 'process' in spec:
+            self.kind = 'top'
+            self.process = spec['process']
+            self.value = spec.get('top', 3)
+            if self.metric not in ('cpu', 'memory'):
+                raise Exception('Invalid metric on rule %s. Should be cpu or memory' % self.name)
+            if not isinstance(self.value, int) or self.value < 1:
+                raise Exception('Invalid top on rule %s. Should be at least 1' % self.name)
+        else:
+            self.kind = 'rate' if spec.get('rate') else 'threshold'
+            bounds = [bound for bound in BOUNDS if bound in spec]
+            if not isinstance(self.metric, str) or len(bounds) != 1:
+                raise Exception('Invalid rule %s. Should have a metric and either below or '
+                                'above' % self.name)
+            self.bound = bounds[0]
+            self.value = spec[self.bound]
+            if isinstance(self.value, bool) or not isinstance(self.value, (int, float)):
+                raise Exception('Invalid %s on rule %s. Should be a number' % (
+                    self.bound, self.name))
+
+
+def parse_rules(document):
+    """
+    Builds the rules of a rules file.
+
+    Parameters
+    ----------
+    document: list or dictionary
+        The parsed rules file: a list of rules, or an object with a ``rules``
+        list.
+
+    Returns
+    -------
+    list
+        The ``Rule`` objects.
+
+    Raises
+    ------
+    Exception
+        Invalid rules, with the reason.
+    """
+    if isinstance(document, dict):
+        document = document.get('rules')
+    if not isinstance(document, list) or not document:
+        raise Exception('Invalid rules. Should be a non-empty list of rules')
+    rules = [Rule(spec) for spec in document]
+    names = set()
+    for rule in rules:
+        if rule.name in names:
+            raise Exception('Duplicate rule name: %s' % rule.name)
+        names.add(rule.name)
+    return rules
+
+
+def _number(value):
+    """
+    Returns a value as a float, or NaN if it is not a number.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return math.nan
+    return float(value)
+
+
+def _top_names(stats_dict, metric):
+    """
+    Returns the names of the top processes of a server by a metric, from
+    greater to lower.
+    """
+    suffix = '_%s_consumption' % metric
+    for key, top_dict in stats_dict.items():
+        if key.startswith('top_') and key.endswith(suffix) and isinstance(top_dict, dict):
+            return [process.get('name', first) for first, process in top_dict.items()]
+    return []
+
+
+def _usage(host):
+    """
+    Returns the last usage data of a server, None if its last result is an
+    error.
+    """
+    return host['last'] if host['status'] is None else None
+
+
+class FleetColumns:
+    """
+    Columns of the last samples of every server of a fleet.
+
+    Notes
+    -----
+        * The values missing on a server, such as the metrics of a server
+          whose last result is an error, are NaN, which never fire a rule.
+        * The rates of change are taken between the last two samples of
+          every server with usage data, and are NaN for the servers with a
+          single sample.
+        * The top process names are dictionary-encoded: every name is given
+          a code, and the top of every server is a row of codes, padded with
+          -1, so finding a name is an integer comparison.
+
+    Parameters
+    ----------
+    hosts: dictionary
+        The last samples of every server, keyed by IP address, as built by
+        ``add_sample()``.
+
+    Attributes
+    ----------
+    ips: list
+        IP address of every row.
+    timestamps: list
+        Time of the last sample of every row, None if unknown.
+    """
+
+    def __init__(self, hosts):
+        self.ips = list(hosts)
+        self.timestamps = [hosts[ip]['timestamp'] for ip in self.ips]
+        self._hosts = [hosts[ip] for ip in self.ips]
+        self._columns = {}
+        self._rates = {}
+        self._codes = {}
+        self._names = {}
+
+    def _array(self, values):
+        """
+        Turns a list of floats into a column.
+        """
+        return numpy.array(values, dtype=float) if numpy is not None else values
+
+    def _sample_value(self, sample, metric):
+        """
+        Returns the value of a metric on a sample, NaN if missing.
+        """
+        if sample is None:
+            return math.nan
+        if metric == 'processes':
+            processes = sample.get('running_processes')
+            return float(len(processes)) if isinstance(processes, list) else math.nan
+        return _number(sample.get('remaining_capacity', {}).get(metric))
+
+    def column(self, metric):
+        """
+        Returns the column of the last value of a metric on every server.
+        """
+        if metric not in self._columns:
+            self._columns[metric] = self._array(
+                [self._sample_value(_usage(host), metric) for host in self._hosts])
+        return self._columns[metric]
+
+    def rate(self, metric):
+        """
+        Returns the column of the change of a metric per ``RATE_PERIOD``
+        between the last two samples of every server.
+        """
+        if metric in self._rates:
+            return self._rates[metric]
+        previous = [self._sample_value(host['previous'], metric) for host in self._hosts]
+        elapsed = [host['elapsed'] if host['elapsed'] else math.nan for host in self._hosts]
+        current = self.column(metric)
+        if numpy is not None:
+            with numpy.errstate(invalid='ignore'):
+                rates = (current - numpy.array(previous)) / numpy.array(elapsed) * RATE_PERIOD
+        else:
+            rates = [(value - old) / seconds * RATE_PERIOD
+                     for value, old, seconds in zip(current, previous, elapsed)]
+        self._rates[metric] = rates
+        return rates
+
+    def _top_codes(self, metric):
+        """
+        Returns the rows of top process codes of a metric.
+        """
+        if metric in self._codes:
+            return self._codes[metric]
+        rows = []
+        for host in self._hosts:
+            sample = _usage(host)
+            names = _top_names(sample, metric) if sample is not None else []
+            rows.append([self._names.setdefault(name, len(self._names)) for name in names])
+        if numpy is not None:
+            width = max([len(row) for row in rows] + [1])
+            rows = numpy.array([row + [-1] * (width - len(row)) for row in rows], dtype=int)
+            rows.shape = (len(self.ips), width)
+        self._codes[metric] = rows
+        return rows
+
+    def rank(self, metric, process, top):
+        """
+        Returns the column of the rank of a process name among the top
+        processes of every server by a metric, NaN if not among the ``top``.
+        """
+        codes = self._top_codes(metric)
+        code = self._names.get(process)
+        if numpy is not None:
+            if code is None:
+                return numpy.full(len(self.ips), math.nan)
+            hits = codes[:, :top] == code
+            return numpy.where(hits.any(axis=1), hits.argmax(axis=1) + 1.0, math.nan)
+        return [float(row.index(code) + 1) if code in row[:top] else math.nan for row in codes]
+
+    def status(self, status):
+        """
+        Returns the column of whether the last result of every server is an
+        error with the given status, or any error for ``any``: 1.0 if it is
+        and NaN otherwise.
+        """
+        return self._array([
+            1.0 if host['status'] is not None and status in ('any', host['status']) else math.nan
+            for host in self._hosts])
+
+
+def _select(values, compare, bound):
+    """
+    Returns the rows of a column whose value compares true to a bound, with
+    their values. NaN never compares true.
+    """
+    if numpy is not None:
+        rows = numpy.flatnonzero(compare(values, bound))
+        return list(zip(rows.tolist(), values[rows].tolist()))
+    return [(row, value) for row, value in enumerate(values) if compare(value, bound)]
+
+
+def add_sample(hosts, ip_address, record, timestamp=None):
+    """
+    Adds a server result to the last samples of a fleet.
+
+    Parameters
+    ----------
+    hosts: dictionary
+        The last samples of every server, keyed by IP address. Every server
+        holds its ``last`` and ``previous`` usage data, the ``last_time`` of
+        its usage data and the seconds ``elapsed`` since the previous one, the
+        ``timestamp`` of its last result and its ``status``, None unless its
+        last result is an error.
+    ip_address: string
+        IPv4 address of the server.
+    record: dictionary
+        The usage data or the error status of the server.
+    timestamp: float
+        UNIX time of the result. The results without it are taken as the
+        newest ones.
+    """
+    host = hosts.get(ip_address)
+    if host is None:
+        host = hosts[ip_address] = {'last': None, 'previous': None, 'elapsed': None,
+                                    'timestamp': None, 'status': None, 'last_time': None}
+    elif (timestamp is not None and host['timestamp'] is not None
+          and timestamp < host['timestamp']):
+        return
+    host['timestamp'] = timestamp
+    host['status'] = record.get('status')
+    if host['status'] is not None:
+        return
+    if host['last'] is not None and timestamp is not None and host['last_time'] is not None:
+        host['elapsed'] = timestamp - host['last_time']
+    else:
+        host['elapsed'] = None
+    host['previous'] = host['last']
+    host['last'] = record
+    host['last_time'] = timestamp
+
+
+def read_results(stream, timestamp=None):
+    """
+    Reads the server results written by a sweep or a watch.
+
+    Parameters
+    ----------
+    stream: file
+        Text stream with the ``json`` document of a sweep, or ``ndjson``
+        lines, full or written with ``--diff``.
+    timestamp: float
+        UNIX time of the results without a ``timestamp``, such as the ones
+        of a sweep.
+
+    Yields
+    ------
+    tuple
+        The IP address, the UNIX time and the usage data or error status of
+        every server result. The fleet summaries are skipped.
+
+    Raises
+    ------
+    Exception
+        Invalid results, with the reason.
+    """
+    from vmdiag import delta
+    text = stream.read()
+    try:
+        document = json.loads(text)
+    except ValueError:
+        document = None
+    if isinstance(document, dict) and 'ip' not in document:
+        for ip_address, record in document.items():
+            if ip_address != 'fleet' and isinstance(record, dict):
+                yield ip_address, timestamp, record
+        return
+    decoder = delta.DeltaDecoder()
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise Exception('Invalid results on line %d. Should be JSON' % number)
+        if not isinstance(record, dict) or 'ip' not in record:
+            continue
+        if 'delta' in record or 'keyframe' in record:
+            record = decoder.decode(record)
+            if record is None:
+                continue
+        yield (record.pop('ip'), record.pop('timestamp', timestamp), record)
+
+
+def evaluate(rules, hosts):
+    """
+    Evaluates every rule against every server.
+
+    Parameters
+    ----------
+    rules: list
+        The ``Rule`` objects.
+    hosts: dictionary
+        The last samples of every server, as built by ``add_sample()``.
+
+    Returns
+    -------
+    list
+        The alerts, in the order of the rules and the servers: dictionaries
+        with the ``ip`` of the server, the ``rule``, its ``severity``, the
+        ``timestamp`` of the last sample if known and what fired the rule:
+        the ``metric`` and its ``value`` or ``rate``, the ``process`` and its
+        ``rank``, or the ``status``.
+    """
+    columns = FleetColumns(hosts)
+    alerts = []
+    for rule in rules:
+        if rule.kind == 'threshold':
+            matches = _select(columns.column(rule.metric), BOUNDS[rule.bound], rule.value)
+        elif rule.kind == 'rate':
+            matches = _select(columns.rate(rule.metric), BOUNDS[rule.bound], rule.value)
+        elif rule.kind == 'top':
+            matches = _select(columns.rank(rule.metric, rule.process, rule.value),
+                              operator.le, rule.value)
+        else:
+            matches = _select(columns.status(rule.value), operator.gt, 0.0)
+        for row, value in matches:
+            alert = {'ip': columns.ips[row], 'rule': rule.name, 'severity': rule.severity}
+            if columns.timestamps[row] is not None:
+                alert['timestamp'] = columns.timestamps[row]
+            if rule.kind == 'threshold':
+                alert.update(metric=rule.metric, value=value)
+            elif rule.kind == 'rate':
+                alert.update(metric=rule.metric, rate=round(value, 3))
+            elif rule.kind == 'top':
+                alert.update(metric=rule.metric, process=rule.process, rank=int(value))
+            else:
+                alert['status'] = hosts[columns.ips[row]]['status']
+            alerts.append(alert)
+    return alerts
+
+
+def exit_code(alerts):
+    """
+    Returns the exit code of an evaluation: the one of its most severe
+    alert (see ``SEVERITIES``), or ``EXIT_OK`` without alerts.
+    """
+    return max([SEVERITIES[alert['severity']] for alert in alerts] + [EXIT_OK])
@@ -0,0 +1,195 @@
+"""
+Sampler run on the servers by the ``sampler`` backend.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Notes
+-----
+    This file is uploaded to the servers over SFTP and run there with the
+    Python interpreter of the system, so it only uses the standard library
+    and runs on Python 2.7 too. It is not imported by ``vmdiag``.
+
+    The sampler reads ``/proc/stat``, ``/proc/meminfo`` and every
+    ``/proc/[pid]/stat`` ``rate`` times per second for ``window`` seconds,
+    and prints one JSON line summarizing the window:
+
+        * ``samples`` and ``seconds``: number of samples and length of the
+          window.
+        * ``cpu``: minimum, average and maximum remaining CPU percentage.
+        * ``cpu_steal``: average percentage of time stolen by the hypervisor.
+        * ``memory_kb``: minimum, average and maximum available memory.
+        * ``top_cpu``: the ``top`` processes with the highest average CPU
+          percentage, as ``[pid, name, cpu, cpu_max, memory]`` lists, where
+          ``cpu_max`` is the highest CPU percentage of a single sample and
+          ``memory`` the highest memory percentage.
+        * ``top_memory``: the ``top`` processes with the highest memory
+          percentage, in the same form.
+        * ``processes``: names of the processes running at the end.
+
+    With ``--aggregate``, the processes sharing the same name are added up
+    and the first item of every top process is the number of processes.
+
+Usage::
+
+    python sampler.py WINDOW RATE TOP [--aggregate]
+"""
+
+import json
+import os
+import sys
+import time
+
+CPU_FIELDS = 8
+"""
+int: Number of ``/proc/stat`` CPU counters used: user, nice, system, idle,
+iowait, irq, softirq and steal. Guest time is already included in user.
+"""
+
+
+def read_cpu():
+    """
+    Returns the busy, steal and total jiffies of the whole CPU. Idle and
+    iowait time count as available CPU.
+    """
+    with open('/proc/stat') as stat_file:
+        fields = [int(value) for value in stat_file.readline().split()[1:CPU_FIELDS + 1]]
+    fields += [0] * (CPU_FIELDS - len(fields))
+    total = sum(fields)
+    return total - fields[3] - fields[4], fields[7], total
+
+
+def read_memory():
+    """
+    Returns the total and the available memory in kB.
+    """
+    values = {}
+    with open('/proc/meminfo') as meminfo_file:
+        for line in meminfo_file:
+            name, _, value = line.partition(':')
+            values[name] = int(value.split()[0])
+    available = values.get('MemAvailable')
+    if available is None:
+        available = values['MemFree'] + values.get('Buffers', 0) + values.get('Cached', 0)
+    return values['MemTotal'], available
+
+
+def read_processes():
+    """
+    Returns the name, CPU jiffies and resident pages of every process but
+    the sampler, keyed by PID.
+    """
+    processes = {}
+    own_pid = str(os.getpid())
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit() or pid == own_pid:
+            continue
+        try:
+            with open('/proc/%s/stat' % pid) as stat_file:
+                line = stat_file.read()
+        except (IOError, OSError):
+            continue
+        name = line[line.find('(') + 1:line.rfind(')')]
+        fields = line[line.rfind(')') + 2:].split()
+        processes[int(pid)] = (name, int(fields[11]) + int(fields[12]), int(fields[21]))
+    return processes
+
+
+def sample(window, rate, top, aggregate=False):
+    """
+    Samples the server during ``window`` seconds.
+
+    Parameters
+    ----------
+    window: float
+        Length of the window in seconds.
+    rate: float
+        Number of samples per second.
+    top: int
+        Number of top processes reported for CPU and memory.
+    aggregate: bool
+        Whether to add up the processes sharing the same name.
+
+    Returns
+    -------
+    dictionary
+        The summary of the window, see the notes of the module.
+    """
+    clock_ticks = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    step = 1.0 / rate
+    steps = max(1, int(round(window * rate)))
+    cpu_values = []
+    steal_values = []
+    memory_values = []
+    # Name, first jiffies, last jiffies, highest CPU and highest memory:
+    process_stats = {}
+    start = time.time()
+    previous_time = start
+    previous_cpu = read_cpu()
+    previous_processes = read_processes()
+    for pid, (name, jiffies, pages) in previous_processes.items():
+        process_stats[pid] = [name, jiffies, jiffies, 0.0, 0.0]
+    for index in range(1, steps + 1):
+        time.sleep(max(0, start + index * step - time.time()))
+        now = time.time()
+        cpu = read_cpu()
+        mem_total, mem_available = read_memory()
+        processes = read_processes()
+        elapsed = max(now - previous_time, 1e-6)
+        busy, steal, total = [curr - prev for prev, curr in zip(previous_cpu, cpu)]
+        cpu_values.append(100.0 - (100.0 * busy / total if total > 0 else 0.0))
+        steal_values.append(100.0 * steal / total if total > 0 else 0.0)
+        memory_values.append(mem_available)
+        for pid, (name, jiffies, pages) in processes.items():
+            entry = process_stats.get(pid)
+            if entry is None:
+                entry = process_stats[pid] = [name, jiffies, jiffies, 0.0, 0.0]
+            previous = previous_processes.get(pid)
+            if previous is not None:
+                cpu_percent = 100.0 * (jiffies - previous[1]) / clock_ticks / elapsed
+                entry[3] = max(entry[3], cpu_percent)
+            entry[2] = jiffies
+            entry[4] = max(entry[4], 100.0 * pages * page_size / 1024 / mem_total)
+        previous_time, previous_cpu, previous_processes = now, cpu, processes
+    seconds = previous_time - start
+    rows = []
+    for pid, (name, first, last, cpu_max, memory) in process_stats.items():
+        if pid in previous_processes:
+            rows.append([pid, name, 100.0 * (last - first) / clock_ticks / seconds, cpu_max, memory])
+    if aggregate:
+        totals = {}
+        for pid, name, cpu, cpu_max, memory in rows:
+            total = totals.setdefault(name, [0, name, 0.0, 0.0, 0.0])
+            total[0] += 1
+            total[2] += cpu
+            total[3] += cpu_max
+            total[4] += memory
+        rows = list(totals.values())
+    for row in rows:
+        row[2:] = [round(value, 1) for value in row[2:]]
+    return {
+        'samples': steps,
+        'seconds': round(seconds, 3),
+        'cpu': [round(min(cpu_values), 1), round(sum(cpu_values) / steps, 1),
+                round(max(cpu_values), 1)],
+        'cpu_steal': round(sum(steal_values) / steps, 1),
+        'memory_kb': [min(memory_values), int(sum(memory_values) / steps), max(memory_values)],
+        'top_cpu': sorted(rows, key=lambda row: row[2], reverse=True)[:top],
+        'top_memory': sorted(rows, key=lambda row: row[4], reverse=True)[:top],
+        'processes': [previous_processes[pid][0] for pid in sorted(previous_processes)],
+    }
+
+
+def main(arguments):
+    """
+    Runs the sampler with the command line arguments and prints its summary.
+    """
+    aggregate = '--aggregate' in arguments
+    arguments = [argument for argument in arguments if argument != '--aggregate']
+    summary = sample(float(arguments[0]), float(arguments[1]), int(arguments[2]), aggregate)
+    sys.stdout.write(json.dumps(summary, separators=(',', ':')) + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,263 @@
+"""
+Adaptive polling scheduler: samples the busy servers more often than the
+idle ones.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Notes
+-----
+    Every time a server is sampled, its volatility is measured as how much
+    its remaining CPU, its available memory and its set of top processes
+    changed since the previous sample, and smoothed with an exponential
+    moving average. The next sample of the server is scheduled between the
+    minimum interval, for a volatility of ``VOLATILE`` or more, and the
+    maximum interval, for a server that did not change at all.
+
+    The servers wait on a priority queue ordered by the time of their next
+    sample. An optional budget limits how many samples are started per
+    second: when it runs out, the servers that have been due the longest
+    go first.
+"""
+
+import heapq
+import itertools
+import time
+from concurrent import futures
+from vmdiag import stats
+
+VOLATILE = 0.2
+"""
+float: Volatility at and above which a server is sampled at the minimum
+interval.
+"""
+
+SMOOTHING = 0.5
+"""
+float: Weight of the last sample on the moving average of the volatility.
+"""
+
+
+def summarize(result):
+    """
+    Extracts what the volatility is measured on from a server result.
+
+    Parameters
+    ----------
+    result: HostStats or dictionary
+        The usage data, or the error status, of the server.
+
+    Returns
+    -------
+    tuple
+        The remaining CPU percentage, the available memory in kB and the
+        frozenset of the top process names, or None if the result is an
+        error status.
+    """
+    stats_dict = stats.as_dict(result)
+    capacity = stats_dict.get('remaining_capacity')
+    if capacity is None:
+        return None
+    names = set()
+    for key, top_dict in stats_dict.items():
+        if key.startswith('top_'):
+            for first, process in top_dict.items():
+                names.add(process.get('name', first))
+    return capacity.get('cpu', 0.0), capacity.get('memory_kb', 0), frozenset(names)
+
+
+def volatility(previous, current):
+    """
+    Measures how much a server changed between two samples.
+
+    Parameters
+    ----------
+    previous: tuple
+        Summary of the previous sample, see ``summarize()``.
+    current: tuple
+        Summary of the current sample.
+
+    Returns
+    -------
+    float
+        The largest of the change of the remaining CPU, as a fraction of the
+        whole CPU, the relative change of the available memory and the share
+        of top processes that entered or left the top, between 0 and 1.
+    """
+    cpu_change = abs(current[0] - previous[0]) / 100
+    memory_change = abs(current[1] - previous[1]) / max(current[1], previous[1], 1)
+    union = previous[2] | current[2]
+    top_change = 1 - len(previous[2] & current[2]) / len(union) if union else 0.0
+    return min(1.0, max(cpu_change, memory_change, top_change))
+
+
+def interval_for(score, min_interval, max_interval):
+    """
+    Returns the time until the next sample of a server.
+
+    Parameters
+    ----------
+    score: float
+        Smoothed volatility of the server.
+    min_interval: float
+        Interval for a volatility of ``VOLATILE`` or more.
+    max_interval: float
+        Interval for a volatility of 0.
+
+    Returns
+    -------
+    float
+        The interval in seconds, interpolated geometrically between the
+        bounds, so every step of volatility shortens it by the same factor.
+    """
+    fraction = min(1.0, score / VOLATILE)
+    return max_interval * (min_interval / max_interval) ** fraction
+
+
+class AdaptiveScheduler:
+    """
+    Samples every server at an interval that follows its volatility.
+
+    Parameters
+    ----------
+    targets: iterable
+        Iterable of ``(ip_address, username, key)`` tuples.
+    min_interval: float
+        Shortest time in seconds between two samples of a server. New
+        servers start at this interval.
+    max_interval: float
+        Longest time in seconds between two samples of a server.
+    rate: float
+        Maximum number of samples started per second, None for no limit.
+
+    Attributes
+    ----------
+    targets: list
+        List of ``(ip_address, username, key)`` tuples.
+    min_interval: float
+        Shortest time in seconds between two samples of a server.
+    max_interval: float
+        Longest time in seconds between two samples of a server.
+    rate: float
+        Maximum number of samples started per second, None for no limit.
+    intervals: dictionary
+        Current interval of every server, keyed by IP address.
+
+    Raises
+    ------
+    Exception
+        Invalid intervals. Should be 0 < minimum <= maximum
+    Exception
+        Invalid rate. Should be greater than 0
+    """
+
+    def __init__(self, targets, min_interval, max_interval, rate=None):
+        if not 0 < min_interval <= max_interval:
+            raise Exception('Invalid intervals. Should be 0 < minimum <= maximum')
+        if rate is not None and rate <= 0:
+            raise Exception('Invalid rate. Should be greater than 0')
+        self.targets = list(targets)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.rate = rate
+        self.intervals = dict((target[0], min_interval) for target in self.targets)
+        self._summaries = {}
+        self._scores = {}
+
+    def update(self, ip_address, result):
+        """
+        Measures the volatility of a new sample and updates the interval of
+        the server. Error results leave the interval unchanged.
+
+        Parameters
+        ----------
+        ip_address: string
+            IPv4 address of the server.
+        result: HostStats or dictionary
+            The usage data, or the error status, of the server.
+
+        Returns
+        -------
+        float
+            The new interval of the server, in seconds.
+        """
+        summary = summarize(result)
+        if summary is None:
+            return self.intervals[ip_address]
+        previous = self._summaries.get(ip_address)
+        self._summaries[ip_address] = summary
+        if previous is None:
+            return self.intervals[ip_address]
+        change = volatility(previous, summary)
+        score = self._scores.get(ip_address, change)
+        score = SMOOTHING * change + (1 - SMOOTHING) * score
+        self._scores[ip_address] = score
+        self.intervals[ip_address] = interval_for(score, self.min_interval, self.max_interval)
+        return self.intervals[ip_address]
+
+    def run(self, retrieve, concurrency=10, samples=None):
+        """
+        Samples the servers on a bounded thread pool, each one when it is
+        due, and yields every result as soon as its host finishes.
+
+        Notes
+        -----
+            * The next sample of a server is due one interval after its last
+              sample started, so the time spent querying it does not add up.
+            * If ``retrieve`` raises an exception, it is raised again when the
+              result of that host is yielded.
+
+        Parameters
+        ----------
+        retrieve: function
+            Function called as ``retrieve(ip_address, username, key)`` that
+            returns the usage data, or the error status, of a single server.
+        concurrency: int
+            Maximum number of servers queried at the same time.
+        samples: int
+            Total number of samples to take. If not given, runs forever.
+
+        Yields
+        ------
+        tuple
+            A ``(timestamp, ip_address, result)`` tuple for every sample,
+            where ``timestamp`` is the UNIX time the sample started.
+
+        Raises
+        ------
+        Exception
+            Invalid concurrency. Should be at least 1
+        """
+        if concurrency < 1:
+            raise Exception('Invalid concurrency. Should be at least 1')
+        order = itertools.count()
+        now = time.monotonic()
+        queue = [(now, next(order), target) for target in self.targets]
+        heapq.heapify(queue)
+        next_start = now
+        started = 0
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = {}
+            while pending or (queue and (samples is None or started < samples)):
+                now = time.monotonic()
+                while (queue and len(pending) < concurrency and queue[0][0] <= now
+                       and next_start <= now and (samples is None or started < samples)):
+                    _, _, target = heapq.heappop(queue)
+                    future = executor.submit(retrieve, *target)
+                    pending[future] = (target, time.time(), now)
+                    started += 1
+                    if self.rate is not None:
+                        next_start = max(next_start, now) + 1 / self.rate
+                timeout = None
+                if queue and len(pending) < concurrency and (samples is None or started < samples):
+                    timeout = max(0, max(queue[0][0], next_start) - time.monotonic())
+                if not pending:
+                    time.sleep(timeout)
+                    continue
+                done, _ = futures.wait(pending, timeout=timeout, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    target, timestamp, start = pending.pop(future)
+                    result = future.result()
+                    interval = self.update(target[0], result)
+                    heapq.heappush(queue, (start + interval, next(order), target))
+                    yield timestamp, target[0], result
@@ -6,8 +6,34 @@ consumption information.
 * Email: andres.arias12@gmail.com
 """
 
+import hashlib
+import io
+import itertools
+import os
+import socket
+import time
 import paramiko
 import click
+from vmdiag import credentials, profiling, stats
+
+
+class ProfiledSSHClient(paramiko.SSHClient):
+    """
+    ``SSHClient`` that adds the time spent authenticating to the ``auth``
+    phase of its profile, so it can be told apart from the key exchange.
+
+    Attributes
+    ----------
+    profile: HostProfile
+        Profile of the current query, None if profiling is disabled.
+    """
+
+    profile = None
+
+    def _auth(self, *args, **kwargs):
+        with profiling.phase(self.profile, 'auth'):
+            return super()._auth(*args, **kwargs)
+
 
 class Server:
     """
@@ -21,9 +47,19 @@ class Server:
     username: string
         Username to log into via SSH.
     creds: string
-        PEM key path to use for SSH authentication.
+        PEM key path to use for SSH authentication, or ``credentials.AGENT``
+        to use the ``ssh-agent`` keys. Every key file is only parsed once,
+        see ``credentials.KEYS``.
     timeout: int
         Time in seconds to wait before giving up trying to connected.
+    known_hosts: KnownHosts
+        Known host keys the server is verified against. If not given, any
+        host key is accepted.
+    port: int
+        TCP port of the SSH server.
+    compress: bool
+        Whether to use the compact transport: SSH compression, and the
+        process listings dictionary encoded on the server.
 
     Attributes
     ----------
@@ -31,12 +67,29 @@ class Server:
         IPv4 address of the remote server.
     username: string
         Username to log into via SSH.
-    credentials: string
+    credentials: PKey
+        Private key loaded from ``key_path``, None when using the agent.
+    key_path: string
         PEM key path to use for SSH authentication.
+    port: int
+        TCP port of the SSH server.
+    compress: bool
+        Whether the compact transport is used.
     timeout: int
         Time in seconds to wait before giving up trying to connected.
+    deadline: float
+        ``time.monotonic()`` value after which connecting and running
+        commands fail with ``TimeoutError``. None if there is no deadline.
+    profile: HostProfile
+        Where the timings and counters of the current query are recorded,
+        None to not record them.
     connected: bool
         Indicates if a connection is currently established or not
+    cpu_times: dictionary
+        ``/proc/stat`` counters read on the last query, used to compute the
+        CPU usage of the next one.
+    sampler_path: string
+        Path of the sampler on the server, once uploaded on this connection.
     """
 
     connected = False
@@ -44,29 +97,135 @@ class Server:
     bool: Indicates if a connection is currently established or not.
     """
 
-    def __init__(self, ip_address, username, creds, timeout=60):
+    TOP_RETRIES = 3
+    """
+    int: Times the top processes command is re-run when it returns less
+    processes than requested.
+    """
+
+    SAMPLER_DIRECTORY = '.vmdiag'
+    """
+    string: Directory, relative to the home of the user, where the sampler
+    is uploaded.
+    """
+
+    SAMPLER_COMMAND = ('PYTHON=$(command -v python3 || command -v python) || '
+                       '{ echo \'{"error":"Python not found"}\'; exit 1; }; '
+                       'exec "$PYTHON" %s %g %g %d')
+    """
+    string: Command running the sampler with the first Python interpreter
+    found, for its path, window, rate and number of top processes.
+    """
+
+    CHUNK_SIZE = 32768
+    """
+    int: Maximum number of bytes read from a command output at once.
+    """
+
+    def __init__(self, ip_address, username, creds, timeout=60, known_hosts=None, port=22,
+                 compress=False):
         self.ip_address = ip_address
         self.username = username
-        self.client = paramiko.SSHClient()
+        self.client = ProfiledSSHClient()
         self.timeout = timeout
-        self.credentials = paramiko.RSAKey.from_private_key_file(creds)
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.port = port
+        self.compress = compress
+        self.key_path = creds
+        self.cpu_times = None
+        self.sampler_path = None
+        self.deadline = None
+        self.profile = None
+        self.credentials = credentials.KEYS.get(creds)
+        if known_hosts is None:
+            self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        else:
+            # Same host names paramiko uses on the known hosts:
+            hostname = ip_address if port == 22 else '[%s]:%d' % (ip_address, port)
+            known_hosts.attach(self.client, hostname)
+
+    def set_deadline(self, seconds):
+        """
+        Limits the time left for connecting and running commands on the
+        server. Once it runs out, they fail with ``TimeoutError`` and the
+        command being run is cancelled.
+
+        Parameters
+        ----------
+        seconds: float
+            Time in seconds from now. None removes the deadline.
+        """
+        self.deadline = None if seconds is None else time.monotonic() + seconds
+
+    def __remaining(self):
+        """
+        Returns the time in seconds left before the deadline, or None if
+        there is no deadline. Raises ``TimeoutError`` if it already passed.
+        """
+        if self.deadline is None:
+            return None
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('Deadline exceeded on %s' % self.ip_address)
+        return remaining
+
+    def __expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
 
     def connect(self):
         """
         Establishes a connection via SSH to the remote server using
         the parameters provided when initializing the Server object.
 
+        Notes
+        -----
+            * The timeout applies to the TCP connection, the SSH banner and
+              the authentication, and is shortened to the time left before the
+              deadline, if any.
+
         Raises
         ------
+        TimeoutError
+            If the connection times out or the deadline is exceeded.
+        BadHostKeyException
+            If the server key does not match the known one.
         Exception
-            If connection times out or server not found.
+            If server not found.
         """
-        self.client.connect(hostname=self.ip_address,
-                            username=self.username,
-                            pkey=self.credentials,
-                            timeout=self.timeout)
-        click.echo("Succesfully logged into address %s" % self.ip_address)
+        timeout = self.timeout
+        remaining = self.__remaining()
+        if remaining is not None:
+            timeout = min(timeout, remaining)
+        profile = self.client.profile = self.profile
+        try:
+            # The TCP connection is opened here to time it apart from the
+            # SSH handshake:
+            with profiling.phase(profile, 'connect'):
+                sock = socket.create_connection((self.ip_address, self.port), timeout)
+            auth_time = profile.phases['auth'] if profile is not None else 0
+            try:
+                with profiling.phase(profile, 'kex'):
+                    self.client.connect(hostname=self.ip_address,
+                                        port=self.port,
+                                        username=self.username,
+                                        pkey=self.credentials,
+                                        timeout=timeout,
+                                        banner_timeout=timeout,
+                                        auth_timeout=timeout,
+                                        compress=self.compress,
+                                        sock=sock)
+            except Exception:
+                sock.close()
+                raise
+            finally:
+                if profile is not None:
+                    profile.phases['kex'] -= profile.phases['auth'] - auth_time
+        except socket.timeout:
+            raise TimeoutError('Connection to %s timed out' % self.ip_address)
+        except Exception:
+            if self.__expired():
+                raise TimeoutError('Deadline exceeded on %s' % self.ip_address)
+            raise
+        click.echo("Succesfully logged into address %s" % self.ip_address, err=True)
         self.connected = True
 
     def disconnect(self):
@@ -76,6 +235,102 @@ class Server:
         """
         if self.connected:
             self.client.close()
+            self.connected = False
+
+    def is_active(self):
+        """
+        Checks whether the SSH connection is still established.
+
+        Returns
+        -------
+        bool
+            True if the connection can still be used to run commands.
+        """
+        if not self.connected:
+            return False
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def set_keepalive(self, interval):
+        """
+        Sends an SSH keepalive packet every ``interval`` seconds so idle
+        connections are not dropped by the server or the network.
+
+        Parameters
+        ----------
+        interval: int
+            Seconds between keepalive packets, 0 to disable them.
+        """
+        self.client.get_transport().set_keepalive(interval)
+
+    def __stream(self, command):
+        """
+        Runs a command on the server and yields its output lines, without
+        their newline, as the output arrives (see ``stats.iter_lines()``).
+        Closing the generator before the end cancels the command. If the
+        deadline passes before the output is complete, the command is
+        cancelled and ``TimeoutError`` is raised.
+        """
+        yield from stats.iter_lines(self.__chunks(command))
+
+    def __chunks(self, command):
+        """
+        Runs a command on the server and yields its output in chunks of up to
+        ``CHUNK_SIZE`` bytes, as they arrive.
+        """
+        channel = None
+        received = 0
+        try:
+            with profiling.phase(self.profile, 'exec'):
+                stdin, stdout, stderr = self.client.exec_command(command, timeout=self.__remaining())
+                channel = stdout.channel
+            while True:
+                with profiling.phase(self.profile, 'exec'):
+                    channel.settimeout(self.__remaining())
+                    data = channel.recv(self.CHUNK_SIZE)
+                if not data:
+                    break
+                received += len(data)
+                yield data
+        except (socket.timeout, TimeoutError):
+            if channel is not None:
+                channel.close()
+            raise TimeoutError('Deadline exceeded on %s running: %s' % (self.ip_address, command))
+        finally:
+            if channel is not None and not channel.eof_received:
+                channel.close() # Stopped early, the rest of the output is not needed
+            if self.profile is not None:
+                self.profile.add('round_trips')
+                self.profile.add('bytes_received', received)
+
+    def __parse(self, command, parse):
+        """
+        Runs a command on the server and parses its output as it arrives.
+
+        Parameters
+        ----------
+        command: string
+            The command.
+        parse: function
+            Called with the iterator over the output lines, without their
+            newline. The command is cancelled if it returns before reading
+            them all.
+
+        Returns
+        -------
+        object
+            What ``parse`` returns.
+        """
+        lines = self.__stream(command)
+        profile = self.profile
+        exec_time = profile.phases['exec'] if profile is not None else 0
+        try:
+            with profiling.phase(profile, 'parse'):
+                return parse(lines)
+        finally:
+            lines.close()
+            if profile is not None: # Waiting for the output is not parsing
+                profile.phases['parse'] -= profile.phases['exec'] - exec_time
 
     def get_running_proccesses(self):
         """
@@ -89,67 +344,82 @@ class Server:
             on the server.
 
         """
-        stdin, stdout, stderr = self.client.exec_command('ps axco command --sort=-pcpu')
-        process_list = []
-        process_list_raw = stdout.readlines()
-        process_list_raw.pop(0)
-        for proc in process_list_raw:
-            process_list.append(proc.rstrip())
-        return process_list
+        if self.compress:
+            return self.__parse('ps axco command --sort=-pcpu | awk \'%s\''
+                                % stats.COMPACT_NAMES_AWK, stats.parse_compact_names)
+        # Every line but the header:
+        return self.__parse('ps axco command --sort=-pcpu',
+                            lambda lines: [line.rstrip() for line in itertools.islice(lines, 1, None)])
 
 
-    def get_top_cpu(self):
+    def get_top_cpu(self, count=3, aggregate=False):
         """
         Queries the server for the currently running processes (one interval) and
-        returns a dictionary containing the top 3 processes consuming CPU.
+        returns a dictionary containing the top processes consuming CPU.
+
+        Parameters
+        ----------
+        count: int
+            Number of processes to return.
+        aggregate: bool
+            Whether to add up the processes sharing the same name and return
+            the top names instead of the top processes.
 
         Returns
         -------
         dictionary
-            A dictionary containing the top 3 processes consuming CPU, where the
-            keys are de process names and the value the consumed CPU percentage.
+            A dictionary containing the top processes consuming CPU, from greater
+            to lower, in the format returned by ``stats.top_processes()``.
 
         """
-        stdin, stdout, stderr = self.client.exec_command('ps axco command,pcpu --sort=-pcpu | head -n 4')
-        output_lines = stdout.readlines()
-        line_count = len(output_lines)
-        # Sometimes the command only returns 2 processes instead of 3, re-running
-        # the command fixes it:
-        while line_count != 4:
-            stdin, stdout, stderr = self.client.exec_command('ps axco command,pcpu --sort=-pcpu | head -n 4')
-            output_lines = stdout.readlines()
-            line_count = len(output_lines)
-        return self.__clean_stdout(output_lines)
+        return self.__top_processes('cpu', count, aggregate)
 
 
-    def get_top_mem(self):
+    def get_top_mem(self, count=3, aggregate=False):
         """
         Queries the server for the currently running processes (one interval) and
-        returns a dictionary containing the top 3 processes consuming memory.
+        returns a dictionary containing the top processes consuming memory.
+
+        Parameters
+        ----------
+        count: int
+            Number of processes to return.
+        aggregate: bool
+            Whether to add up the processes sharing the same name and return
+            the top names instead of the top processes.
 
         Returns
         -------
         dictionary
-            A dictionary containing the top 3 processes consuming memory, where the
-            keys are de process names and the value the consumed memory percentage.
+            A dictionary containing the top processes consuming memory, from greater
+            to lower, in the format returned by ``stats.top_processes()``.
 
         """
-        stdin, stdout, stderr = self.client.exec_command('ps axco command,pmem --sort=-pmem | head -n 4')
-        output_lines = stdout.readlines()
-        return self.__clean_stdout(output_lines)
+        return self.__top_processes('memory', count, aggregate)
 
 
-    def __clean_stdout(self, output_lines):
-        process_dict = {}
-        output_lines.pop(0)
-        for proc in output_lines:
-            split_list = proc.split(' ')
-            clean_list = []
-            for i in split_list:
-                if i != '':
-                    clean_list.append(i.rstrip())
-            process_dict[clean_list[0]] = float(clean_list[1])
-        return process_dict
+    def __top_processes(self, metric, count, aggregate):
+        sort_key = {'cpu': 'pcpu', 'memory': 'pmem'}[metric]
+        command = 'ps axo pid,pcpu,pmem,comm --sort=-%s' % sort_key
+        if aggregate: # Every process is needed to add up the ones with the same name
+            processes = self.__parse(command, stats.parse_processes)
+        else:
+            # The output is sorted, so reading stops after the header and the
+            # first processes:
+            command += ' | head -n %d' % (count + 1)
+            parse = lambda lines: stats.parse_processes(itertools.islice(lines, count + 1))
+            processes = self.__parse(command, parse)
+            # Sometimes the command returns less processes than requested,
+            # re-running the command fixes it. The server may also have less
+            # processes than requested, so give up after a few attempts:
+            for _ in range(self.TOP_RETRIES):
+                if len(processes) == count:
+                    break
+                if self.profile is not None:
+                    self.profile.add('retries')
+                processes = self.__parse(command, parse)
+        with profiling.phase(self.profile, 'parse'):
+            return stats.top_processes(processes, metric, count, aggregate)
 
 
     def get_remaining_cap(self):
@@ -157,25 +427,140 @@ class Server:
         Queries the server for the current CPU and memory usage and returns
         the remaining CPU percentage and memory in kB available.
 
+        Notes
+        -----
+            * As with ``get_stats()``, the CPU usage is computed against the
+              ``/proc/stat`` counters of the previous query on this instance,
+              and the first query reads them twice, one second apart.
+
         Returns
         -------
         dictionary
             A dictionary where the ``cpu`` key indicates the remaining CPU
             percentage available and the ``memory_kb`` key indicates the
-            remaining memory in kB.
-
-        """
-        result_dict = {}
-        stdin, stdout, stderr = self.client.exec_command('grep \'cpu \' /proc/stat | awk \'{usage=($2+$4)*100/($2+$4+$5)} END {print usage}\'')
-        total_cpu = stdout.readlines()[0].rstrip()
-        remaining_cpu = (1 - float(total_cpu)) * 100
-        result_dict['cpu'] = remaining_cpu
-        stdin, stdout, stderr = self.client.exec_command('cat /proc/meminfo | grep MemAvailable')
-        split_list = stdout.readlines()[0].split(' ')
-        clean_list = []
-        for i in split_list:
-            if i != '':
-                clean_list.append(i.rstrip())
-        result_dict['memory_kb'] = int(clean_list[1])
-        return result_dict
+            remaining memory in kB. See ``stats.cpu_usage()`` for the other
+            keys.
+
+        """
+        sections = stats.CAPACITY_SECTIONS
+        if self.cpu_times is None:
+            sections = [stats.CPU_BASELINE_SECTION] + sections
+        capacity, self.cpu_times = self.__parse(
+            stats.batch_command(sections),
+            lambda lines: stats.parse_capacity(lines, self.cpu_times))
+        return capacity
+
+    def get_stats(self, backend='ps', top=3, aggregate=False):
+        """
+        Queries the server for every usage statistic using a single remote
+        command, so the whole query costs one round trip and every value
+        comes from the same snapshot.
+
+        Notes
+        -----
+            * The CPU usage is computed against the ``/proc/stat`` counters of
+              the previous query on this instance. The first query has none, so
+              it reads the counters twice, one second apart.
+            * With the compact transport, the ``ps`` backend receives the
+              process table dictionary encoded. See ``stats.COMPACT_BATCH_SECTIONS``.
 
+        Parameters
+        ----------
+        backend: string
+            How the process table is obtained: ``ps`` runs ``ps`` on the server,
+            ``proc`` reads ``/proc/[pid]/stat`` and builds the table locally.
+        top: int
+            Number of top processes to report for every metric.
+        aggregate: bool
+            Whether to rank the process names instead of the individual processes.
+
+        Returns
+        -------
+        HostStats
+            The usage statistics of the server. ``as_dict()`` returns them with
+            the ``running_processes``, ``top_N_cpu_consumption``,
+            ``top_N_memory_consumption`` and ``remaining_capacity`` keys.
+
+        """
+        sections = stats.BACKENDS[backend]
+        if self.compress and backend == 'ps':
+            sections = stats.COMPACT_BATCH_SECTIONS
+        if self.cpu_times is None:
+            sections = [stats.CPU_BASELINE_SECTION] + sections
+        host_stats, self.cpu_times = self.__parse(
+            stats.batch_command(sections),
+            lambda lines: stats.parse_batch(lines, self.cpu_times, top, aggregate))
+        return host_stats
+
+    def upload_sampler(self):
+        """
+        Uploads the sampler (``sampler.py``) to the server over SFTP, unless
+        it is already there.
+
+        Notes
+        -----
+            * The file name holds a hash of the sampler, so a server keeps the
+              copy uploaded by any previous query until ``vmdiag`` is updated.
+            * The file is written under a temporary name and renamed, so a
+              query running at the same time never sees half a file.
+
+        Returns
+        -------
+        string
+            Path of the sampler on the server, relative to the home of the
+            user.
+        """
+        if self.sampler_path is not None:
+            return self.sampler_path
+        with open(os.path.join(os.path.dirname(__file__), 'sampler.py'), 'rb') as sampler_file:
+            source = sampler_file.read()
+        path = '%s/sampler-%s.py' % (self.SAMPLER_DIRECTORY, hashlib.sha1(source).hexdigest()[:12])
+        try:
+            with profiling.phase(self.profile, 'exec'):
+                sftp = self.client.open_sftp()
+                try:
+                    sftp.get_channel().settimeout(self.__remaining())
+                    try:
+                        sftp.stat(path)
+                    except IOError:
+                        try:
+                            sftp.mkdir(self.SAMPLER_DIRECTORY)
+                        except IOError:
+                            pass # Already there
+                        temporary = '%s.%s.tmp' % (path, os.urandom(4).hex())
+                        sftp.putfo(io.BytesIO(source), temporary)
+                        sftp.posix_rename(temporary, path)
+                finally:
+                    sftp.close()
+        except (socket.timeout, TimeoutError):
+            raise TimeoutError('Deadline exceeded on %s uploading the sampler' % self.ip_address)
+        self.sampler_path = path
+        return path
+
+    def get_sampled_stats(self, window=5.0, rate=10.0, top=3, aggregate=False):
+        """
+        Samples the server many times over a window with the sampler, which
+        is uploaded on the first query, and returns the summary of the window.
+        The whole window costs one round trip.
+
+        Parameters
+        ----------
+        window: float
+            Length of the window in seconds. Should be shorter than the
+            deadline.
+        rate: float
+            Number of samples per second.
+        top: int
+            Number of top processes to report for every metric.
+        aggregate: bool
+            Whether to rank the process names instead of the individual processes.
+
+        Returns
+        -------
+        dictionary
+            The usage data of the server. See ``stats.parse_sampler()``.
+        """
+        command = self.SAMPLER_COMMAND % (self.upload_sampler(), window, rate, top)
+        if aggregate:
+            command += ' --aggregate'
+        return self.__parse(command, lambda lines: stats.parse_sampler(lines, top, aggregate))
@@ -0,0 +1,887 @@
+"""
+Functions for parsing the raw output of the commands run on the remote
+servers into usage statistics.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Notes
+-----
+    The batched collection mode runs a single composite command on the remote
+    server (see ``batch_command()``). Every section of its output is preceded
+    by a delimiter line, ``iter_sections()`` separates them as the output
+    arrives and ``parse_batch()`` derives every statistic from that single
+    snapshot, building the process table line by line without keeping the
+    output in memory.
+
+    There are two batched backends (see ``BACKENDS``). The ``ps`` backend runs
+    ``ps`` on the remote server. The ``proc`` backend only reads files: it
+    dumps ``/proc/[pid]/stat`` of every process and builds the process table
+    locally, so the remote server does not have to walk ``/proc`` and sort it.
+
+    Both backends produce the same process table, with the PID, name, CPU and
+    memory of every process. The top processes are selected from it locally
+    with a heap (see ``top_processes()``), so the remote server does not sort
+    the table once per metric.
+
+    The results are kept in compact containers until they are written:
+    ``ProcessTable`` stores the process table as columns of integers with
+    interned process names, shared by every server, and ``HostStats`` holds
+    the results of one server. ``as_dict()`` turns them into the JSON output.
+
+    The CPU usage is computed from the difference between two reads of the
+    ``/proc/stat`` counters, so it reflects the time between both reads and
+    not the average since boot. The first query on a connection reads the
+    counters twice (see ``CPU_BASELINE_SECTION``); the following ones reuse
+    the counters of the previous query.
+
+    With the compact transport (see ``COMPACT_BATCH_SECTIONS``), the process
+    table of the ``ps`` backend is dictionary encoded on the server with
+    ``awk``: every process name is sent once, the first time it appears, and
+    every process is sent as the increment of its PID over the previous one,
+    the index of its name and its CPU and memory percentages, which are left
+    out when both are zero. ``parse_compact_processes()`` decodes it back
+    into the same process table.
+
+    The ``sampler`` backend samples the server many times over a window with
+    a script run on the server (see ``sampler.py``), which prints a summary
+    of the window that ``parse_sampler()`` turns into the usage data.
+"""
+
+import codecs
+import heapq
+import itertools
+import json
+import sys
+from array import array
+
+SECTION_MARKER = '@@vmdiag@@'
+"""
+string: Prefix of the delimiter lines emitted between output sections.
+"""
+
+BATCH_SECTIONS = [
+    ('processes', 'ps axo pid,pcpu,pmem,comm'),
+    ('cpu', 'grep \'^cpu\' /proc/stat'),
+    ('memory', 'grep MemAvailable /proc/meminfo'),
+]
+"""
+list: Name and remote command of every section in the batched output of
+the ``ps`` backend.
+"""
+
+PROC_SECTIONS = [
+    ('uptime', 'cat /proc/uptime'),
+    ('sysconf', 'getconf CLK_TCK; getconf PAGESIZE'),
+    ('cpu', 'grep \'^cpu\' /proc/stat'),
+    ('memory', 'cat /proc/meminfo'),
+    ('pids', 'cat /proc/[0-9]*/stat 2>/dev/null'),
+]
+"""
+list: Name and remote command of every section in the batched output of
+the ``proc`` backend. The process table comes last, so it can be parsed as
+it arrives with the values of the other sections.
+"""
+
+CAPACITY_SECTIONS = BATCH_SECTIONS[1:]
+"""
+list: Name and remote command of every section in the batched output of
+the remaining capacity alone, read by ``parse_capacity()``.
+"""
+
+COMPACT_PROCESSES_AWK = (
+    'NR > 1 { name = $0; sub(/^ *[0-9]+ +[0-9.]+ +[0-9.]+ /, "", name); '
+    'if (!(name in ids)) { ids[name] = count++; print "=" name } '
+    'row = ($1 - last) " " ids[name]; if ($2 + 0 || $3 + 0) row = row " " $2 " " $3; '
+    'print row; last = $1 }')
+"""
+string: ``awk`` program encoding the output of ``ps axo pid,pcpu,pmem,comm``
+in the compact form read by ``parse_compact_processes()``. Only uses POSIX
+``awk``.
+"""
+
+COMPACT_NAMES_AWK = ('NR > 1 { if (!($0 in ids)) { ids[$0] = count++; print "=" $0 } '
+                     'print ids[$0] }')
+"""
+string: ``awk`` program encoding a list of process names, one per line after
+a header, in the compact form read by ``parse_compact_names()``.
+"""
+
+COMPACT_BATCH_SECTIONS = [
+    ('compact_processes', 'ps axo pid,pcpu,pmem,comm | awk \'%s\'' % COMPACT_PROCESSES_AWK),
+] + BATCH_SECTIONS[1:]
+"""
+list: Sections of the ``ps`` backend with the compact transport, where the
+process table is dictionary encoded on the server.
+"""
+
+BACKENDS = {
+    'ps': BATCH_SECTIONS,
+    'proc': PROC_SECTIONS,
+}
+"""
+dictionary: Sections of every batched backend, by backend name.
+"""
+
+CPU_BASELINE_SECTION = ('cpu_baseline', 'grep \'^cpu\' /proc/stat; sleep 1')
+"""
+tuple: Section prepended to the batched command when there are no previous
+``/proc/stat`` counters to compute the CPU usage from.
+"""
+
+METRICS = {'cpu': 2, 'memory': 3}
+"""
+dictionary: Column of every metric on the process table tuples.
+"""
+
+CPU_FIELDS = 8
+"""
+int: Number of ``/proc/stat`` CPU counters used: user, nice, system, idle,
+iowait, irq, softirq and steal. Guest time is already included in user.
+"""
+
+
+class ProcessTable:
+    """
+    Process table stored by columns: the PIDs, CPU and memory percentages
+    are kept on arrays of integers and the names are interned, so servers
+    running the same processes share the name strings.
+
+    Notes
+    -----
+        * The percentages are stored in tenths, the precision reported by
+          ``ps``, so they are returned exactly as they were parsed.
+        * Iterating over the table yields ``(pid, name, cpu, memory)`` tuples.
+
+    Attributes
+    ----------
+    pids: array
+        PID of every process.
+    names: list
+        Interned name of every process.
+    cpu: array
+        CPU percentage of every process, in tenths.
+    memory: array
+        Memory percentage of every process, in tenths.
+    """
+
+    __slots__ = ('pids', 'names', 'cpu', 'memory')
+
+    def __init__(self):
+        self.pids = array('i')
+        self.names = []
+        self.cpu = array('i')
+        self.memory = array('i')
+
+    def append(self, pid, name, cpu, memory):
+        """
+        Adds a process to the table.
+
+        Parameters
+        ----------
+        pid: int
+            PID of the process.
+        name: string
+            Name of the process.
+        cpu: float
+            CPU percentage used by the process.
+        memory: float
+            Memory percentage used by the process.
+        """
+        self.pids.append(pid)
+        self.names.append(sys.intern(name))
+        self.cpu.append(round(cpu * 10))
+        self.memory.append(round(memory * 10))
+
+    def __len__(self):
+        return len(self.pids)
+
+    def __iter__(self):
+        for pid, name, cpu, memory in zip(self.pids, self.names, self.cpu, self.memory):
+            yield pid, name, cpu / 10, memory / 10
+
+
+class HostStats:
+    """
+    Usage statistics of one server, kept in compact form until they are
+    written to the output.
+
+    Parameters
+    ----------
+    processes: ProcessTable
+        Process table of the server.
+    capacity: dictionary
+        Remaining capacity of the server, as reported on ``remaining_capacity``.
+    top: int
+        Number of top processes to report for every metric.
+    aggregate: bool
+        Whether to rank the process names instead of the individual processes.
+    """
+
+    __slots__ = ('processes', 'capacity', 'top', 'aggregate')
+
+    def __init__(self, processes, capacity, top=3, aggregate=False):
+        self.processes = processes
+        self.capacity = capacity
+        self.top = top
+        self.aggregate = aggregate
+
+    def as_dict(self):
+        """
+        Builds the JSON output of the server.
+
+        Returns
+        -------
+        dictionary
+            A dictionary with the ``running_processes``, ``top_N_cpu_consumption``,
+            ``top_N_memory_consumption`` and ``remaining_capacity`` keys. The
+            running processes are sorted by CPU usage, highest first.
+        """
+        stats_dict = {}
+        # Highest CPU first, as ``ps --sort=-pcpu`` lists them on the commands
+        # backend; the table is kept in PID order for the compact transport.
+        # The sort is stable, so the processes using the same CPU stay in PID
+        # order:
+        cpu = self.processes.cpu
+        order = sorted(range(len(cpu)), key=cpu.__getitem__, reverse=True)
+        names = self.processes.names
+        stats_dict['running_processes'] = [names[index] for index in order]
+        for metric in ('cpu', 'memory'):
+            stats_dict['top_%d_%s_consumption' % (self.top, metric)] = top_processes(
+                self.processes, metric, self.top, self.aggregate)
+        stats_dict['remaining_capacity'] = self.capacity
+        return stats_dict
+
+
+def as_dict(host_stats):
+    """
+    Returns the JSON output of a server result. Can be used as the ``default``
+    function of ``json.dumps()``.
+
+    Parameters
+    ----------
+    host_stats: HostStats or dictionary
+        The result of a server.
+
+    Returns
+    -------
+    dictionary
+        The JSON output of the server.
+
+    Raises
+    ------
+    TypeError
+        If the given object is not a server result.
+    """
+    if isinstance(host_stats, HostStats):
+        return host_stats.as_dict()
+    if isinstance(host_stats, dict):
+        return host_stats
+    raise TypeError('Object of type %s is not JSON serializable' % type(host_stats).__name__)
+
+
+def batch_command(sections=None):
+    """
+    Builds the composite shell command that emits every section preceded by
+    its delimiter line.
+
+    Parameters
+    ----------
+    sections: list
+        List of ``(name, command)`` tuples. Defaults to ``BATCH_SECTIONS``.
+
+    Returns
+    -------
+    string
+        The command to run on the remote server.
+    """
+    if sections is None:
+        sections = BATCH_SECTIONS
+    commands = []
+    for name, command in sections:
+        commands.append('echo \'%s %s\'; %s' % (SECTION_MARKER, name, command))
+    return '; '.join(commands)
+
+
+def iter_lines(chunks):
+    """
+    Splits the output of a remote command into lines as it arrives.
+
+    Notes
+    -----
+        * Single pass: every chunk is decoded and split once, and only the
+          unfinished line at its end is kept for the next chunk, so the
+          memory used does not grow with the output.
+        * Only ``\\n`` ends a line, any other control character is part of
+          the line, like in the process names.
+
+    Parameters
+    ----------
+    chunks: iterable
+        Chunks of UTF-8 bytes, split anywhere. Invalid bytes are replaced.
+
+    Yields
+    ------
+    string
+        Every line, without its newline. A last line without a newline is
+        yielded too.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).split('\n')
+        pending = lines.pop()
+        yield from lines
+    pending += decoder.decode(b'', True)
+    if pending:
+        yield pending
+
+
+def iter_sections(output_lines):
+    """
+    Splits the output of a batched command into its sections as it is read,
+    without keeping it in memory.
+
+    Parameters
+    ----------
+    output_lines: iterable
+        Lines returned by the remote server, read once.
+
+    Yields
+    ------
+    tuple
+        The name of every section and an iterator over its lines (without
+        trailing newlines), which reads them from ``output_lines``. The lines
+        left unread when the next section is requested are skipped.
+    """
+    lines = iter(output_lines)
+    following = []
+
+    def section_lines():
+        for line in lines:
+            line = line.rstrip('\n')
+            if line.startswith(SECTION_MARKER):
+                following.append(line[len(SECTION_MARKER):].strip())
+                return
+            yield line
+
+    for _ in section_lines(): # Skip anything before the first section
+        pass
+    while following:
+        body = section_lines()
+        yield following.pop(), body
+        for _ in body:
+            pass
+
+
+def _non_empty(lines):
+    """
+    Returns an iterator over the same lines, or None if there are none.
+    """
+    first = next(lines, None)
+    return None if first is None else itertools.chain((first,), lines)
+
+
+def parse_processes(lines):
+    """
+    Parses the output of ``ps axo pid,pcpu,pmem,comm``.
+
+    Parameters
+    ----------
+    lines: iterable
+        Output lines of ``ps``, including its header.
+
+    Returns
+    -------
+    ProcessTable
+        The processes in the order given by ``ps``.
+    """
+    processes = ProcessTable()
+    lines = iter(lines)
+    next(lines, None) # Skip the header
+    for line in lines:
+        fields = line.split(None, 3)
+        if len(fields) == 4:
+            processes.append(int(fields[0]), fields[3].rstrip(), float(fields[1]), float(fields[2]))
+    return processes
+
+
+def parse_compact_processes(lines):
+    """
+    Decodes the process table encoded with ``COMPACT_PROCESSES_AWK``.
+
+    Notes
+    -----
+        * A line starting with ``=`` holds a new process name, whose index is
+          the number of names before it. Any other line holds a process: the
+          increment of its PID over the previous process, the index of its
+          name and, unless both are zero, its CPU and memory percentages.
+
+    Parameters
+    ----------
+    lines: iterable
+        Lines of the encoded process table.
+
+    Returns
+    -------
+    ProcessTable
+        The processes in the order given by ``ps``, the same returned by
+        ``parse_processes()`` for the output before encoding.
+    """
+    processes = ProcessTable()
+    names = []
+    pid = 0
+    for line in lines:
+        line = line.rstrip('\n')
+        if line.startswith('='):
+            names.append(sys.intern(line[1:]))
+            continue
+        fields = line.split()
+        if len(fields) == 2:
+            fields += ['0', '0']
+        elif len(fields) != 4:
+            continue
+        pid += int(fields[0])
+        processes.append(pid, names[int(fields[1])], float(fields[2]), float(fields[3]))
+    return processes
+
+
+def parse_compact_names(lines):
+    """
+    Decodes a list of process names encoded with ``COMPACT_NAMES_AWK``.
+
+    Parameters
+    ----------
+    lines: iterable
+        Lines of the encoded list: a new name after a ``=``, or the index of
+        an already sent name.
+
+    Returns
+    -------
+    list
+        The process names, in the order they were listed.
+    """
+    names = []
+    process_names = []
+    for line in lines:
+        line = line.rstrip('\n')
+        if line.startswith('='):
+            names.append(line[1:])
+        elif line:
+            process_names.append(names[int(line)])
+    return process_names
+
+
+def parse_cpu_times(lines):
+    """
+    Parses the ``cpu`` lines of ``/proc/stat``.
+
+    Parameters
+    ----------
+    lines: list
+        The ``cpu`` lines of ``/proc/stat``: the aggregated one and one per core.
+
+    Returns
+    -------
+    dictionary
+        A dictionary where the keys are the line names (``cpu``, ``cpu0``, ...)
+        and the values lists with the ``CPU_FIELDS`` counters of every line.
+    """
+    cpu_times = {}
+    for line in lines:
+        fields = line.split()
+        if fields and fields[0].startswith('cpu'):
+            counters = [int(field) for field in fields[1:CPU_FIELDS + 1]]
+            counters += [0] * (CPU_FIELDS - len(counters))
+            cpu_times[fields[0]] = counters
+    return cpu_times
+
+
+def cpu_remaining(previous, current):
+    """
+    Computes the remaining CPU and the steal time between two reads of the
+    counters of one ``/proc/stat`` line.
+
+    Notes
+    -----
+        * Idle and iowait time count as available CPU. User, nice, system,
+          irq, softirq and steal time count as used CPU.
+
+    Parameters
+    ----------
+    previous: list
+        Counters of the first read.
+    current: list
+        Counters of the second read.
+
+    Returns
+    -------
+    tuple
+        The remaining CPU percentage and the steal time percentage.
+    """
+    deltas = [curr - prev for prev, curr in zip(previous, current)]
+    total = sum(deltas)
+    if total <= 0: # No time elapsed between both reads
+        return 100.0, 0.0
+    return (deltas[3] + deltas[4]) * 100 / total, deltas[7] * 100 / total
+
+
+def cpu_usage(previous, current):
+    """
+    Computes the remaining CPU of the whole server and of every core from two
+    reads of ``/proc/stat``.
+
+    Notes
+    -----
+        * If there is no previous read, or the counters went backwards because
+          the server rebooted, the usage is computed since boot.
+
+    Parameters
+    ----------
+    previous: dictionary
+        Counters of the first read, as returned by ``parse_cpu_times()``.
+    current: dictionary
+        Counters of the second read, as returned by ``parse_cpu_times()``.
+
+    Returns
+    -------
+    dictionary
+        A dictionary where the ``cpu`` key indicates the remaining CPU
+        percentage, ``cpu_steal`` the percentage of time stolen by the
+        hypervisor and ``cpu_cores`` the remaining CPU percentage of every core.
+    """
+    if previous is None or any(curr < prev for prev, curr in zip(previous.get('cpu', []), current['cpu'])):
+        previous = {}
+    zero = [0] * CPU_FIELDS
+    remaining, steal = cpu_remaining(previous.get('cpu', zero), current['cpu'])
+    cores = []
+    core = 0
+    while 'cpu%d' % core in current:
+        name = 'cpu%d' % core
+        cores.append(cpu_remaining(previous.get(name, zero), current[name])[0])
+        core += 1
+    return {'cpu': remaining, 'cpu_steal': steal, 'cpu_cores': cores}
+
+
+def parse_meminfo(lines):
+    """
+    Parses the lines of ``/proc/meminfo``.
+
+    Parameters
+    ----------
+    lines: list
+        Lines of ``/proc/meminfo``, all of them or just the ones needed.
+
+    Returns
+    -------
+    dictionary
+        A dictionary where the keys are the field names (``MemTotal``,
+        ``MemAvailable``, ...) and the values the amounts in kB.
+    """
+    meminfo = {}
+    for line in lines:
+        name, _, value = line.partition(':')
+        fields = value.split()
+        if fields:
+            meminfo[name.strip()] = int(fields[0])
+    return meminfo
+
+
+def parse_proc_processes(stat_lines, uptime, clock_ticks, page_size, mem_total):
+    """
+    Builds the process table from the contents of ``/proc/[pid]/stat``,
+    computing the same CPU and memory percentages reported by ``ps``.
+
+    Notes
+    -----
+        * The CPU percentage is the CPU time used over the time elapsed since
+          the process started, and the memory percentage is the resident set
+          size over the total memory. Both are rounded to one decimal, like
+          ``ps`` does.
+
+    Parameters
+    ----------
+    stat_lines: list
+        Contents of ``/proc/[pid]/stat``, one line per process.
+    uptime: float
+        Seconds since the server booted, from ``/proc/uptime``.
+    clock_ticks: int
+        Clock ticks per second (``CLK_TCK``).
+    page_size: int
+        Memory page size in bytes.
+    mem_total: int
+        Total memory of the server in kB.
+
+    Returns
+    -------
+    ProcessTable
+        The processes in the order they were read.
+    """
+    processes = ProcessTable()
+    for line in stat_lines:
+        # The process name is enclosed in parentheses and may contain spaces
+        # or parentheses itself, the remaining fields start after the last one:
+        name_start = line.find('(')
+        name_end = line.rfind(')')
+        if name_start == -1 or name_end == -1:
+            continue
+        fields = line[name_end + 2:].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / clock_ticks
+        elapsed = uptime - int(fields[19]) / clock_ticks
+        cpu = cpu_seconds * 100 / elapsed if elapsed > 0 else 0.0
+        memory = int(fields[21]) * page_size / 1024 * 100 / mem_total
+        processes.append(int(line[:name_start]), line[name_start + 1:name_end],
+                         round(cpu, 1), round(memory, 1))
+    return processes
+
+
+def aggregate_processes(processes):
+    """
+    Adds up the CPU and memory of the processes sharing the same name.
+
+    Parameters
+    ----------
+    processes: iterable
+        ``ProcessTable`` or iterable of ``(pid, name, cpu, memory)`` tuples.
+
+    Returns
+    -------
+    list
+        A list of ``(count, name, cpu, memory)`` tuples, one per process name,
+        where ``count`` is the number of processes with that name.
+    """
+    totals = {}
+    for _, name, cpu, memory in processes:
+        total = totals.get(name)
+        if total is None:
+            totals[name] = [1, name, cpu, memory]
+        else:
+            total[0] += 1
+            total[2] += cpu
+            total[3] += memory
+    return [(count, name, round(cpu, 1), round(memory, 1))
+            for count, name, cpu, memory in totals.values()]
+
+
+def top_processes(processes, metric, count=3, aggregate=False):
+    """
+    Returns the processes with the highest value on the given metric.
+
+    Notes
+    -----
+        * The processes are selected with a heap of size ``count``, which takes
+          O(P log N) for P processes instead of sorting the whole table.
+
+    Parameters
+    ----------
+    processes: iterable
+        ``ProcessTable`` or iterable of ``(pid, name, cpu, memory)`` tuples.
+    metric: string
+        Metric to rank by, one of ``METRICS``.
+    count: int
+        Number of processes to return.
+    aggregate: bool
+        Whether to add up the processes sharing the same name and rank the
+        names instead of the individual processes.
+
+    Returns
+    -------
+    dictionary
+        A dictionary from greater to lower value. If ``aggregate`` is False,
+        the keys are the process PIDs and the values dictionaries with their
+        ``name``, ``cpu`` and ``memory``. Otherwise, the keys are the process
+        names and the values dictionaries with the ``count`` of processes and
+        their added ``cpu`` and ``memory``.
+    """
+    if aggregate:
+        processes = aggregate_processes(processes)
+    index = METRICS[metric]
+    process_dict = {}
+    for first, name, cpu, memory in heapq.nlargest(count, processes, key=lambda proc: proc[index]):
+        if aggregate:
+            process_dict[name] = {'count': first, 'cpu': cpu, 'memory': memory}
+        else:
+            process_dict[str(first)] = {'name': name, 'cpu': cpu, 'memory': memory}
+    return process_dict
+
+
+def parse_batch(output_lines, previous_cpu=None, top=3, aggregate=False):
+    """
+    Parses the output of the batched command and derives every statistic
+    from that single snapshot.
+
+    Parameters
+    ----------
+    output_lines: iterable
+        Lines returned by the remote server when running ``batch_command()``
+        with the sections of any of the ``BACKENDS``, or with
+        ``COMPACT_BATCH_SECTIONS``.
+    previous_cpu: dictionary
+        ``/proc/stat`` counters of the previous query, used when the output
+        has no ``cpu_baseline`` section.
+    top: int
+        Number of top processes to report for every metric.
+    aggregate: bool
+        Whether to rank the process names instead of the individual processes.
+        See ``top_processes()``.
+
+    Returns
+    -------
+    tuple
+        The ``HostStats`` of the server and the ``/proc/stat`` counters read,
+        to be used as ``previous_cpu`` on the next query.
+
+    Raises
+    ------
+    Exception
+        Missing section in batched output
+    """
+    # The process table is parsed as it is read, the other sections are a
+    # few lines each and are kept until the end:
+    sections = {}
+    processes = None
+    for name, lines in iter_sections(output_lines):
+        lines = _non_empty(lines)
+        if lines is None:
+            continue
+        if name == 'processes':
+            processes = parse_processes(lines)
+        elif name == 'compact_processes':
+            processes = parse_compact_processes(lines)
+        elif name == 'pids' and all(key in sections for key in ('uptime', 'sysconf', 'memory')):
+            processes = _parse_pids(lines, sections)
+        else:
+            lines = list(lines)
+        sections[name] = lines
+    if 'pids' in sections:
+        backend_sections = PROC_SECTIONS
+    elif 'compact_processes' in sections:
+        backend_sections = COMPACT_BATCH_SECTIONS
+    else:
+        backend_sections = BATCH_SECTIONS
+    for name, _ in backend_sections:
+        if name not in sections:
+            raise Exception('Missing section in batched output: %s' % name)
+    if processes is None: # A process table sent before the values it needs
+        processes = _parse_pids(sections['pids'], sections)
+    capacity, cpu_times = _capacity(sections, previous_cpu)
+    return HostStats(processes, capacity, top, aggregate), cpu_times
+
+
+def parse_capacity(output_lines, previous_cpu=None):
+    """
+    Parses the output of the batched command of ``CAPACITY_SECTIONS``.
+
+    Parameters
+    ----------
+    output_lines: iterable
+        Lines returned by the remote server when running ``batch_command()``
+        with ``CAPACITY_SECTIONS``, optionally after ``CPU_BASELINE_SECTION``.
+    previous_cpu: dictionary
+        ``/proc/stat`` counters of the previous query, used when the output
+        has no ``cpu_baseline`` section.
+
+    Returns
+    -------
+    tuple
+        The remaining capacity of the server, as computed by ``cpu_usage()``
+        plus the available ``memory_kb``, and the ``/proc/stat`` counters
+        read, to be used as ``previous_cpu`` on the next query.
+
+    Raises
+    ------
+    Exception
+        Missing section in batched output
+    """
+    sections = dict((name, list(lines)) for name, lines in iter_sections(output_lines))
+    for name, _ in CAPACITY_SECTIONS:
+        if name not in sections:
+            raise Exception('Missing section in batched output: %s' % name)
+    return _capacity(sections, previous_cpu)
+
+
+def _capacity(sections, previous_cpu):
+    """
+    Computes the remaining capacity from the parsed sections of a batched
+    output, see ``parse_capacity()``.
+    """
+    if CPU_BASELINE_SECTION[0] in sections:
+        previous_cpu = parse_cpu_times(sections[CPU_BASELINE_SECTION[0]])
+    cpu_times = parse_cpu_times(sections['cpu'])
+    capacity = cpu_usage(previous_cpu, cpu_times)
+    capacity['memory_kb'] = parse_meminfo(sections['memory'])['MemAvailable']
+    return capacity, cpu_times
+
+
+def _parse_pids(stat_lines, sections):
+    """
+    Builds the process table of the ``proc`` backend with the values of its
+    other sections.
+    """
+    sysconf = sections['sysconf']
+    return parse_proc_processes(stat_lines, float(sections['uptime'][0].split()[0]),
+                                int(sysconf[0]), int(sysconf[1]),
+                                parse_meminfo(sections['memory'])['MemTotal'])
+
+
+def parse_sampler(output_lines, top=3, aggregate=False):
+    """
+    Parses the summary printed by the sampler (see ``sampler.py``).
+
+    Parameters
+    ----------
+    output_lines: iterable
+        Lines returned by the remote server when running the sampler.
+    top: int
+        Number of top processes the sampler was asked for.
+    aggregate: bool
+        Whether the sampler added up the processes sharing the same name.
+
+    Returns
+    -------
+    dictionary
+        The usage data of the server, with the same keys as ``HostStats``,
+        where the remaining capacity is the average remaining CPU and steal
+        time and the lowest available memory of the window, and the top
+        processes have the highest CPU percentage of a single sample under
+        ``cpu_max``. The
+        ``window`` key holds the number of ``samples``, the ``seconds`` they
+        span and the ``min``, ``avg`` and ``max`` of the remaining ``cpu`` and
+        the available ``memory_kb``.
+
+    Raises
+    ------
+    Exception
+        Invalid sampler output
+    """
+    text = '\n'.join(output_lines).strip()
+    try:
+        summary = json.loads(text)
+    except ValueError:
+        raise Exception('Invalid sampler output: %s' % (text[:200] or 'no output'))
+    if 'error' in summary:
+        raise Exception('Sampler failed on the server: %s' % summary['error'])
+
+    def top_dict(rows):
+        process_dict = {}
+        for first, name, cpu, cpu_max, memory in rows:
+            if aggregate:
+                process_dict[name] = {'count': first, 'cpu': cpu, 'cpu_max': cpu_max,
+                                      'memory': memory}
+            else:
+                process_dict[str(first)] = {'name': name, 'cpu': cpu, 'cpu_max': cpu_max,
+                                            'memory': memory}
+        return process_dict
+
+    window = {'samples': summary['samples'], 'seconds': summary['seconds']}
+    for name in ('cpu', 'memory_kb'):
+        window[name] = dict(zip(('min', 'avg', 'max'), summary[name]))
+    stats_dict = {}
+    stats_dict['running_processes'] = summary['processes']
+    stats_dict['top_%d_cpu_consumption' % top] = top_dict(summary['top_cpu'])
+    stats_dict['top_%d_memory_consumption' % top] = top_dict(summary['top_memory'])
+    stats_dict['remaining_capacity'] = {'cpu': window['cpu']['avg'],
+                                        'cpu_steal': summary['cpu_steal'],
+                                        'memory_kb': window['memory_kb']['min']}
+    stats_dict['window'] = window
+    return stats_dict
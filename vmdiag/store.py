@@ -0,0 +1,327 @@
+"""
+Append-only on-disk store of the samples collected from the servers.
+
+* Author: Andrés Arias
+* Email: andres.arias12@gmail.com
+
+Notes
+-----
+    Every server has its own directory inside the store, which works as the
+    per-host index: reading the samples of a server never touches the files
+    of the others. The samples are appended to segment files named after the
+    UNIX time their period starts (one segment per day by default), and the
+    segments older than the retention time are deleted.
+
+    Every sample is a fixed-width binary record (see ``RECORD``), so the
+    segments are memory-mapped and the first sample of a time range is found
+    with a binary search over the record timestamps, without reading the
+    whole file. The samples of a server are expected to be appended in
+    chronological order.
+"""
+
+import mmap
+import os
+import struct
+import time
+from vmdiag import stats
+
+TOP_SLOTS = 3
+"""
+int: Number of top processes stored per metric.
+"""
+
+HEADER = struct.Struct('<dffQ')
+"""
+Struct: Timestamp, remaining CPU, CPU steal and available memory in kB.
+"""
+
+TOP_ENTRY = struct.Struct('<IIH16s')
+"""
+Struct: PID, CPU and memory percentages in tenths and name of a top process.
+"""
+
+RECORD_SIZE = HEADER.size + 2 * TOP_SLOTS * TOP_ENTRY.size
+"""
+int: Size in bytes of every record: the header followed by the top CPU and
+the top memory processes.
+"""
+
+SEGMENT_SUFFIX = '.seg'
+"""
+string: Extension of the segment files.
+"""
+
+
+def top_entries(host_stats, metric):
+    """
+    Returns the first ``TOP_SLOTS`` top processes of a result.
+
+    Parameters
+    ----------
+    host_stats: HostStats or dictionary
+        The usage data of the server.
+    metric: string
+        ``cpu`` or ``memory``.
+
+    Returns
+    -------
+    list
+        ``(pid, name, cpu, memory)`` tuples from greater to lower value, as
+        reported on the output. The top processes added up by name get the
+        PID 0.
+    """
+    if isinstance(host_stats, stats.HostStats):
+        top_dict = stats.top_processes(host_stats.processes, metric, TOP_SLOTS,
+                                       host_stats.aggregate)
+    else:
+        suffix = '_%s_consumption' % metric
+        top_dict = next((value for key, value in host_stats.items()
+                         if key.startswith('top_') and key.endswith(suffix)), {})
+    entries = []
+    for first, proc in list(top_dict.items())[:TOP_SLOTS]:
+        if 'name' in proc:
+            entries.append((int(first), proc['name'], proc['cpu'], proc['memory']))
+        else:
+            entries.append((0, first, proc['cpu'], proc['memory']))
+    return entries
+
+
+def encode_sample(timestamp, host_stats):
+    """
+    Packs a sample into a fixed-width record.
+
+    Notes
+    -----
+        * Only the first ``TOP_SLOTS`` top processes of every metric are
+          stored. Unused slots are filled with zeros.
+
+    Parameters
+    ----------
+    timestamp: float
+        UNIX time of the sample.
+    host_stats: HostStats or dictionary
+        The usage statistics of the server, in the compact form or as the
+        dictionary returned by the ``commands`` and ``sampler`` backends.
+
+    Returns
+    -------
+    bytes
+        The packed record, ``RECORD_SIZE`` bytes long.
+    """
+    if isinstance(host_stats, stats.HostStats):
+        capacity = host_stats.capacity
+    else:
+        capacity = host_stats['remaining_capacity']
+    record = [HEADER.pack(timestamp, capacity['cpu'], capacity.get('cpu_steal', 0.0),
+                          capacity['memory_kb'])]
+    for metric in ('cpu', 'memory'):
+        entries = top_entries(host_stats, metric)
+        for pid, name, cpu, memory in entries:
+            record.append(TOP_ENTRY.pack(pid, round(cpu * 10), round(memory * 10),
+                                         name.encode('utf-8')[:16]))
+        record.append(bytes(TOP_ENTRY.size * (TOP_SLOTS - len(entries))))
+    return b''.join(record)
+
+
+def decode_sample(buffer, offset=0):
+    """
+    Unpacks a record packed by ``encode_sample()``.
+
+    Parameters
+    ----------
+    buffer: bytes
+        Buffer holding the record.
+    offset: int
+        Position of the record in the buffer.
+
+    Returns
+    -------
+    dictionary
+        A dictionary with the ``timestamp``, ``remaining_capacity``,
+        ``top_cpu_consumption`` and ``top_memory_consumption`` of the sample.
+        The top processes added up by name are keyed by their name.
+    """
+    timestamp, cpu, steal, memory_kb = HEADER.unpack_from(buffer, offset)
+    sample = {
+        'timestamp': timestamp,
+        'remaining_capacity': {'cpu': cpu, 'cpu_steal': steal, 'memory_kb': memory_kb}
+    }
+    offset += HEADER.size
+    for metric in ('cpu', 'memory'):
+        top_dict = {}
+        for _ in range(TOP_SLOTS):
+            pid, proc_cpu, proc_memory, name = TOP_ENTRY.unpack_from(buffer, offset)
+            offset += TOP_ENTRY.size
+            name = name.rstrip(b'\0').decode('utf-8', 'replace')
+            if pid:
+                top_dict[str(pid)] = {'name': name, 'cpu': proc_cpu / 10,
+                                      'memory': proc_memory / 10}
+            elif name: # Processes added up by name
+                top_dict[name] = {'cpu': proc_cpu / 10, 'memory': proc_memory / 10}
+        sample['top_%s_consumption' % metric] = top_dict
+    return sample
+
+
+class SampleStore:
+    """
+    Append-only store of the samples collected from the servers.
+
+    Parameters
+    ----------
+    path: string
+        Directory where the samples are stored. Created if it does not exist.
+    segment_seconds: int
+        Time in seconds covered by every segment file.
+    retention: int
+        Time in seconds the samples are kept. 0 keeps them forever.
+
+    Attributes
+    ----------
+    path: string
+        Directory where the samples are stored.
+    segment_seconds: int
+        Time in seconds covered by every segment file.
+    retention: int
+        Time in seconds the samples are kept.
+    """
+
+    def __init__(self, path, segment_seconds=86400, retention=7 * 86400):
+        self.path = path
+        self.segment_seconds = segment_seconds
+        self.retention = retention
+        self._last_cleanup = None
+        os.makedirs(path, exist_ok=True)
+
+    def append(self, ip_address, timestamp, host_stats):
+        """
+        Appends a sample of a server to its current segment.
+
+        Parameters
+        ----------
+        ip_address: string
+            IPv4 address of the server.
+        timestamp: float
+            UNIX time of the sample.
+        host_stats: HostStats or dictionary
+            The usage statistics of the server, see ``encode_sample()``.
+        """
+        host_path = os.path.join(self.path, ip_address)
+        os.makedirs(host_path, exist_ok=True)
+        segment_start = int(timestamp // self.segment_seconds * self.segment_seconds)
+        segment_path = os.path.join(host_path, '%d%s' % (segment_start, SEGMENT_SUFFIX))
+        with open(segment_path, 'ab') as segment:
+            # Drop the leftover of a record that was not completely written:
+            extra = segment.tell() % RECORD_SIZE
+            if extra:
+                segment.truncate(segment.tell() - extra)
+                segment.seek(0, os.SEEK_END)
+            segment.write(encode_sample(timestamp, host_stats))
+        if self._last_cleanup != segment_start:
+            self._last_cleanup = segment_start
+            self.enforce_retention(timestamp)
+
+    def hosts(self):
+        """
+        Returns the servers that have samples on the store.
+
+        Returns
+        -------
+        list
+            The IP addresses of the servers.
+        """
+        return sorted(name for name in os.listdir(self.path)
+                      if os.path.isdir(os.path.join(self.path, name)))
+
+    def _segments(self, ip_address):
+        """
+        Returns the ``(start, path)`` tuples of the segments of a server,
+        sorted by start time.
+        """
+        host_path = os.path.join(self.path, ip_address)
+        if not os.path.isdir(host_path):
+            return []
+        segments = []
+        for name in os.listdir(host_path):
+            if name.endswith(SEGMENT_SUFFIX):
+                segments.append((int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(host_path, name)))
+        segments.sort()
+        return segments
+
+    def query(self, ip_address, start=None, end=None):
+        """
+        Reads the samples of a server within a time range.
+
+        Parameters
+        ----------
+        ip_address: string
+            IPv4 address of the server.
+        start: float
+            UNIX time of the first sample to return. If not given, the samples
+            are returned from the oldest one.
+        end: float
+            UNIX time after which no samples are returned. If not given, the
+            samples are returned up to the newest one.
+
+        Yields
+        ------
+        dictionary
+            Every sample in the range, in chronological order, as returned by
+            ``decode_sample()``.
+        """
+        segments = self._segments(ip_address)
+        for index, (segment_start, segment_path) in enumerate(segments):
+            if end is not None and segment_start > end:
+                break
+            if start is not None and index + 1 < len(segments) and segments[index + 1][0] <= start:
+                continue
+            for sample in self._read_segment(segment_path, start, end):
+                yield sample
+
+    def _read_segment(self, segment_path, start, end):
+        """
+        Yields the samples of a segment within a time range.
+        """
+        with open(segment_path, 'rb') as segment:
+            size = os.fstat(segment.fileno()).st_size
+            count = size // RECORD_SIZE
+            if count == 0:
+                return
+            with mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as records:
+                low = 0
+                if start is not None:
+                    # Binary search of the first record at or after start:
+                    high = count
+                    while low < high:
+                        middle = (low + high) // 2
+                        if HEADER.unpack_from(records, middle * RECORD_SIZE)[0] < start:
+                            low = middle + 1
+                        else:
+                            high = middle
+                for index in range(low, count):
+                    sample = decode_sample(records, index * RECORD_SIZE)
+                    if end is not None and sample['timestamp'] > end:
+                        return
+                    yield sample
+
+    def enforce_retention(self, now=None):
+        """
+        Deletes the segments whose samples are all older than the retention
+        time.
+
+        Parameters
+        ----------
+        now: float
+            Current UNIX time. Defaults to the system time.
+        """
+        if not self.retention:
+            return
+        if now is None:
+            now = time.time()
+        oldest = now - self.retention
+        for ip_address in self.hosts():
+            segments = self._segments(ip_address)
+            # A segment ends where the next one starts, so the newest
+            # segment of every server is always kept:
+            for (_, segment_path), (next_start, _) in zip(segments, segments[1:]):
+                if next_start <= oldest:
+                    os.remove(segment_path)
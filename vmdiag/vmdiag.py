@@ -1,20 +1,88 @@
 """
 Connects via SSH to Linux servers to retrieve usage data:
     * Currently running processes (one interval).
-    * Top 3 processes consuming CPU.
-    * Top 3 processes consuming memory.
+    * Top N processes consuming CPU (3 by default).
+    * Top N processes consuming memory (3 by default).
     * Remaining memory in kB and CPU percentage available.
 
 * Author: Andrés Arias
 * Email: andres.arias12@gmail.com
+
+Notes
+-----
+    The modules that pull ``paramiko``, ``http.server`` or
+    ``multiprocessing`` are imported by the functions that use them, so
+    ``--help`` and the invalid argument errors do not pay for their import.
+    See ``tests/test_startup.py``.
 """
 
 import click
+import datetime
+import functools
 import json
-from vmdiag import parser, server
+import os
+import socket
+import sys
+import threading
+import time
+from vmdiag import credentials, output, parser, profiling, stats
+
+
+RETRY_ERRORS = (TimeoutError, socket.timeout, ConnectionError, EOFError)
+"""
+tuple: Exceptions after which querying a server is retried, along with
+``paramiko.SSHException`` except for the authentication and host key errors.
+"""
+
+BACKENDS = ['ps', 'proc', 'commands', 'sampler']
+"""
+list: Available ways of querying a server. ``ps`` and ``proc`` retrieve every
+statistic with a single remote command, ``commands`` runs one command per
+statistic and ``sampler`` samples the server over a window with a script
+uploaded to it.
+"""
+
+
+def query_stats(client, backend='ps', top=3, aggregate=False, window=5.0, sample_rate=10.0):
+    """
+    Retrieves the usage info from an already connected server.
+
+    Parameters
+    ----------
+    client: Server
+        Server instance already connected to the target server.
+    backend: string
+        How to query the server, one of ``BACKENDS``.
+    top: int
+        Number of top processes to report for CPU and memory.
+    aggregate: bool
+        Whether to report the top process names, adding up the processes
+        sharing the same name, instead of the top individual processes.
+    window: float
+        Seconds the ``sampler`` backend samples the server for.
+    sample_rate: float
+        Samples per second taken by the ``sampler`` backend.
 
+    Returns
+    -------
+    HostStats or dictionary
+        The usage data of the server. The batched backends return it in the
+        compact ``HostStats`` form, ``stats.as_dict()`` builds its output.
+    """
+    if backend == 'sampler':
+        return client.get_sampled_stats(window, sample_rate, top, aggregate)
+    if backend != 'commands':
+        return client.get_stats(backend, top, aggregate)
+    stats_dict = {}
+    stats_dict['running_processes'] = client.get_running_proccesses()
+    stats_dict['top_%d_cpu_consumption' % top] = client.get_top_cpu(top, aggregate)
+    stats_dict['top_%d_memory_consumption' % top] = client.get_top_mem(top, aggregate)
+    stats_dict['remaining_capacity'] = client.get_remaining_cap()
+    return stats_dict
 
-def retrieve_info(ip_address, username, key):
+
+def retrieve_info(ip_address, username, key, pool=None, deadline=None, known_hosts=None,
+                  profile=None, port=22, compress=False, cpu_counters=None, **options):
     """
     Runs a server instance and retrieves the usage info.
 
@@ -26,66 +94,760 @@ def retrieve_info(ip_address, username, key):
         Username to log via SSH to target server.
     key: string
         File path of the private key to log via SSH to target server.
+    pool: ConnectionPool
+        Pool to take the connection from. If not given, a new connection
+        is established and closed once the data is retrieved.
+    deadline: float
+        Time in seconds for connecting, authenticating, running the commands
+        and parsing their output. If not given, only connecting times out.
+    known_hosts: KnownHosts
+        Known host keys the server is verified against, for new connections.
+        The pool uses its own.
+    profile: HostProfile
+        Where the timings and counters of the query are recorded, if given.
+    port: int
+        TCP port of the SSH server, for new connections. The pool uses its own.
+    compress: bool
+        Whether new connections use the compact transport: SSH compression and
+        the process listings encoded on the server. The pool uses its own.
+    cpu_counters: CpuCounters
+        Where the ``/proc/stat`` counters of new connections are loaded from
+        and saved to, if given, so the CPU usage is measured against the
+        previous sweep. The pooled connections keep their own.
+    options:
+        Keyword arguments passed to ``query_stats()``: ``backend``, ``top``
+        and ``aggregate``.
 
     Returns
     -------
     dictionary
-        Dictionary with the resulting usage data.
+        Dictionary with the resulting usage data keyed by IP address. See
+        ``query_stats()`` for the format of the usage data.
+
+    Raises
+    ------
+    TimeoutError
+        If the deadline is exceeded. The command being run is cancelled and
+        the connection closed.
     """
-    stats_dict = {}
     result_dict = {}
-    client = server.Server(ip_address, username, key, 20)
-    client.connect()
-    stats_dict['running_processes'] = client.get_running_proccesses()
-    stats_dict['top_3_cpu_consumption'] = client.get_top_cpu()
-    stats_dict['top_3_memory_consumption'] = client.get_top_mem()
-    stats_dict['remaining_capacity'] = client.get_remaining_cap()
-    result_dict[ip_address] = stats_dict
-    client.disconnect()
+    if pool is None:
+        from vmdiag import server
+        client = server.Server(ip_address, username, key, 20, known_hosts, port, compress)
+        client.set_deadline(deadline)
+        client.profile = profile
+        if cpu_counters is not None:
+            client.cpu_times = cpu_counters.load(ip_address)
+        try:
+            client.connect()
+            result_dict[ip_address] = query_stats(client, **options)
+        finally:
+            client.disconnect()
+        if cpu_counters is not None and client.cpu_times is not None:
+            cpu_counters.save(ip_address, client.cpu_times)
+    else:
+        result_dict[ip_address] = pool.run(ip_address, username, key,
+                                           lambda client: query_stats(client, **options),
+                                           deadline, profile)
     return result_dict
 
-@click.command()
-@click.argument('ip', required=True, nargs=-1)
-@click.option('--user', required=True, multiple=True, help='SSH username for the given IP addresses')
-@click.option('--key', required=True, multiple=True, type=click.Path(), help='SSH Keys for the given IP addresses')
-@click.option('--output', help='File where the output will be dumped.')
-def main(ip, user, key, output):
-    ip_string = ""
-    for i in ip:
-        ip_string += i
+
+def retrieve_with_retries(ip_address, username, key, retries=0, backoff=1.0, profiler=None,
+                          **options):
+    """
+    Runs ``retrieve_info()``, retrying it on timeouts and broken connections,
+    but not on authentication or host key errors.
+
+    Notes
+    -----
+        * Every attempt gets the whole deadline. The wait before retrying
+          doubles after every attempt: ``backoff``, ``2 * backoff``, ...
+        * A server still timing out after the last attempt is reported with
+          a timeout status instead of raising, so it does not abort the sweep.
+
+    Parameters
+    ----------
+    ip_address: string
+        IPv4 of the target server. Format: ``XXX.XXX.XXX.XXX``
+    username: string
+        Username to log via SSH to target server.
+    key: string
+        File path of the private key to log via SSH to target server.
+    retries: int
+        Number of times a failed attempt is retried.
+    backoff: float
+        Time in seconds to wait before the first retry.
+    profiler: Profiler
+        Where the profile of the query is kept, if given. Covers every attempt.
+    options:
+        Keyword arguments passed to ``retrieve_info()``.
+
+    Returns
+    -------
+    dictionary
+        Dictionary with the resulting usage data keyed by IP address, or
+        with a dictionary with the ``status`` (``timeout``), ``error``,
+        ``attempts`` and ``elapsed`` seconds if the server timed out.
+    """
+    import paramiko
+    start = time.monotonic()
+    profile = None if profiler is None else profiler.start(ip_address)
+    try:
+        for attempt in range(retries + 1):
+            try:
+                return retrieve_info(ip_address, username, key, profile=profile, **options)
+            except (paramiko.AuthenticationException, paramiko.BadHostKeyException):
+                raise # Would fail the same way on every attempt
+            except RETRY_ERRORS + (paramiko.SSHException,) as error:
+                if attempt < retries:
+                    if profile is not None:
+                        profile.add('retries')
+                    time.sleep(backoff * 2 ** attempt)
+                elif isinstance(error, (TimeoutError, socket.timeout)):
+                    return {ip_address: {'status': 'timeout',
+                                         'error': str(error),
+                                         'attempts': attempt + 1,
+                                         'elapsed': round(time.monotonic() - start, 3)}}
+                else:
+                    raise
+    finally:
+        if profile is not None:
+            profile.finish()
+
+
+def retrieve_or_error(ip_address, username, key, **options):
+    """
+    Runs ``retrieve_with_retries()``, reporting a server that failed with an
+    error status instead of raising, so it does not abort the sweep.
+
+    Parameters
+    ----------
+    ip_address: string
+        IPv4 of the target server. Format: ``XXX.XXX.XXX.XXX``
+    username: string
+        Username to log via SSH to target server.
+    key: string
+        File path of the private key to log via SSH to target server.
+    options:
+        Keyword arguments passed to ``retrieve_with_retries()``.
+
+    Returns
+    -------
+    dictionary
+        Dictionary with the resulting usage data keyed by IP address, or with
+        a dictionary with the ``status`` (``error``) and the ``error`` message
+        if the server failed.
+    """
     try:
-        ip_list = parser.parse_ip(ip_string)
-        if len(user) != len(key):
-            click.echo("Error: Must provide usernames and PEM keys for every IP or one PEM key common to all servers.")
-            exit()
+        return retrieve_with_retries(ip_address, username, key, **options)
+    except Exception as error:
+        return {ip_address: {'status': 'error', 'error': str(error)}}
+
+
+def retrieve_sample(ip_address, username, key, profiler=None, **options):
+    """
+    Runs ``retrieve_or_error()`` and returns the usage data of the server
+    along with the profile of the query, so both can be sent back from a
+    worker process.
+
+    Parameters
+    ----------
+    ip_address: string
+        IPv4 of the target server. Format: ``XXX.XXX.XXX.XXX``
+    username: string
+        Username to log via SSH to target server.
+    key: string
+        File path of the private key to log via SSH to target server.
+    profiler: Profiler
+        Where the profile of the query is kept, if given.
+    options:
+        Keyword arguments passed to ``retrieve_or_error()``.
+
+    Returns
+    -------
+    tuple
+        The usage data, or error status, of the server and its
+        ``HostProfile``, None if profiling is disabled.
+    """
+    stats_dict = retrieve_or_error(ip_address, username, key, profiler=profiler,
+                                   **options)[ip_address]
+    return stats_dict, None if profiler is None else profiler.get(ip_address)
+
+
+def with_profile(ip_address, stats_dict, profiler):
+    """
+    Adds the profile of the last query of a server to its usage data.
+
+    Parameters
+    ----------
+    ip_address: string
+        IPv4 address of the server.
+    stats_dict: HostStats or dictionary
+        The usage data of the server.
+    profiler: Profiler
+        Profiler that kept the profile of the query, None if disabled.
+
+    Returns
+    -------
+    HostStats or dictionary
+        ``stats_dict`` untouched if profiling is disabled or the server has
+        no profile. Otherwise, its dictionary form with a ``profile`` key.
+    """
+    profile = None if profiler is None else profiler.get(ip_address)
+    if profile is None:
+        return stats_dict
+    stats_dict = dict(stats.as_dict(stats_dict))
+    stats_dict['profile'] = profile.as_dict()
+    return stats_dict
+
+
+def pooled_retrieve(interval, known_hosts, port, compress, **options):
+    """
+    Opens the connection pool of servers sampled every ``interval`` seconds
+    and builds the function that samples one of them through it.
+
+    Parameters
+    ----------
+    interval: float
+        Seconds between two samples of a server. The connections are kept
+        open for twice as long, 5 minutes at least.
+    known_hosts: KnownHosts
+        Known host keys the servers are verified against.
+    port: int
+        TCP port of the SSH servers.
+    compress: bool
+        Whether the connections use the compact transport.
+    options:
+        Keyword arguments passed to ``retrieve_with_retries()``.
+
+    Returns
+    -------
+    tuple
+        The ``ConnectionPool`` and the function, called with the IP
+        address, username and key of a server, returning its usage data or
+        its error status.
+    """
+    from vmdiag import pool
+    connection_pool = pool.ConnectionPool(ttl=max(300, 2 * interval), known_hosts=known_hosts,
+                                          port=port, compress=compress)
+
+    def retrieve(ip_address, username, key):
+        return retrieve_or_error(ip_address, username, key, pool=connection_pool,
+                                 **options)[ip_address]
+
+    return connection_pool, retrieve
+
+
+def watch_servers(targets, interval, concurrency, output, sample_store=None, known_hosts=None,
+                  port=22, max_interval=None, rate=None, compress=False, encoder=None, **options):
+    """
+    Samples the servers every ``interval`` seconds, reusing their SSH
+    connections, and streams one compact JSON line per server per sample.
+
+    Notes
+    -----
+        * A server that fails on a sample is reported with a ``status`` and an
+          ``error`` key and is queried again on the next one.
+        * With ``max_interval``, every server is sampled at its own interval,
+          between ``interval`` and ``max_interval``, following how fast it
+          changes. See ``scheduler.AdaptiveScheduler``.
+        * With an ``encoder``, only what changed on every server is written,
+          with a full keyframe from time to time. See ``delta``.
+        * Runs until interrupted with ``Ctrl+C``.
+
+    Parameters
+    ----------
+    targets: list
+        List of ``(ip_address, username, key)`` tuples.
+    interval: float
+        Time in seconds between two consecutive samples.
+    concurrency: int
+        Maximum number of servers queried at the same time.
+    output: string
+        File where the lines are appended. If not given, the lines are
+        written to the console.
+    sample_store: SampleStore
+        Store where every sample is also appended, if given.
+    known_hosts: KnownHosts
+        Known host keys the servers are verified against, if given.
+    port: int
+        TCP port of the SSH servers.
+    max_interval: float
+        Longest time in seconds between two samples of a server, to adapt
+        the interval of every server. If not given, every server is sampled
+        every ``interval`` seconds.
+    rate: float
+        Maximum number of samples started per second when adapting the
+        intervals, None for no limit.
+    compress: bool
+        Whether the connections use the compact transport.
+    encoder: DeltaEncoder
+        Encoder of the delta records, if given.
+    options:
+        Keyword arguments passed to ``retrieve_with_retries()``.
+    """
+    from vmdiag import collector, scheduler
+    # The connections of the servers sampled least often have to outlive
+    # their longest interval:
+    connection_pool, retrieve = pooled_retrieve(max_interval or interval, known_hosts, port,
+                                                compress, **options)
+    profiler = options.get('profiler')
+    json_file = None if output is None else open(output, "a")
+    try:
+        if max_interval is not None:
+            adaptive = scheduler.AdaptiveScheduler(targets, interval, max_interval, rate)
+            samples = adaptive.run(retrieve, concurrency)
         else:
-            result_dict = {}
-            if len(user) == len(ip_list):
-                server_count = 0
-                for addr in ip_list:
-                    stats_dict = retrieve_info(addr, user[server_count], key[server_count])
-                    result_dict[addr] = stats_dict[addr]
-                    server_count += 1
-            elif len(user) == 1: # Use a common user, key pair for all servers
-                for addr in ip_list:
-                    stats_dict = retrieve_info(addr, user[0], key[0])
-                    result_dict[addr] = stats_dict[addr]
-            else:
-                click.echo("Error: Must provide PEM keys and usernames for every IP or one PEM key common to all servers.")
-                exit()
-
-            server_json = json.dumps(result_dict, indent=4)
-            click.echo(server_json)
-            if output is None: # Gave no output file name, use default
-                json_file = open('server_data.json', "w")
-                json_file.write(server_json)
+            samples = collector.watch(targets, retrieve, interval, concurrency)
+        for timestamp, addr, stats_dict in samples:
+            if sample_store is not None and (isinstance(stats_dict, stats.HostStats)
+                                             or 'status' not in stats_dict):
+                sample_store.append(addr, timestamp, stats_dict)
+            record = {'timestamp': timestamp, 'ip': addr}
+            record.update(stats.as_dict(with_profile(addr, stats_dict, profiler)))
+            if encoder is not None:
+                record = encoder.encode(record)
+            line = json.dumps(record, separators=(',', ':'))
+            if json_file is None:
+                click.echo(line)
             else:
-                json_file = open(output, "w")
-                json_file.write(server_json)
-            click.echo("Output stored in output file!")
+                json_file.write(line + "\n")
+                json_file.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        connection_pool.close()
+        if json_file is not None:
             json_file.close()
+        if profiler is not None:
+            click.echo(profiler.report(), err=True)
+
+
+def parse_time(value):
+    """
+    Parses a time given on the command line.
+
+    Parameters
+    ----------
+    value: string
+        UNIX time or local date and time in ISO format: ``YYYY-MM-DDTHH:MM:SS``.
+
+    Returns
+    -------
+    float
+        The UNIX time, or None if no value was given.
+
+    Raises
+    ------
+    Exception
+        Invalid time. Should be a UNIX time or YYYY-MM-DDTHH:MM:SS
+    """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise Exception('Invalid time. Should be a UNIX time or YYYY-MM-DDTHH:MM:SS')
+
+
+class DefaultGroup(click.Group):
+    """
+    Command group that runs the ``sweep`` command when the first argument is
+    not the name of another command, so ``vmdiag IP...`` keeps working.
+    """
+
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and args[0] not in ctx.help_option_names:
+            args.insert(0, 'sweep')
+        return super().parse_args(ctx, args)
+
+
+QUERY_OPTIONS = [
+    click.argument('ip', nargs=-1),
+    click.option('--user', multiple=True, help='SSH username for the given IP addresses'),
+    click.option('--key', multiple=True, type=click.Path(),
+                 help='SSH Keys for the given IP addresses, "%s" to use the ssh-agent keys' % credentials.AGENT),
+    click.option('--hosts-file', type=click.Path(exists=True, dir_okay=False),
+                 help='File with one target per line, optionally followed by its username and key.'),
+    click.option('--concurrency', default=10, show_default=True, type=click.IntRange(min=1),
+                 help='Maximum number of servers queried at the same time.'),
+    click.option('--backend', default='ps', show_default=True, type=click.Choice(BACKENDS),
+                 help='How to query the servers: ps, /proc reads, one command per statistic '
+                      'or a sampler script uploaded to them.'),
+    click.option('--window', default=5.0, show_default=True, type=click.FloatRange(min=0.1),
+                 help='With the sampler backend, seconds every server is sampled for.'),
+    click.option('--sample-rate', default=10.0, show_default=True, type=click.FloatRange(min=0.1),
+                 help='With the sampler backend, samples per second.'),
+    click.option('--top', default=3, show_default=True, type=click.IntRange(min=1),
+                 help='Number of top processes reported for CPU and memory.'),
+    click.option('--aggregate', is_flag=True,
+                 help='Report the top process names, adding up processes with the same name.'),
+    click.option('--deadline', default=60, show_default=True, type=click.FloatRange(min=0),
+                 help='Seconds a server has to connect and return its data, 0 for no limit.'),
+    click.option('--retries', default=0, show_default=True, type=click.IntRange(min=0),
+                 help='Times a server that timed out or dropped the connection is queried again.'),
+    click.option('--backoff', default=1.0, show_default=True, type=click.FloatRange(min=0),
+                 help='Seconds to wait before the first retry, doubled after every retry.'),
+    click.option('--port', default=22, show_default=True, type=click.IntRange(1, 65535),
+                 help='TCP port of the SSH servers.'),
+    click.option('--compress', is_flag=True,
+                 help='Compress the SSH connections and encode the process listings on the servers.'),
+    click.option('--known-hosts', default=credentials.DEFAULT_KNOWN_HOSTS, show_default=True,
+                 type=click.Path(dir_okay=False),
+                 help='File where the server host keys are saved the first time and verified afterwards.'),
+]
+"""
+list: Arguments and options shared by the commands that query the servers:
+the targets, how many are queried at once, how they are queried and how to
+connect to them.
+"""
+
+
+def query_options(command):
+    """
+    Adds the ``QUERY_OPTIONS`` to a command.
+
+    Parameters
+    ----------
+    command: function
+        The command function.
+
+    Returns
+    -------
+    function
+        The command function with the shared arguments and options.
+    """
+    for option in reversed(QUERY_OPTIONS):
+        command = option(command)
+    return command
+
+
+def retrieve_options(backend, top, aggregate, window, sample_rate, deadline, retries, backoff):
+    """
+    Builds the keyword arguments of ``retrieve_with_retries()`` from the
+    query options of a command.
+
+    Parameters
+    ----------
+    backend: string
+        How to query the servers, one of ``BACKENDS``.
+    top: int
+        Number of top processes to report for CPU and memory.
+    aggregate: bool
+        Whether to add up the processes sharing the same name.
+    window: float
+        Seconds the ``sampler`` backend samples the servers for.
+    sample_rate: float
+        Samples per second taken by the ``sampler`` backend.
+    deadline: float
+        Seconds a server has to connect and return its data, 0 for no limit.
+    retries: int
+        Times a server that timed out or dropped the connection is queried
+        again.
+    backoff: float
+        Seconds to wait before the first retry.
+
+    Returns
+    -------
+    dictionary
+        The keyword arguments.
+
+    Raises
+    ------
+    Exception
+        Invalid window. Should be shorter than the deadline
+    """
+    if backend == 'sampler' and deadline and window >= deadline:
+        raise Exception('Invalid window. Should be shorter than the deadline')
+    return {'backend': backend, 'top': top, 'aggregate': aggregate, 'window': window,
+            'sample_rate': sample_rate, 'deadline': deadline or None, 'retries': retries,
+            'backoff': backoff}
+
+
+@click.group(cls=DefaultGroup)
+def main():
+    """
+    Connects via SSH to Linux servers to retrieve usage data.
+
+    Runs the sweep command when no command is given: vmdiag IP... is the
+    same as vmdiag sweep IP...
+    """
+
+
+@main.command()
+@query_options
+@click.option('--output', 'output_path', help='File where the output will be dumped.')
+@click.option('--format', 'output_format', default='json', show_default=True, type=click.Choice(output.FORMATS),
+              help='Write one JSON document or one JSON line per server.')
+@click.option('--compact', is_flag=True, help='Write the JSON document without indentation.')
+@click.option('--workers', default=1, show_default=True, type=click.IntRange(min=1),
+              help='Number of processes the servers are split across, sharing the concurrency.')
+@click.option('--watch', type=float, metavar='INTERVAL',
+              help='Sample the servers every INTERVAL seconds and stream one JSON line per server.')
+@click.option('--max-interval', type=float, metavar='SECONDS',
+              help='With --watch, sample every server between INTERVAL and SECONDS apart, '
+                   'more often the faster it changes.')
+@click.option('--rate', type=float,
+              help='With --max-interval, maximum number of samples started per second.')
+@click.option('--diff', is_flag=True,
+              help='With --watch, write only what changed on every server since its previous sample.')
+@click.option('--keyframe', default=20, show_default=True, type=click.IntRange(min=1),
+              help='With --diff, write the full record of a server at least every KEYFRAME samples.')
+@click.option('--diff-threshold', default=1.0, show_default=True, type=click.FloatRange(min=0),
+              help='With --diff, smallest change of the remaining capacity written: percentage '
+                   'points for the CPU, percent of the last value for the memory.')
+@click.option('--profile', is_flag=True,
+              help='Add the time of every phase of the queries to the output and print a summary.')
+@click.option('--summary', is_flag=True,
+              help='Add a fleet summary: the top processes of the whole fleet and the '
+                   'percentiles of the remaining capacity.')
+@click.option('--summary-top', default=10, show_default=True, type=click.IntRange(min=1),
+              help='Number of top processes of the fleet in the summary.')
+@click.option('--store', 'store_path', type=click.Path(file_okay=False),
+              help='Directory of a sample store where every result is also appended.')
+@click.option('--retention', default=7, show_default=True, type=click.IntRange(min=0),
+              help='Days the samples are kept on the store, 0 to keep them forever.')
+def sweep(ip, user, key, hosts_file, concurrency, backend, window, sample_rate, top, aggregate,
+          deadline, retries, backoff, port, compress, known_hosts, output_path, output_format,
+          compact, workers, watch, max_interval, rate, diff, keyframe, diff_threshold, profile,
+          summary, summary_top, store_path, retention):
+    """
+    Retrieves the usage data of the servers at the given IP addresses, CIDR
+    blocks (10.0.0.0/24) or ranges (10.0.0.1-20).
+    """
+    # Once the results are streamed to the standard output, errors go to the
+    # standard error so they are not appended to the JSON written so far:
+    streaming = False
+    try:
+        targets = parser.expand_targets(parser.parse_targets("".join(ip), user, key, hosts_file))
+        if watch is None and max_interval is not None:
+            raise Exception('--max-interval requires --watch')
+        if max_interval is None and rate is not None:
+            raise Exception('--rate requires --max-interval')
+        if watch is None and diff:
+            raise Exception('--diff requires --watch')
+        if watch is not None and summary:
+            raise Exception('--summary is not supported with --watch')
+        if watch is not None and workers > 1:
+            raise Exception('--workers is not supported with --watch')
+        options = retrieve_options(backend, top, aggregate, window, sample_rate, deadline,
+                                   retries, backoff)
+        profiler = profiling.Profiler() if profile else None
+        options['profiler'] = profiler
+        known_hosts = credentials.KnownHosts(known_hosts)
+        sample_store = None
+        if store_path is not None:
+            from vmdiag import store
+            sample_store = store.SampleStore(store_path, retention=retention * 86400)
+        if watch is not None:
+            encoder = None
+            if diff:
+                from vmdiag import delta
+                encoder = delta.DeltaEncoder(keyframe, diff_threshold)
+            streaming = True
+            watch_servers(targets, watch, concurrency, output_path, sample_store, known_hosts, port,
+                          max_interval, rate, compress, encoder, **options)
+            return
+
+        if output_path is None: # Gave no output file name, use default
+            output_path = 'server_data.json'
+        timestamp = time.time()
+        from vmdiag import collector, counters
+        cpu_counters = counters.CpuCounters(os.path.join(os.path.dirname(known_hosts.path),
+                                                         'cpu_times'))
+        retrieve = functools.partial(retrieve_sample, known_hosts=known_hosts, port=port,
+                                     compress=compress, cpu_counters=cpu_counters, **options)
+        if workers > 1:
+            results = collector.collect_sharded(targets, retrieve, concurrency, workers)
+        else:
+            results = collector.collect(targets, retrieve, concurrency)
+        fleet_rollup = None
+        if summary:
+            from vmdiag import rollup
+            fleet_rollup = rollup.FleetRollup(summary_top)
+        with open(output_path, "w") as json_file:
+            writer = output.JsonWriter([click.get_text_stream('stdout'), json_file],
+                                       output_format, compact)
+            streaming = True
+            try:
+                for addr, (stats_dict, profile) in results:
+                    if sample_store is not None and (isinstance(stats_dict, stats.HostStats)
+                                                     or 'status' not in stats_dict):
+                        sample_store.append(addr, timestamp, stats_dict)
+                    if fleet_rollup is not None:
+                        fleet_rollup.add(addr, stats_dict)
+                    if profile is not None:
+                        profiler.add(addr, profile)
+                    writer.write(addr, with_profile(addr, stats_dict, profiler))
+                if fleet_rollup is not None:
+                    writer.write_summary(fleet_rollup.summary())
+            finally:
+                # Keep the document valid even if a server failed:
+                writer.close()
+        click.echo("Output stored in output file!", err=True)
+        if profiler is not None:
+            click.echo(profiler.report(), err=True)
+    except Exception as error:
+        click.echo("Error: %s" % error, err=streaming)
+
+
+def parse_listen(value):
+    """
+    Parses the address the daemon listens on.
+
+    Parameters
+    ----------
+    value: string
+        Address as ``HOST:PORT``.
+
+    Returns
+    -------
+    tuple
+        The ``(host, port)`` tuple.
+
+    Raises
+    ------
+    Exception
+        Invalid listen address. Should be HOST:PORT
+    """
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit() or int(port) > 65535:
+        raise Exception('Invalid listen address. Should be HOST:PORT')
+    return host, int(port)
+
+
+@main.command()
+@query_options
+@click.option('--interval', default=30, show_default=True, type=click.FloatRange(min=0.1),
+              help='Seconds between two samples of the servers.')
+@click.option('--ttl', default=90, show_default=True, type=click.FloatRange(min=0.1),
+              help='Seconds a sample is served after it was taken.')
+@click.option('--listen', default='127.0.0.1:8470', show_default=True,
+              help='HOST:PORT the HTTP endpoint listens on.')
+@click.option('--socket', 'socket_path', type=click.Path(dir_okay=False),
+              help='Serve on this Unix socket instead of a TCP address.')
+def serve(ip, user, key, hosts_file, concurrency, backend, window, sample_rate, top, aggregate,
+          deadline, retries, backoff, port, compress, known_hosts, interval, ttl, listen,
+          socket_path):
+    """
+    Samples the servers every INTERVAL seconds and serves their latest
+    results over HTTP: GET /hosts for every server, GET /hosts/IP for one.
+    """
+    try:
+        targets = list(parser.expand_targets(parser.parse_targets("".join(ip), user, key, hosts_file)))
+        if ttl < interval:
+            raise Exception('Invalid TTL. Should be at least the interval')
+        options = retrieve_options(backend, top, aggregate, window, sample_rate, deadline,
+                                   retries, backoff)
+        listen_address = parse_listen(listen) if socket_path is None else None
+        known_hosts = credentials.KnownHosts(known_hosts)
+        from vmdiag import daemon
+        cache = daemon.SnapshotCache(ttl)
+        if socket_path is not None:
+            http_server = daemon.UnixSnapshotServer(socket_path, cache)
+            address = socket_path
+        else:
+            http_server = daemon.SnapshotServer(listen_address, cache)
+            address = 'http://%s:%d' % http_server.server_address[:2]
+        connection_pool, retrieve = pooled_retrieve(interval, known_hosts, port, compress,
+                                                    **options)
+        refresher = threading.Thread(target=daemon.refresh,
+                                     args=(cache, targets, retrieve, interval, concurrency))
+        refresher.daemon = True
+        refresher.start()
+        click.echo('Serving %d servers on %s' % (len(targets), address))
+        try:
+            http_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            http_server.server_close()
+            connection_pool.close()
+    except Exception as error:
+        click.echo("Error: %s" % error)
+
+
+@main.command()
+@click.argument('ip', required=True)
+@click.option('--store', 'store_path', required=True, type=click.Path(exists=True, file_okay=False),
+              help='Directory of the sample store.')
+@click.option('--start', help='Time of the first sample: UNIX time or YYYY-MM-DDTHH:MM:SS.')
+@click.option('--end', help='Time of the last sample: UNIX time or YYYY-MM-DDTHH:MM:SS.')
+def query(ip, store_path, start, end):
+    """
+    Prints the stored samples of a server, one JSON line per sample.
+    """
+    try:
+        from vmdiag import store
+        ip_address = parser.int_to_address(parser.address_to_int(ip.strip()))
+        sample_store = store.SampleStore(store_path, retention=0)
+        for sample in sample_store.query(ip_address, parse_time(start), parse_time(end)):
+            click.echo(json.dumps(sample, separators=(',', ':')))
+    except Exception as error:
+        click.echo("Error: %s" % error)
+
+
+@main.command()
+@click.argument('stream', default='-', type=click.File('r'))
+def expand(stream):
+    """
+    Rebuilds the full records of a stream written with --watch --diff, read
+    from the STREAM file or the standard input, one JSON line per sample.
+    The samples of a server before its first full record are skipped.
+    """
+    try:
+        from vmdiag import delta
+        decoder = delta.DeltaDecoder()
+        for line in stream:
+            if not line.strip():
+                continue
+            record = decoder.decode(json.loads(line))
+            if record is not None:
+                click.echo(json.dumps(record, separators=(',', ':')))
+    except Exception as error:
+        click.echo("Error: %s" % error)
+
+
+@main.command()
+@click.argument('rules_path', metavar='RULES')
+@click.argument('inputs', nargs=-1, metavar='[RESULTS]...')
+def check(rules_path, inputs):
+    """
+    Evaluates the alert rules of the RULES file against the results of a
+    sweep or a watch, read from the RESULTS files (server_data.json by
+    default) or the standard input (-), and prints one JSON line per alert.
+    With several files, the rates of change are taken between the last two
+    samples of every server.
+
+    Exits with 0 without alerts, 1 with warnings, 2 with critical alerts and
+    3 if the rules or the results could not be read.
+    """
+    from vmdiag import rules
+    try:
+        with open(rules_path) as rules_file:
+            rule_list = rules.parse_rules(json.load(rules_file))
+        hosts = {}
+        for path in inputs or ['server_data.json']:
+            if path == '-':
+                results = rules.read_results(click.get_text_stream('stdin'), time.time())
+            else:
+                with open(path) as results_file:
+                    results = list(rules.read_results(results_file, os.path.getmtime(path)))
+            for ip_address, timestamp, record in results:
+                rules.add_sample(hosts, ip_address, record, timestamp)
+        alerts = rules.evaluate(rule_list, hosts)
     except Exception as error:
         click.echo("Error: %s" % error)
+        sys.exit(rules.EXIT_UNKNOWN)
+    for alert in alerts:
+        click.echo(json.dumps(alert, separators=(',', ':')))
+    click.echo('%d alerts on %d of %d servers' % (
+        len(alerts), len(set(alert['ip'] for alert in alerts)), len(hosts)), err=True)
+    sys.exit(rules.exit_code(alerts))
 
 
 if __name__ == '__main__':